@@ -0,0 +1,12 @@
+# python -m benchmarks --messages 500 --latency 0.02 --workers 1,8 --batch_size 0,50
+# python -m benchmarks startup --repeat 5
+import sys
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["startup"]:
+        del sys.argv[1]
+        from .bench_startup import main
+    else:
+        from .bench_extract import main
+
+    main()
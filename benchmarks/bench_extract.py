@@ -0,0 +1,220 @@
+"""フェイクの Gmail API に対してパイプラインを実行し、スループットを計測する"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from .fake_gmail_server import FakeGmailServer, Mailbox, build_fake_service
+
+
+def parse_int_list(v):
+    return [int(x) for x in v.split(",") if x]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="抽出パイプラインのベンチマーク")
+    parser.add_argument("--messages", type=int, default=200, help="メッセージ数")
+    parser.add_argument(
+        "--attachments", type=int, default=2, help="メッセージごとの添付ファイル数"
+    )
+    parser.add_argument(
+        "--skipped",
+        type=int,
+        default=1,
+        help="メッセージごとの除外される添付ファイル数",
+    )
+    parser.add_argument(
+        "--size", type=int, default=64 * 1024, help="添付ファイルのバイト数"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="リクエストごとの遅延（秒）"
+    )
+    parser.add_argument(
+        "--workers", type=parse_int_list, default=[1, 8], help="カンマ区切り"
+    )
+    parser.add_argument(
+        "--batch_size", type=parse_int_list, default=[0, 50], help="カンマ区切り"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=parse_int_list,
+        default=[],
+        help="pipe_extract_attachments_async の同時実行数（カンマ区切り、要 httpx）",
+    )
+    parser.add_argument(
+        "--stage_workers",
+        type=lambda v: v.split(";") if v else [],
+        default=[],
+        help="pipe_extract_attachments_stream の段階ごとのワーカー数（; 区切り、例: 'fetch=8;fetch=8,download=16'）",
+    )
+    parser.add_argument(
+        "--quota",
+        type=float,
+        default=0,
+        help="クォータ（units/秒）。0 で無制限",
+    )
+    parser.add_argument("--output", type=str, help="結果を JSON Lines で追記するパス")
+    return parser.parse_args()
+
+
+def run_async_extract(url, output_dir, scenario, quota):
+    import httpx
+
+    from modules._google_async import AsyncGmailClient, extract_attachments_async
+    from modules._ratelimit import AsyncRequestScheduler
+
+    concurrency = scenario["concurrency"]
+
+    async def run():
+        client = AsyncGmailClient(
+            httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency)),
+            root_url=url,
+            scheduler=AsyncRequestScheduler(
+                quota_per_second=quota or 1e9, concurrency=concurrency
+            ),
+        )
+        try:
+            await extract_attachments_async(
+                "file", output_dir, clean=True, client=client, **scenario
+            )
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+
+
+def run_scenario(url, workdir, scenario, quota, queue):
+    """子プロセスでパイプラインを実行する（ピーク RSS を計測するため）"""
+    from modules import _google, _stream
+    from modules._ratelimit import RequestScheduler
+
+    # プロジェクトの状態ファイルを汚さない
+    _google.STATE_FILE = os.path.join(workdir, "state.sqlite")
+    _google.CATALOG_FILE = os.path.join(workdir, "catalog.sqlite")
+    _google.JOURNAL_DIR = os.path.join(workdir, "journal")
+    output_dir = os.path.join(workdir, "out")
+
+    start = time.perf_counter()
+    if "concurrency" in scenario:
+        run_async_extract(url, output_dir, scenario, quota)
+    else:
+
+        def service_factory():
+            return build_fake_service(url)
+
+        concurrency = max(scenario["workers"], 1)
+        if "stage_workers" in scenario:
+            stages = _stream.parse_stage_workers(scenario["stage_workers"], concurrency)
+            concurrency = stages["fetch"] + stages["download"]
+
+        client = _google.GmailClient(
+            service_factory(),
+            service_factory=service_factory,
+            scheduler=RequestScheduler(
+                quota_per_second=quota or 1e9,
+                concurrency=concurrency,
+            ),
+        )
+        pipe = (
+            _stream.pipe_extract_attachments_stream
+            if "stage_workers" in scenario
+            else _google.pipe_extract_attachments
+        )
+        pipe("file", output_dir, clean=True, client=client, **scenario)
+    extract_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _google.pipe_rm_empty_dir("file", output_dir)
+    rm_empty_dir_seconds = time.perf_counter() - start
+
+    queue.put(
+        {
+            "extract_seconds": extract_seconds,
+            "rm_empty_dir_seconds": rm_empty_dir_seconds,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def count_output(output_dir):
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(output_dir):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+def main():
+    args = parse_arguments()
+    mailbox = Mailbox(
+        messages=args.messages,
+        attachments=args.attachments,
+        size=args.size,
+        skipped=args.skipped,
+    )
+    server = FakeGmailServer(mailbox, latency=args.latency).start()
+    ctx = multiprocessing.get_context("spawn")
+
+    scenarios = [
+        {"workers": workers, "batch_size": batch_size}
+        for workers, batch_size in itertools.product(args.workers, args.batch_size)
+    ]
+    scenarios += [
+        {"workers": workers, "stage_workers": stage_workers}
+        for workers, stage_workers in itertools.product(
+            args.workers, args.stage_workers
+        )
+    ]
+    scenarios += [{"concurrency": concurrency} for concurrency in args.concurrency]
+
+    results = []
+    try:
+        for scenario in scenarios:
+            server.reset()
+
+            with tempfile.TemporaryDirectory() as workdir:
+                queue = ctx.Queue()
+                process = ctx.Process(
+                    target=run_scenario,
+                    args=(server.url, workdir, scenario, args.quota, queue),
+                )
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(f"Scenario failed: {scenario}")
+                measured = queue.get()
+                files, size = count_output(os.path.join(workdir, "out"))
+
+            api_calls = sum(server.calls.values())
+            seconds = measured["extract_seconds"]
+            result = {
+                **scenario,
+                "messages": args.messages,
+                "attachments": files,
+                "messages_per_sec": round(args.messages / seconds, 2),
+                "mb_per_sec": round(size / seconds / 1024 / 1024, 2),
+                "api_calls": dict(sorted(server.calls.items())),
+                "api_calls_per_attachment": round(api_calls / max(files, 1), 3),
+                "http_requests": server.http_requests,
+                "bytes_received_mb": round(server.bytes_sent / 1024 / 1024, 2),
+                "extract_seconds": round(seconds, 3),
+                "rm_empty_dir_seconds": round(measured["rm_empty_dir_seconds"], 3),
+                "peak_rss_mb": round(measured["peak_rss_mb"], 1),
+            }
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
@@ -0,0 +1,99 @@
+"""コールドスタート（import とサービスの生成）の時間を計測する
+
+シナリオごとに新しいインタプリタを起動し、ネットワークには接続しない。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行するコード。最後に生成までの秒数を出力する
+PRELUDE = "import time\nstart = time.perf_counter()\n"
+SCENARIOS = {
+    "import": "import modules._google\n",
+    "build": (
+        "from google.auth.credentials import AnonymousCredentials\n"
+        "from googleapiclient.discovery import build\n"
+        "import modules._google\n"
+        "build('gmail', 'v1', credentials=AnonymousCredentials())\n"
+    ),
+    "static": (
+        "from google.auth.credentials import AnonymousCredentials\n"
+        "from modules import _google\n"
+        "_google.build_gmail_service(AnonymousCredentials(), discovery='static')\n"
+    ),
+    "cache": (
+        "import os\n"
+        "from google.auth.credentials import AnonymousCredentials\n"
+        "from modules import _google\n"
+        "_google.DISCOVERY_CACHE_DIR = os.environ['DISCOVERY_CACHE_DIR']\n"
+        "_google.build_gmail_service(AnonymousCredentials(), discovery='cache')\n"
+    ),
+}
+EPILOGUE = "print(time.perf_counter() - start)\n"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="コールドスタートのベンチマーク")
+    parser.add_argument("--repeat", type=int, default=5, help="シナリオごとの試行回数")
+    parser.add_argument(
+        "--scenarios",
+        type=str,
+        default=",".join(SCENARIOS),
+        help="カンマ区切り（" + " / ".join(SCENARIOS) + "）",
+    )
+    parser.add_argument("--output", type=str, help="結果を JSON Lines で追記するパス")
+    return parser.parse_args()
+
+
+def populate_cache(cache_dir):
+    """cache シナリオが取得しないよう、期限内のキャッシュを用意する"""
+    from googleapiclient.discovery_cache import get_static_doc
+
+    with open(os.path.join(cache_dir, "gmail.v1.json"), "w") as f:
+        f.write(get_static_doc("gmail", "v1"))
+
+
+def run_once(code, env):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", PRELUDE + code + EPILOGUE],
+        cwd=PROJECT_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip()), time.perf_counter() - start
+
+
+def main():
+    args = parse_arguments()
+
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        populate_cache(cache_dir)
+        env = {**os.environ, "DISCOVERY_CACHE_DIR": cache_dir}
+
+        for name in args.scenarios.split(","):
+            samples = [run_once(SCENARIOS[name], env) for _ in range(args.repeat)]
+            result = {
+                "scenario": name,
+                "repeat": args.repeat,
+                "ready_ms": round(statistics.median(s[0] for s in samples) * 1000, 1),
+                "process_ms": round(statistics.median(s[1] for s in samples) * 1000, 1),
+            }
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
@@ -0,0 +1,314 @@
+"""Gmail REST API のローカル代替サーバー（ベンチマーク用）"""
+
+import base64
+import json
+import random
+import re
+import threading
+import time
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+PREFIX = "/gmail/v1/users/me"
+
+
+def parse_fields(fields: str) -> dict:
+    """fields パラメータ（例: "a,b(c,d(e))"）を {name: 子のマスク or None} に変換する"""
+
+    def parse(i):
+        mask = {}
+        name = ""
+        while i < len(fields):
+            c = fields[i]
+            if c == "(":
+                mask[name], i = parse(i + 1)
+                name = ""
+            elif c == ")":
+                break
+            elif c == ",":
+                if name:
+                    mask[name] = None
+                name = ""
+            else:
+                name += c
+            i += 1
+        if name:
+            mask[name] = None
+        return mask, i
+
+    return parse(0)[0]
+
+
+def apply_fields(value, mask):
+    if mask is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(v, mask) for v in value]
+    if isinstance(value, dict):
+        return {k: apply_fields(v, mask[k]) for k, v in value.items() if k in mask}
+    return value
+
+
+def apply_format(message, query):
+    fmt = query.get("format", ["full"])[0]
+    if fmt != "metadata":
+        return message
+
+    names = {h.lower() for h in query.get("metadataHeaders", [])}
+    headers = message["payload"]["headers"]
+    if names:
+        headers = [h for h in headers if h["name"].lower() in names]
+    metadata = {k: v for k, v in message.items() if k != "payload"}
+    metadata["payload"] = {"headers": headers}
+    return metadata
+
+
+class Mailbox:
+    """合成メールボックス"""
+
+    def __init__(
+        self,
+        messages: int = 100,
+        attachments: int = 2,
+        size: int = 64 * 1024,
+        skipped: int = 1,
+        thread_size: int = 1,
+        seed: int = 0,
+    ):
+        rnd = random.Random(seed)
+        self.messages = {}
+        self.data = {}
+        self.order = []
+
+        for n in range(messages):
+            message_id = f"{n:016x}"
+            thread_id = f"{n - n % thread_size:016x}"
+            files = [
+                (f"file{n}_{i}.pdf", "application/pdf", size)
+                for i in range(attachments)
+            ]
+            # 署名画像など、除外される添付ファイル
+            files += [(f"image{i}.png", "image/png", 4096) for i in range(skipped)]
+
+            parts = [
+                {
+                    "partId": "0",
+                    "mimeType": "text/plain",
+                    "filename": "",
+                    "body": {"size": 5, "data": "aGVsbG8"},
+                }
+            ]
+            for i, (filename, mime_type, file_size) in enumerate(files, 1):
+                attachment_id = f"{message_id}-{i}"
+                self.data[attachment_id] = rnd.randbytes(file_size)
+                parts.append(
+                    {
+                        "partId": str(i),
+                        "mimeType": mime_type,
+                        "filename": filename,
+                        "headers": [
+                            {"name": "Content-Type", "value": mime_type},
+                            {
+                                "name": "Content-Disposition",
+                                "value": f'attachment; filename="{filename}"',
+                            },
+                        ],
+                        "body": {"attachmentId": attachment_id, "size": file_size},
+                    }
+                )
+
+            self.messages[message_id] = {
+                "id": message_id,
+                "threadId": thread_id,
+                "labelIds": ["INBOX"],
+                "snippet": "hello",
+                "historyId": "1",
+                "internalDate": "1696309849000",
+                "sizeEstimate": sum(f[2] for f in files),
+                "payload": {
+                    "partId": "",
+                    "mimeType": "multipart/mixed",
+                    "filename": "",
+                    "headers": [
+                        {
+                            "name": "From",
+                            "value": f"Sender <sender{n % 10}@example.com>",
+                        },
+                        {"name": "Subject", "value": f"invoice {n}"},
+                        {"name": "Date", "value": "Tue, 03 Oct 2023 05:10:49 +0000"},
+                        # 実際のメールと同様に、抽出に不要なヘッダーを多く含める
+                        *({"name": "Received", "value": "x" * 200} for _ in range(20)),
+                    ],
+                    "body": {"size": 0},
+                    "parts": parts,
+                },
+            }
+            self.order.append(message_id)
+
+
+class FakeGmailServer:
+    """Mailbox を Gmail REST API として公開する。リクエストごとに latency 秒待機する"""
+
+    def __init__(self, mailbox: Mailbox, latency: float = 0.0, page_size: int = 100):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = {}
+        self.http_requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.http_requests = 0
+            self.bytes_sent = 0
+
+    def _record(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def dispatch(self, path, query):
+        """(status, body) を返す。fields パラメータがあればレスポンスを絞り込む"""
+        status, response = self._dispatch(path, query)
+        if status == 200 and "fields" in query:
+            response = apply_fields(response, parse_fields(query["fields"][0]))
+        return status, response
+
+    def _dispatch(self, path, query):
+        mailbox = self.mailbox
+
+        if path == f"{PREFIX}/profile":
+            self._record("gmail.users.getProfile")
+            return 200, {"emailAddress": "me@example.com", "historyId": "1"}
+
+        if path == f"{PREFIX}/history":
+            self._record("gmail.users.history.list")
+            return 200, {"historyId": "1"}
+
+        if path == f"{PREFIX}/messages":
+            self._record("gmail.users.messages.list")
+            start = int(query.get("pageToken", ["0"])[0])
+            size = int(query.get("maxResults", [self.page_size])[0])
+            ids = mailbox.order[start : start + size]
+            response = {
+                "messages": [
+                    {"id": i, "threadId": mailbox.messages[i]["threadId"]} for i in ids
+                ],
+                "resultSizeEstimate": len(ids),
+            }
+            if start + size < len(mailbox.order):
+                response["nextPageToken"] = str(start + size)
+            return 200, response
+
+        m = re.fullmatch(rf"{PREFIX}/messages/([^/]+)/attachments/([^/]+)", path)
+        if m:
+            self._record("gmail.users.messages.attachments.get")
+            data = mailbox.data.get(m.group(2))
+            if data is None:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            encoded = base64.urlsafe_b64encode(data).decode("ascii")
+            return 200, {"size": len(data), "data": encoded}
+
+        m = re.fullmatch(rf"{PREFIX}/messages/([^/]+)", path)
+        if m:
+            self._record("gmail.users.messages.get")
+            message = mailbox.messages.get(m.group(1))
+            if message is None:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            return 200, apply_format(message, query)
+
+        return 404, {"error": {"code": 404, "message": f"Unknown path: {path}"}}
+
+    def dispatch_batch(self, content_type, body: str) -> str:
+        message = Parser().parsestr(f"Content-Type: {content_type}\r\n\r\n" + body)
+        boundary = "batch_fake_gmail"
+        chunks = []
+        for part in message.get_payload():
+            request_line = part.get_payload().split("\n", 1)[0]
+            _, target, _ = request_line.split(" ", 2)
+            url = urlparse(target)
+            status, response = self.dispatch(url.path, parse_qs(url.query))
+            content_id = part["Content-ID"][1:-1]
+            chunks.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(response)}\r\n"
+            )
+        chunks.append(f"--{boundary}--\r\n")
+        return f"multipart/mixed; boundary={boundary}", "".join(chunks)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # ヘッダーと本文の書き込みが Nagle により遅延しないようにする
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, content_type, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                # クライアントが応答を受け取る前に集計する
+                with server._lock:
+                    server.http_requests += 1
+                    server.bytes_sent += len(body)
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                url = urlparse(self.path)
+                status, response = server.dispatch(url.path, parse_qs(url.query))
+                body = json.dumps(response).encode()
+                self._send(status, "application/json; charset=UTF-8", body)
+
+            def do_POST(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                content_type, response = server.dispatch_batch(
+                    self.headers["Content-Type"], body
+                )
+                self._send(200, content_type, response.encode())
+
+        return Handler
+
+
+def build_fake_service(url: str):
+    """フェイクサーバーに接続する Gmail サービスを生成する（認証なし）"""
+    document = json.loads(get_static_doc("gmail", "v1"))
+    document["rootUrl"] = url
+    document["baseUrl"] = url
+    return build_from_document(document, http=httplib2.Http())
@@ -1,4 +1,10 @@
 import argparse
+import json
+import logging
+import sys
+import time
+
+logger = logging.getLogger(__name__)
 
 
 def convert_str_to_bool(v):
@@ -35,20 +41,282 @@ def parse_arguments():
         "--pipelines", help="実行するパイプラインの順序をカンマ区切りで指定する"
     )
     parser.add_argument("--query", type=str, help="gmail のフィルタを指定する")
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        type=convert_str_to_bool,
+        default=False,
+        help="抽出済みのメールをスキップし、差分のみを抽出する",
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        type=convert_str_to_bool,
+        default=False,
+        help="中断した抽出を最後のチェックポイントから再開する（clean は無視される）",
+    )
+    parser.add_argument(
+        "--shards",
+        type=str,
+        default="",
+        help="query の after: / before: の期間を分割し、一覧を並列に取得する（day / week / month / 分割数）",
+    )
+    parser.add_argument(
+        "--skip_existing",
+        type=convert_str_to_bool,
+        default=True,
+        help="出力先に既に存在するファイルをダウンロードしない",
+    )
+    parser.add_argument(
+        "--postprocess",
+        type=str,
+        default="",
+        help="保存した添付ファイルに別プロセスで適用する変換をカンマ区切りで指定する（gunzip / unzip）",
+    )
+    parser.add_argument(
+        "--postprocess_workers",
+        type=int,
+        default=0,
+        help="後処理のプロセス数（0 で CPU 数）",
+    )
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        default="",
+        choices=["", "hardlink", "symlink", "manifest"],
+        help="同じ内容の添付ファイルを一度だけ保存する方法",
+    )
+    parser.add_argument(
+        "--fetch_profile",
+        type=str,
+        default="attachments",
+        choices=["attachments", "full", "raw"],
+        help="メッセージ取得時のフィールド（attachments は必要なフィールドのみ取得する、raw は小さなメッセージを 1 回で取得する）",
+    )
+    parser.add_argument(
+        "--threads",
+        type=convert_str_to_bool,
+        default=False,
+        help="同じスレッドのメールを threads().get でまとめて取得する（batch_size と併用できない）",
+    )
+    parser.add_argument(
+        "--raw_max_size",
+        type=int,
+        default=1024 * 1024,
+        help="fetch_profile が raw の場合に、raw で取得するメッセージのバイト数の上限",
+    )
+    parser.add_argument(
+        "--discovery",
+        type=str,
+        default="static",
+        choices=["static", "cache"],
+        help="ディスカバリドキュメントの取得元（static は同梱のもの、cache は取得して 1 日キャッシュする）",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="添付ファイルを並列に取得するワーカー数",
+    )
+    parser.add_argument(
+        "--stage_workers",
+        type=str,
+        default="",
+        help="pipe_extract_attachments_stream の段階ごとのワーカー数（例: fetch=8,download=16,write=4）",
+    )
+    parser.add_argument(
+        "--stage_queue",
+        type=int,
+        default=0,
+        help="pipe_extract_attachments_stream の段階の間のキューの上限（0 でワーカー数の 2 倍）",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="pipe_extract_attachments_async で同時に取得するメール数",
+    )
+    parser.add_argument(
+        "--quota_per_second",
+        type=float,
+        default=250,
+        help="メールボックスに使うクォータ（units/秒、ユーザーごとの上限は 250）",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=0,
+        help="メッセージをバッチリクエストで取得する件数（0 で無効、最大 100）",
+    )
+    parser.add_argument(
+        "--exclude_mime_types",
+        type=str,
+        default="",
+        help="ダウンロードしない MIME タイプをカンマ区切りで指定する（image/ で前方一致）",
+    )
+    parser.add_argument(
+        "--max_size",
+        type=int,
+        default=0,
+        help="このバイト数を超える添付ファイルをダウンロードしない（0 で無制限）",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default="",
+        help="パイプラインごとの計測値を JSON Lines で追記するパス",
+    )
+    parser.add_argument(
+        "--prometheus",
+        type=str,
+        default="",
+        help="計測値を Prometheus のテキスト形式で書き出すパス（textfile collector 向け）",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="",
+        help="cProfile の結果を書き出すパス（python -m pstats で読める。ワーカースレッドも含め、後処理のプロセスは含まない）",
+    )
 
     return parser.parse_args()
 
 
+def parse_query_arguments(argv):
+    """query サブコマンドの引数を解析"""
+    parser = argparse.ArgumentParser(
+        prog="python -m modules query", description="カタログを SQL で検索する"
+    )
+    parser.add_argument("sql", type=str, help="実行する SQL（mails / attachments）")
+    parser.add_argument("--catalog", type=str, help="カタログのパス")
+    return parser.parse_args(argv)
+
+
+def parse_accounts_arguments(argv):
+    """accounts サブコマンドの引数を解析"""
+    parser = argparse.ArgumentParser(
+        prog="python -m modules accounts",
+        description="マニフェストの複数のアカウントを並列に抽出する",
+    )
+    parser.add_argument("manifest", type=str, help="マニフェスト（JSON）のパス")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="同時に抽出するアカウント数（0 ですべて）",
+    )
+    parser.add_argument(
+        "--authorize",
+        action="store_true",
+        help="トークンの無いアカウントを、抽出の前に順に認可する",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default="",
+        help="アカウントごとのサマリーを JSON Lines で追記するパス",
+    )
+    return parser.parse_args(argv)
+
+
+def main_accounts(argv):
+    # python -m modules accounts accounts.json --processes 8
+    args = parse_accounts_arguments(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from ._accounts import authorize_accounts, load_manifest, run_accounts
+
+    accounts, project_quota = load_manifest(args.manifest)
+    if args.authorize:
+        authorize_accounts(accounts)
+
+    start = time.perf_counter()
+    results = run_accounts(accounts, args.processes, project_quota)
+    seconds = round(time.perf_counter() - start, 3)
+
+    for result in results:
+        logger.info("[ACCOUNT]%s", json.dumps(result, ensure_ascii=False))
+    if args.metrics:
+        with open(args.metrics, "a") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    failed = [r["account"] for r in results if r["status"] != "ok"]
+    slowest = max((r.get("seconds", 0) for r in results), default=0)
+    logger.info(
+        f"[SUMMARY] accounts: {len(results)} failed: {len(failed)}"
+        f" seconds: {seconds} slowest: {slowest}"
+    )
+    return 1 if failed else 0
+
+
+def run_query(argv):
+    # python -m modules query "SELECT path FROM attachments WHERE mime = 'application/pdf'"
+    args = parse_query_arguments(argv)
+
+    from ._catalog import query_catalog
+    from ._google import CATALOG_FILE
+
+    try:
+        columns, rows = query_catalog(args.catalog or CATALOG_FILE, args.sql)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join("" if v is None else str(v) for v in row))
+    return 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["query"]:
+        sys.exit(run_query(sys.argv[2:]))
+    if sys.argv[1:2] == ["accounts"]:
+        sys.exit(main_accounts(sys.argv[2:]))
+
     args = parse_arguments()
 
-    from . import _google
+    from ._metrics import metrics
+    from ._pipeline import get_pipeline, select_kwargs
 
     # python -m modules --protocol=file --output_dir=.cache --clean 1 --pipelines=extract_attachments,filter_attachments,rm_empty_dir
     kwargs = vars(args)
     _pipelines = kwargs.pop("pipelines")
     pipelines = _pipelines.split(",")
 
-    for funcname in pipelines:
-        func = getattr(_google, funcname)
-        func(**kwargs)
+    profiler = None
+    if args.profile:
+        from ._metrics import ThreadProfiler
+
+        profiler = ThreadProfiler()
+
+    try:
+        for funcname in pipelines:
+            func = get_pipeline(funcname)
+            start = time.perf_counter()
+            try:
+                with metrics.scope(pipeline=funcname):
+                    if profiler is None:
+                        func(**select_kwargs(func, kwargs))
+                    else:
+                        with profiler:
+                            func(**select_kwargs(func, kwargs))
+            finally:
+                # 失敗した場合も、どこまで進んだかを出力する
+                summary = {
+                    "pipeline": funcname,
+                    "seconds": round(time.perf_counter() - start, 3),
+                    **metrics.summary(pipeline=funcname),
+                }
+                logger.info("[METRICS]%s", json.dumps(summary, ensure_ascii=False))
+                if args.metrics:
+                    with open(args.metrics, "a") as f:
+                        f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+    finally:
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus)
+        if profiler is not None:
+            profiler.dump_stats(args.profile)
+            logger.info(f"[PROFILE] {args.profile}")
@@ -0,0 +1,182 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from ._metrics import metrics
+from ._path import assert_linux_safe_path
+from ._ratelimit import USER_QUOTA_PER_SECOND
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# アカウントごとのトークン・状態・カタログ・ジャーナルを置くディレクトリ
+ACCOUNTS_DIR = os.path.join(PROJECT_ROOT, ".accounts")
+DEFAULT_PIPELINES = ["pipe_extract_attachments", "pipe_rm_empty_dir"]
+
+# パイプラインの引数ではない、マニフェストのキー
+ACCOUNT_KEYS = {"name", "token", "state_dir", "output_prefix", "pipelines"}
+
+
+def load_manifest(path: str):
+    """マニフェスト（JSON）を読み込み、(アカウントのリスト, プロジェクトのクォータ) を返す
+
+    {
+      "defaults": {"protocol": "file", "output_prefix": ".cache/accounts", ...},
+      "project_quota_per_second": 1000,
+      "accounts": [{"name": "alice", "query": "has:attachment"}, ...]
+    }
+
+    アカウントは defaults を上書きする。token / state_dir を省略すると
+    ACCOUNTS_DIR/{name}/ 以下を、output_dir を省略すると {output_prefix}/{name} を使う。
+    それ以外のキーはパイプラインの引数として渡す。
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+
+    defaults = manifest.get("defaults", {})
+    accounts = []
+    names = set()
+    for entry in manifest["accounts"]:
+        account = {**defaults, **entry}
+        name = account["name"]
+        assert_linux_safe_path(name)
+        if "/" in name or not name:
+            raise ValueError(f"Invalid account name: {name}")
+        if name in names:
+            raise ValueError(f"Duplicate account: {name}")
+        names.add(name)
+
+        account_dir = os.path.join(ACCOUNTS_DIR, name)
+        account.setdefault("token", os.path.join(account_dir, "token.json"))
+        account.setdefault("state_dir", account_dir)
+        if "output_dir" not in account:
+            if "output_prefix" not in account:
+                raise ValueError(f"output_dir or output_prefix is required: {name}")
+            account["output_dir"] = os.path.join(account["output_prefix"], name)
+        account.setdefault("pipelines", DEFAULT_PIPELINES)
+        accounts.append(account)
+
+    return accounts, manifest.get("project_quota_per_second")
+
+
+def share_quota(accounts, processes: int, project_quota_per_second=None):
+    """プロジェクトのクォータを、同時に実行するアカウントで均等に分ける
+
+    ユーザーごとのクォータはアカウントごとに独立しているため、上限はそれぞれに適用する。
+    """
+    if not project_quota_per_second:
+        return accounts
+
+    share = project_quota_per_second / max(1, min(processes, len(accounts)))
+    return [
+        {
+            **account,
+            "quota_per_second": min(
+                account.get("quota_per_second", USER_QUOTA_PER_SECOND), share
+            ),
+        }
+        for account in accounts
+    ]
+
+
+def use_account(account: dict):
+    """このプロセスで使うトークンと状態のパスを、アカウントのものに切り替える"""
+    from . import _google
+
+    os.makedirs(account["state_dir"], exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(account["token"])), exist_ok=True)
+    _google.TOKEN_FILE = account["token"]
+    _google.STATE_FILE = os.path.join(account["state_dir"], "state.sqlite")
+    _google.CATALOG_FILE = os.path.join(account["state_dir"], "catalog.sqlite")
+    _google.JOURNAL_DIR = os.path.join(account["state_dir"], "journal")
+
+
+def run_account(account: dict) -> dict:
+    """アカウントのパイプラインを実行し、サマリーを返す（ワーカープロセスで呼ばれる）
+
+    失敗した場合も例外は送出せず、サマリーの status と error に記録する。
+    """
+    from ._pipeline import get_pipeline, select_kwargs
+
+    name = account["name"]
+    summary = {"account": name, "output_dir": account["output_dir"], "status": "ok"}
+    kwargs = {k: v for k, v in account.items() if k not in ACCOUNT_KEYS}
+
+    start = time.perf_counter()
+    try:
+        # ワーカーでブラウザの認可を待たないよう、トークンは事前に用意する（--authorize）
+        if not os.path.exists(account["token"]):
+            raise FileNotFoundError(f"Token not found: {account['token']}")
+
+        use_account(account)
+        with metrics.scope(account=name):
+            for funcname in account["pipelines"]:
+                func = get_pipeline(funcname)
+                func(**select_kwargs(func, kwargs))
+    except Exception as e:
+        logger.exception(f"[ACCOUNT] {name} failed")
+        summary.update(status="error", error=repr(e))
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    summary.update(metrics.summary(account=name))
+    return summary
+
+
+def init_worker(level):
+    logging.basicConfig(
+        level=level, format="%(levelname)s:%(processName)s:%(name)s:%(message)s"
+    )
+
+
+def run_accounts(accounts, processes: int = 0, project_quota_per_second=None):
+    """アカウントごとにプロセスを分けて並列に抽出し、サマリーをマニフェストの順序で返す
+
+    processes を省略すると全アカウントを同時に実行する（全体の時間は最も大きな
+    メールボックスの時間に近づく）。アカウントはそれぞれのクォータで独立に取得するため、
+    大きなメールボックスが他のアカウントのクォータを使い切ることはない。
+    """
+    if not accounts:
+        return []
+
+    processes = min(processes or len(accounts), len(accounts))
+    accounts = share_quota(accounts, processes, project_quota_per_second)
+
+    results = {}
+    # スレッドを使うプロセスを fork しないよう spawn で起動する
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(logging.getLogger().level,),
+    ) as executor:
+        futures = {executor.submit(run_account, a): a["name"] for a in accounts}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except BrokenProcessPool as e:
+                # ワーカープロセスが異常終了した場合
+                results[name] = {"account": name, "status": "error", "error": repr(e)}
+            result = results[name]
+            logger.info(
+                f"[ACCOUNT] {name} {result['status']} seconds: {result.get('seconds')}"
+            )
+
+    return [results[a["name"]] for a in accounts]
+
+
+def authorize_accounts(accounts):
+    """トークンの無いアカウントを順に認可する（ブラウザで認可 URL を開く）"""
+    from . import _google
+
+    for account in accounts:
+        if os.path.exists(account["token"]):
+            continue
+
+        logger.info(f"[ACCOUNT] authorize: {account['name']}")
+        use_account(account)
+        _google.OauthFlow(_google.CredentialResoruce()).exec()
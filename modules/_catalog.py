@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from ._state import SQLITE_TIMEOUT
+
+
+class Catalog:
+    """抽出したメールと添付ファイルのメタデータを SQLite に記録する。
+
+    select ... from mails / select ... from attachments でオフラインに検索できる。
+    メールと添付ファイルはメールの完了までメモリに保持し、commit で 1 回の
+    トランザクションで書き込む（並列に実行した別の抽出を書き込みロックで待たせない）。
+    """
+
+    def __init__(self, path: str, timeout: float = SQLITE_TIMEOUT):
+        self.path = path
+        # add_mail はワーカースレッドから呼び出されるため、ロックで保護する
+        self._lock = threading.Lock()
+        # 完了していないメールの [mails の行, attachments の行のリスト]（メール ID ごと）
+        self._pending = {}
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS mails (
+                    id TEXT PRIMARY KEY,
+                    thread_id TEXT,
+                    sender_name TEXT,
+                    sender TEXT,
+                    date TEXT,
+                    title TEXT
+                );
+                CREATE TABLE IF NOT EXISTS attachments (
+                    path TEXT PRIMARY KEY,
+                    output_dir TEXT NOT NULL,
+                    mail_id TEXT NOT NULL,
+                    filename TEXT,
+                    mime TEXT,
+                    size INTEGER,
+                    hash TEXT
+                );
+                CREATE INDEX IF NOT EXISTS mails_sender ON mails (sender);
+                CREATE INDEX IF NOT EXISTS mails_date ON mails (date);
+                CREATE INDEX IF NOT EXISTS attachments_mail_id ON attachments (mail_id);
+                CREATE INDEX IF NOT EXISTS attachments_mime ON attachments (mime);
+                CREATE INDEX IF NOT EXISTS attachments_hash ON attachments (hash);
+                """
+            )
+
+    def _get_pending(self, mail_id) -> list:
+        return self._pending.setdefault(mail_id, [None, []])
+
+    def add_mail(self, message: dict, info: dict):
+        with self._lock:
+            self._get_pending(message["id"])[0] = (
+                message["id"],
+                message.get("threadId"),
+                info["sender_name"],
+                info["sender_address"],
+                info["date"],
+                info["title"],
+            )
+
+    def add_attachment(
+        self, output_dir, mail_id, filename, mime, size, path, digest=None
+    ):
+        with self._lock:
+            self._get_pending(mail_id)[1].append(
+                (path, output_dir, mail_id, filename, mime, size, digest)
+            )
+
+    def commit(self, mail_id):
+        """メールとその添付ファイルを 1 回のトランザクションで書き込む"""
+        with self._lock:
+            mail, attachments = self._pending.pop(mail_id, (None, []))
+            with self._conn:
+                if mail is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?, ?, ?)", mail
+                    )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    attachments,
+                )
+
+    def reset(self, output_dir):
+        """出力先の添付ファイルの記録を削除する"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM attachments WHERE output_dir = ?", (output_dir,)
+            )
+
+    def query(self, sql, params=()):
+        """SQL を実行し、列名と行を返す"""
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            columns = [d[0] for d in cursor.description or []]
+            return columns, cursor.fetchall()
+
+    def close(self):
+        # 完了していないメールは記録しない
+        with self._lock:
+            self._pending.clear()
+            self._conn.close()
+
+
+def query_catalog(path: str, sql, params=()):
+    """カタログを読み取り専用で開いて SQL を実行し、列名と行を返す
+
+    パスを誤った場合に空のカタログを作成せず、SQL による変更も保存しない。
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Catalog not found: {path}")
+
+    conn = sqlite3.connect(f"{Path(path).absolute().as_uri()}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute(sql, params)
+        columns = [d[0] for d in cursor.description or []]
+        return columns, cursor.fetchall()
+    finally:
+        conn.close()
@@ -1,16 +1,40 @@
 import os
 import json
 import base64
-from typing import TypedDict, Iterable
+import hashlib
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, TypedDict, Iterable
 import logging
 
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間の排他を行わない
+    fcntl = None
+
+from googleapiclient.errors import HttpError
 from fsspec import filesystem, AbstractFileSystem
 
 from ._path import assert_linux_safe_path, decode_email_date, decode_email_sender
+from ._postprocess import PostProcessor
+from ._raw import parse_raw_message
+from ._ratelimit import USER_QUOTA_PER_SECOND, RequestScheduler, is_retryable
+from ._shard import shard_query
+from ._catalog import Catalog
+from ._state import Journal, SyncState
+from ._store import BlobStore
+from ._writer import BulkWriter, OutputIndex
+from ._metrics import metrics
+
+# 認証やサービスの生成に使うモジュールは import に時間がかかるため、使う時点で読み込む
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +45,79 @@ SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_FILE = os.path.join(PROJECT_ROOT, "google_secret.secret.json")
 TOKEN_FILE = os.path.join(PROJECT_ROOT, "token.json")
+STATE_FILE = os.path.join(PROJECT_ROOT, "state.sqlite")
+CATALOG_FILE = os.path.join(PROJECT_ROOT, "catalog.sqlite")
+JOURNAL_DIR = os.path.join(PROJECT_ROOT, ".journal")
+
+# 有効期限までの残りがこれを下回ったら、期限切れを待たずに更新する
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# ディスカバリドキュメントのキャッシュ（--discovery cache）
+DISCOVERY_CACHE_DIR = os.path.join(PROJECT_ROOT, ".discovery")
+DISCOVERY_TTL = 24 * 60 * 60
+DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+DISCOVERY_SOURCES = {"static", "cache"}
+
+# バッチリクエストの上限は 100 件だが、Gmail は 50 件以下を推奨している
+MAX_BATCH_SIZE = 100
+
+
+# messages().list の maxResults の上限
+MAX_PAGE_SIZE = 500
+
+# 添付ファイルの探索に使うパートのフィールド（ネストしたパートは MAX_PART_DEPTH 階層まで）
+MAX_PART_DEPTH = 6
+PART_FIELDS = "partId,mimeType,filename,body(attachmentId,size,data)"
+
+
+def get_parts_fields(depth=MAX_PART_DEPTH):
+    fields = PART_FIELDS
+    for _ in range(depth):
+        fields = f"{PART_FIELDS},parts({fields})"
+    return f"parts({fields})"
+
+
+# messages().get に渡すパラメータ。select に必要なヘッダーと、パートの構造のみを取得する
+FETCH_PROFILES = {
+    "full": {"format": "full"},
+    "attachments": {
+        "format": "full",
+        "fields": f"id,threadId,payload(headers,{PART_FIELDS},{get_parts_fields()})",
+    },
+    "metadata": {
+        "format": "metadata",
+        "metadataHeaders": ["Subject", "Date", "From"],
+        "fields": "id,threadId,payload(headers)",
+    },
+    # メッセージ全体を 1 回で取得し、添付ファイルはローカルで切り出す（parse_raw_message）
+    "raw": {"format": "raw", "fields": "id,threadId,raw"},
+}
+
+# fetch_profile が raw の場合に、raw で取得するメッセージのサイズの上限（これより大きい
+# メッセージは attachments で取得する）。除外する添付ファイルもダウンロードするため小さくする
+RAW_MAX_SIZE = 1024 * 1024
+LIST_FIELDS = "messages(id,threadId),nextPageToken"
+
+# htmlに含まれるデータなども添付ファイルとして認識されてしまうので exclude
+DEFAULT_EXCLUDES = {
+    ".ics",
+    ".html",
+    ".htm",
+    ".css",
+    ".js",
+    ".gif",
+    ".png",
+    ".p7s",  # 電子署名付きEメールに対応していない場合に、smime.p7s という添付ファイルが添付される
+}
+
+
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class CredentialResoruce:
@@ -55,26 +152,82 @@ class CredentialResoruce:
 
     @classmethod
     def save_token(cls, token: dict):
-        with open(cls.get_token_path(), "w") as f:
+        """一時ファイルに書き込んでから置き換え、読み込み途中の破損を防ぐ"""
+        path = cls.get_token_path()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
             json.dump(token, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    @contextmanager
+    def lock(cls):
+        """トークンの読み込みから更新までを、プロセス間で排他する"""
+        if fcntl is None:
+            yield
+            return
+
+        with open(f"{cls.get_token_path()}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def needs_refresh(creds: "Credentials") -> bool:
+    """有効期限が TOKEN_REFRESH_MARGIN 以内に迫っているかを返す"""
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth の expiry は naive な UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < TOKEN_REFRESH_MARGIN
 
 
 class OauthFlow:
+    # トークンのパスごとに、プロセス内で認証情報を共有する
+    _cache = {}
+    _cache_lock = threading.Lock()
+
     def __init__(self, resource: CredentialResoruce):
         self._res = resource
 
     def exec(self):
+        """キャッシュした認証情報を返す。期限が迫っていれば更新する"""
         res: CredentialResoruce = self._res
+        path = res.get_token_path()
+
+        with self._cache_lock:
+            creds = self._cache.get(path)
+            if creds is not None and not needs_refresh(creds):
+                return creds
+
+            # 並列に実行した他のプロセスが更新した token.json を読み直す
+            with res.lock():
+                creds = self._exec(res)
+            self._cache[path] = creds
+            return creds
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    def _exec(self, res: CredentialResoruce):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
 
         token = res.get_token_or_none()
         if token is None:
             return self._run_oauth_flow(res)
 
         creds = Credentials.from_authorized_user_info(token)
-        if creds.valid:
+        if not needs_refresh(creds):
             return creds
 
-        if creds.expired and creds.refresh_token:
+        if creds.refresh_token:
             try:
                 creds.refresh(Request())
                 res.save_token(json.loads(creds.to_json()))
@@ -96,12 +249,16 @@ class OauthFlow:
 
     @classmethod
     def exec_oauth_flow_from_dict(cls, input_secret_path, scopes) -> dict:
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_config(input_secret_path, scopes)
         creds = flow.run_local_server(port=0, open_browser=False)
         return creds
 
 
 def authenticate_and_build_service(serviceName, version, **kwargs):
+    from googleapiclient.discovery import build
+
     loc = CredentialResoruce()
     flow = OauthFlow(loc)
     creds = flow.exec()
@@ -109,23 +266,321 @@ def authenticate_and_build_service(serviceName, version, **kwargs):
     return build(serviceName, version, credentials=creds, **kwargs)
 
 
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+
+def fetch_discovery_document() -> str:
+    import httplib2
+
+    response, content = httplib2.Http(timeout=10).request(DISCOVERY_URL)
+    if response.status != 200:
+        raise RuntimeError(f"Failed to fetch discovery document: {response.status}")
+    return content.decode("utf-8")
+
+
+def load_discovery_document(source: str = "static", ttl: float = DISCOVERY_TTL):
+    """Gmail API のディスカバリドキュメントを返す（プロセス内では一度だけ解析する）
+
+    static は google-api-python-client に同梱されたものを使い、ネットワークに接続しない。
+    cache は DISCOVERY_CACHE_DIR に保存したものを ttl 秒まで使い、期限切れなら取得し直す。
+    取得に失敗した場合は、期限切れのキャッシュか同梱のものを使う。
+    """
+    if source not in DISCOVERY_SOURCES:
+        raise ValueError(f"Unknown discovery source: {source}")
+
+    with _discovery_lock:
+        document = _discovery_documents.get(source)
+        if document is None:
+            document = json.loads(_read_discovery_document(source, ttl))
+            _discovery_documents[source] = document
+        return document
+
+
+def _read_discovery_document(source: str, ttl: float) -> str:
+    from googleapiclient.discovery_cache import get_static_doc
+
+    if source == "static":
+        return get_static_doc("gmail", "v1")
+
+    path = os.path.join(DISCOVERY_CACHE_DIR, "gmail.v1.json")
+    exists = os.path.exists(path)
+    if exists and time.time() - os.path.getmtime(path) < ttl:
+        with open(path) as f:
+            return f.read()
+
+    try:
+        content = fetch_discovery_document()
+    except Exception as e:
+        logger.warning(f"[DISCOVR] fetch failed: {e}")
+        if exists:
+            with open(path) as f:
+                return f.read()
+        return get_static_doc("gmail", "v1")
+
+    os.makedirs(DISCOVERY_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+    return content
+
+
+def build_gmail_service(credentials=None, discovery: str = "static", **kwargs):
+    """ディスカバリドキュメントから Gmail のサービスを生成する（build の取得・解析を省く）"""
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(
+        load_discovery_document(discovery), credentials=credentials, **kwargs
+    )
+
+
 class GMailInfo(TypedDict):
     id: str
     threadId: str
 
 
+class PartInfo(TypedDict):
+    filename: str
+    mime_type: str
+    size: int
+    sender_address: str
+    date: str
+
+
+class AttachmentFilter:
+    """パートのメタデータから、添付ファイルをダウンロードするかを判定する"""
+
+    def __init__(
+        self,
+        excludes: Iterable[str] = (),
+        exclude_mime_types: Iterable[str] = (),
+        min_size: int = 0,
+        max_size: int = 0,
+    ):
+        self.excludes = set(excludes)
+        # "image/" のように末尾を / にすると前方一致する
+        self.exclude_mime_types = set(exclude_mime_types)
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def __call__(self, part: PartInfo) -> bool:
+        filename = part["filename"]
+        for exclude in self.excludes:
+            if exclude in filename:
+                return False
+
+        mime_type = (part["mime_type"] or "").lower()
+        for exclude in self.exclude_mime_types:
+            if mime_type == exclude or (
+                exclude.endswith("/") and mime_type.startswith(exclude)
+            ):
+                return False
+
+        size = part["size"]
+        if size < self.min_size:
+            return False
+        if self.max_size and size > self.max_size:
+            return False
+
+        return True
+
+
+class ExtractStats:
+    """スキップしたリクエスト数などを集計する（ワーカー間で共有する）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.skipped_requests = 0
+        self.skipped_bytes = 0
+
+    def skip(self, size: int, request: bool = True):
+        with self._lock:
+            if request:
+                self.skipped_requests += 1
+            self.skipped_bytes += size
+        if request:
+            metrics.inc("skipped_requests")
+        metrics.inc("skipped_bytes", size)
+
+    def log_summary(self):
+        logger.info(
+            f"[SUMMARY] skipped requests: {self.skipped_requests}"
+            f" bytes: {self.skipped_bytes}"
+        )
+
+
+def walk_parts(payload: dict):
+    """パートのツリーを深さ優先（文書順）で走査する。
+
+    multipart/* や転送された message/rfc822 の入れ子も辿る。再帰はしない。
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get("parts", [])))
+
+
+def find_truncated_part(payload: dict, depth: int = MAX_PART_DEPTH + 1):
+    """fields のマスクの深さで子のパートが切り捨てられたパートを返す（無ければ None）
+
+    マスクは payload から depth 階層のパートまで取得するため、その階層の multipart/*
+    や message/rfc822 は parts を持たず、その下の添付ファイルが見つからない。
+    """
+    stack = [(payload, 0)]
+    while stack:
+        part, level = stack.pop()
+        children = part.get("parts")
+        if children:
+            stack.extend((child, level + 1) for child in children)
+            continue
+
+        mime_type = (part.get("mimeType") or "").lower()
+        if level >= depth and (
+            mime_type.startswith("multipart/") or mime_type == "message/rfc822"
+        ):
+            return part
+    return None
+
+
+def find_attachment_parts(message: dict):
+    """添付ファイルのパート（ファイル名と attachmentId か body.data を持つもの）を文書順に返す"""
+    for part in walk_parts(message.get("payload", {})):
+        body = part.get("body", {})
+        if part.get("filename") and (body.get("attachmentId") or body.get("data")):
+            yield part
+
+
+def accept_part(part: dict, info: dict, predicate=None, stats=None) -> bool:
+    """添付ファイルのパートをダウンロードするかを返す
+
+    predicate が False を返したパートはスキップし、stats に記録する。
+    """
+    filename = part["filename"]
+    body = part.get("body", {})
+    if predicate is not None and not predicate(
+        {
+            "filename": filename,
+            "mime_type": part.get("mimeType"),
+            "size": body.get("size", 0),
+            "sender_address": info["sender_address"],
+            "date": info["date"],
+        }
+    ):
+        if stats is not None:
+            stats.skip(body.get("size", 0), request=bool(body.get("attachmentId")))
+        # ログレベルで出力しない場合に文字列を組み立てないよう、% 形式で渡す
+        logger.info("[SKIP   ]%s/%s", info["sender_address"], filename)
+        return False
+
+    assert_linux_safe_path(filename)
+    return True
+
+
+def iter_attachment_parts(message: dict, info: dict, predicate=None, stats=None):
+    """ダウンロードする添付ファイルのパートを (filename, mimeType, attachmentId, data) で返す"""
+    for part in find_attachment_parts(message):
+        if accept_part(part, info, predicate, stats):
+            body = part["body"]
+            yield (
+                part["filename"],
+                part.get("mimeType"),
+                body.get("attachmentId"),
+                body.get("data"),
+            )
+
+
+def get_attachment_path(output_dir, sender_address, date, filename):
+    return os.path.join(
+        output_dir,
+        sender_address,
+        "_".join([date, filename.replace(":", "-")]),
+    )
+
+
+def skip_existing_files(predicate, index: OutputIndex, output_dir):
+    """出力先に既に存在する添付ファイルを除外する predicate を返す
+
+    index は exists(path) で判定する（OutputIndex か、manifest の BlobStore）。
+    """
+
+    def wrapper(part: PartInfo) -> bool:
+        if not predicate(part):
+            return False
+        path = get_attachment_path(
+            output_dir, part["sender_address"], part["date"], part["filename"]
+        )
+        return not index.exists(path)
+
+    return wrapper
+
+
 class GmailClient:
     @classmethod
-    def authenticate_and_build_service(cls, **kwargs):
+    def authenticate_and_build_service(
+        cls, scheduler=None, fetch_profile="attachments", discovery="static", **kwargs
+    ):
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.http import build_http
+
         loc = CredentialResoruce()
         flow = OauthFlow(loc)
         creds = flow.exec()
 
-        service = build("gmail", "v1", credentials=creds, **kwargs)
-        return cls(service)
+        service = build_gmail_service(creds, discovery=discovery, **kwargs)
+
+        def service_factory():
+            # 解析済みのディスカバリドキュメントを共有し、httplib2.Http のみ
+            # スレッドごとに作る（httplib2 はスレッドセーフではない）
+            return build_gmail_service(
+                discovery=discovery, http=AuthorizedHttp(creds, http=build_http())
+            )
+
+        return cls(
+            service,
+            service_factory=service_factory,
+            scheduler=scheduler,
+            fetch_profile=fetch_profile,
+        )
+
+    def __init__(
+        self,
+        service,
+        service_factory=None,
+        scheduler=None,
+        fetch_profile="attachments",
+        page_size=MAX_PAGE_SIZE,
+    ):
+        if fetch_profile not in FETCH_PROFILES:
+            raise ValueError(f"Unknown fetch profile: {fetch_profile}")
 
-    def __init__(self, service):
         self._service = service
+        self.fetch_profile = fetch_profile
+        self.page_size = page_size
+        self._service_factory = service_factory
+        self._local = threading.local()
+        self.stats = ExtractStats()
+        # クォータはユーザー単位のため、ワーカー間で共有する
+        self.scheduler = scheduler or RequestScheduler()
+
+    def _get_service(self):
+        """呼び出し元スレッド専用のサービスを返す（httplib2 はスレッドセーフではない）"""
+        if self._service_factory is None:
+            return self._service
+
+        if threading.current_thread() is threading.main_thread():
+            return self._service
+
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._service_factory()
+            self._local.service = service
+        return service
+
+    def _get_message_request(self, client, message_id, fetch_profile=None):
+        params = FETCH_PROFILES[fetch_profile or self.fetch_profile]
+        return client.users().messages().get(userId="me", id=message_id, **params)
 
     @classmethod
     def select(cls, message):
@@ -146,40 +601,97 @@ class GmailClient:
             "sender_address": email_address,
         }
 
-    def extract_attachments(self, message_id):
-        """メールの添付ファイルを取得"""
-        client = self._service
-
-        message = client.users().messages().get(userId="me", id=message_id).execute()
+    def get_message(self, message_id, fetch_profile=None) -> dict:
+        client = self._get_service()
+        return self.scheduler.execute(
+            self._get_message_request(client, message_id, fetch_profile)
+        )
+
+    def get_attachment(self, message_id, attachment_id) -> str:
+        """添付ファイルの内容（base64url）を返す"""
+        client = self._get_service()
+        attachment = self.scheduler.execute(
+            client.users()
+            .messages()
+            .attachments()
+            .get(userId="me", messageId=message_id, id=attachment_id)
+        )
+        return attachment.pop("data")
+
+    def load_message(self, message_id, message=None, fetch_profile=None) -> dict:
+        """添付ファイルの探索に使うメッセージを返す
+
+        message が取得済みの場合は messages().get を省略する。
+        raw で取得したメッセージは、format=full と同じ構造に変換する。
+        fields のマスクより深いパートがある場合は、format=full で取得し直す。
+        """
+        if message is None:
+            message = self.get_message(message_id, fetch_profile)
+        if "raw" in message:
+            with metrics.timer("stage_seconds", stage="parse"):
+                return parse_raw_message(message)
+
+        if "fields" in FETCH_PROFILES[fetch_profile or self.fetch_profile]:
+            part = find_truncated_part(message.get("payload", {}))
+            if part is not None:
+                # 入れ子の深い転送メールなどの添付ファイルを取りこぼさない
+                logger.warning(
+                    "[DEPTH  ]%s %s has parts beyond %d levels, refetch with format=full",
+                    message_id,
+                    part.get("mimeType"),
+                    MAX_PART_DEPTH + 1,
+                )
+                metrics.inc("refetched_messages")
+                message = self.get_message(message_id, "full")
+        return message
+
+    def extract_attachments(
+        self,
+        message_id,
+        message=None,
+        predicate=None,
+        on_message=None,
+        fetch_profile=None,
+        decode: bool = True,
+    ):
+        """メールの添付ファイルを取得
+
+        添付ファイルは取得するたびに返すため、保持するのは常に 1 件のみとなる。
+        message が取得済みの場合は messages().get を省略する。
+        predicate が False を返したパートは attachments().get を呼び出さない。
+        on_message はメッセージと select の結果を受け取る（ワーカースレッドで呼ばれる）。
+        fetch_profile を指定すると、クライアントの fetch_profile の代わりに使う。
+        raw で取得したメッセージは、attachments().get を呼び出さずにローカルで切り出す。
+        decode を False にすると、base64url の文字列をデコードせずに返す
+        （呼び出し元が write_base64 でデコードしながら書き込む。raw のパートは bytes）。
+        """
+        message = self.load_message(message_id, message, fetch_profile)
         info = self.select(message)
-        payload = message.get("payload", {})
-        parts = payload.get("parts", [])
-
-        attachments = []
-
-        for part in parts:
-            filename = part.get("filename")
-            mime_type = part.get("mimeType")
-            body = part.get("body", {})
-            attachment_id = body.get("attachmentId")
-
-            if filename and attachment_id:
+        if on_message is not None:
+            on_message(message, info)
+        for filename, mime_type, attachment_id, inline_data in iter_attachment_parts(
+            message, info, predicate, self.stats
+        ):
+            if attachment_id:
                 # 添付ファイルを取得
-                attachment = (
-                    client.users()
-                    .messages()
-                    .attachments()
-                    .get(userId="me", messageId=message_id, id=attachment_id)
-                    .execute()
-                )
-
-                file_data = base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))
-                attachments.append((filename, mime_type, file_data))
-
-                assert_linux_safe_path(filename)
+                data = self.get_attachment(message_id, attachment_id)
+            else:
+                # 小さな添付ファイルは body.data に含まれるため、取得しない
+                data = inline_data
+
+            if isinstance(data, bytes):
+                # raw から切り出したパートはデコード済み
+                file_data = data
+                metrics.inc("downloaded_bytes", len(file_data))
+            elif decode:
+                with metrics.timer("stage_seconds", stage="decode"):
+                    file_data = base64.urlsafe_b64decode(data)
+                metrics.inc("downloaded_bytes", len(file_data))
+            else:
+                # バイト数は書き込み時に数える
+                file_data = data
+            del data
 
-        for i, attachment in enumerate(attachments):
-            filename, mime_type, file_data = attachment
             yield (
                 info["date"],
                 message_id,
@@ -190,119 +702,847 @@ class GmailClient:
                 mime_type,
                 file_data,
             )
+            # 次の添付ファイルを取得する前に解放する
+            del file_data
 
-    def query(self, query=None) -> Iterable[GMailInfo]:
+    def query(self, query=None, page_token=None) -> Iterable[GMailInfo]:
         """クエリを実行し、GMailInfo を返す。"""
+        for _, messages in self.query_pages(query, page_token=page_token):
+            yield from messages
 
-        client = self._service
+    def query_pages(self, query=None, page_token=None):
+        """クエリを実行し、(ページのトークン, GMailInfo のリスト) をページごとに返す。"""
+
+        client = self._get_service()
 
         messages = []
-        next_page_token = None
+        next_page_token = page_token
 
         while True:
-            response = (
+            response = self.scheduler.execute(
                 client.users()
                 .messages()
-                .list(userId="me", q=query, pageToken=next_page_token)
-                .execute()
+                .list(
+                    userId="me",
+                    q=query,
+                    pageToken=next_page_token,
+                    maxResults=self.page_size,
+                    fields=LIST_FIELDS,
+                )
             )
 
             messages = response.get("messages", [])
-            yield from messages
+            yield next_page_token, messages
 
             _prevToken = next_page_token
             next_page_token = response.get("nextPageToken", None)
             logger.debug(
-                f"[UPDATE Page Token] prev: {_prevToken} next: {next_page_token}"
+                "[UPDATE Page Token] prev: %s next: %s", _prevToken, next_page_token
             )
 
             if not next_page_token:
                 break
 
+    def query_pages_many(self, queries, workers: int = 1, page_tokens=None):
+        """複数のクエリを並列に実行し、(クエリ, ページのトークン, GMailInfo のリスト) を返す。
+
+        ページの取得は前のページのトークンに依存するため、クエリ（シャード）単位で並列化する。
+        ページはクエリをまたいで取得した順に返すが、同じクエリ内の順序は保つ。
+        page_tokens はクエリごとに再開するページのトークンを指定する。
+        """
+        page_tokens = page_tokens or {}
+        if workers <= 1 or len(queries) <= 1:
+            for q in queries:
+                for token, messages in self.query_pages(q, page_tokens.get(q)):
+                    yield q, token, messages
+            return
+
+        # 未処理のページ数の上限。メモリ使用量を抑えるため有界にする
+        pages = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            # 呼び出し元が途中で終了した場合に、ワーカーが待ち続けないようにする
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def list_pages(q):
+            try:
+                for token, messages in self.query_pages(q, page_tokens.get(q)):
+                    if not put((q, token, messages)):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        executor = ThreadPoolExecutor(max_workers=min(workers, len(queries)))
+        try:
+            for q in queries:
+                executor.submit(list_pages, q)
+
+            remaining = len(queries)
+            while remaining:
+                item = pages.get()
+                metrics.gauge("queue_depth", pages.qsize(), queue="pages")
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def get_history_id(self) -> str:
+        """メールボックスの現在の historyId を返す"""
+        client = self._get_service()
+        profile = self.scheduler.execute(client.users().getProfile(userId="me"))
+        return profile["historyId"]
+
+    def has_new_messages(self, start_history_id) -> bool:
+        """start_history_id 以降にメッセージが追加されたかを返す。
+
+        historyId が古すぎて履歴を取得できない場合は True を返す。
+        """
+        client = self._get_service()
+        try:
+            response = self.scheduler.execute(
+                client.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    maxResults=1,
+                )
+            )
+        except HttpError as e:
+            if e.resp.status == 404:
+                logger.warning(f"[SYNC   ] history expired: {start_history_id}")
+                return True
+            raise
 
-def pipe_extract_attachments(
-    protocol: str,
-    output_dir,
-    clean: bool = False,
-    query: str = None,
-    excludes={
-        ".ics",
-        ".html",
-        ".htm",
-        ".css",
-        ".js",
-        ".gif",
-        ".png",
-        ".p7s",  # 電子署名付きEメールに対応していない場合に、smime.p7s という添付ファイルが添付される
-    },  # htmlに含まれるデータなども添付ファイルとして認識されてしまうので exclude
-):
-    """単に添付ファイルを取得する"""
-    fs: AbstractFileSystem = filesystem(protocol)
-    if clean:
-        if fs.exists(output_dir):
-            fs.rm(output_dir, recursive=True)
+        return bool(response.get("history"))
 
-    fs.mkdir(output_dir, create_parents=True)
+    def get_messages(self, message_ids, retries: int = 3, fetch_profile=None):
+        """バッチリクエストでメッセージを取得し、message_ids の順序で返す。
 
-    client = GmailClient.authenticate_and_build_service()
+        失敗したサブリクエストのうち、再試行可能なものだけを再送する。
+        """
+        if len(message_ids) > MAX_BATCH_SIZE:
+            raise ValueError(
+                f"Batch size must be <= {MAX_BATCH_SIZE}: {len(message_ids)}"
+            )
+
+        client = self._get_service()
+        results = {}
+        errors = {}
 
-    def flatten_dict(d, parent_key="", sep="."):
-        """ネストされた辞書をフラット化する"""
-        items = []
-        for k, v in d.items():
-            new_key = f"{parent_key}{sep}{k}" if parent_key else k
-            if isinstance(v, dict):
-                items.extend(flatten_dict(v, new_key, sep=sep).items())
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+                errors.pop(request_id, None)
             else:
-                items.append((new_key, v))
-        return dict(items)
+                errors[request_id] = exception
+
+        remaining = list(message_ids)
+        for attempt in range(retries + 1):
+            batch = client.new_batch_http_request(callback=callback)
+            for message_id in remaining:
+                batch.add(
+                    self._get_message_request(client, message_id, fetch_profile),
+                    request_id=message_id,
+                )
+            # サブリクエストごとにクォータが消費される
+            units = len(remaining) * self.scheduler.get_units(
+                "gmail.users.messages.get"
+            )
+            self.scheduler.execute(batch, units=units, method="batch")
 
-    def is_exclude(filename):
-        for exclude in excludes:
-            if exclude in filename:
-                return True
-        return False
+            remaining = [i for i in remaining if i not in results]
+            if not remaining:
+                break
 
-    for mail in client.query(query):
-        i = 0
-        for (
-            date,
-            message_id,
-            sender_name,
-            sender_address,
-            title,
-            filename,
-            mime_type,
-            file_data,
-        ) in client.extract_attachments(mail["id"]):
-            i += 1
-            domain = os.path.join(output_dir, sender_address)
-            fs.mkdirs(domain, exist_ok=True)
-
-            path = os.path.join(
-                output_dir, sender_address, "_".join([date, filename.replace(":", "-")])
-            )
+            for message_id in remaining:
+                e = errors[message_id]
+                if not is_retryable(e):
+                    raise e
+            if attempt >= retries:
+                # 最後の試行の後は待機せずに失敗する
+                raise errors[remaining[0]]
+
+            metrics.inc("retries", len(remaining), method="batch")
+            logger.warning(f"[RETRY  ] batch: {len(remaining)} requests")
+            self.scheduler.backoff(attempt)
+
+        return [results[i] for i in message_ids]
+
+    def iter_messages(self, mails: Iterable[GMailInfo], batch_size: int = 50):
+        """メールを batch_size 件ずつまとめて取得し、(mail, message) を返す
+
+        fetch_profile が異なるメールは、別のバッチリクエストで取得する。
+        """
+        for chunk in chunked(mails, batch_size):
+            groups = {}
+            for mail in chunk:
+                groups.setdefault(mail.get("fetch_profile"), []).append(mail["id"])
+
+            messages = {}
+            for fetch_profile, ids in groups.items():
+                messages.update(
+                    zip(ids, self.get_messages(ids, fetch_profile=fetch_profile))
+                )
+            for mail in chunk:
+                yield mail, messages[mail["id"]]
+
+    def extract_attachments_many(
+        self,
+        mails: Iterable[GMailInfo],
+        workers: int = 1,
+        batch_size: int = 0,
+        predicate=None,
+        on_message=None,
+        on_complete=None,
+        threads: bool = False,
+        decode: bool = True,
+    ):
+        """複数メールの添付ファイルを並列に取得する。
+
+        ワーカー数に応じて先読みしつつ、出力順は mails の順序を保つ。
+        batch_size を指定すると、メッセージ本体はバッチリクエストでまとめて取得する。
+        on_complete はメッセージの添付ファイルをすべて返し終えた後に呼び出される。
+        メールに fetch_profile がある場合は、そのメールのみ指定の形式で取得する。
+        threads を指定すると、同じスレッドのメールを threads().get でまとめて取得する
+        （出力順はスレッドごとにまとまる。group_threads 参照）。
+        decode は extract_attachments に渡す。
+        """
+        if on_complete is None:
+
+            def on_complete(message_id):
+                pass
+
+        if threads and batch_size > 0:
+            raise ValueError("threads and batch_size cannot be used together")
+
+        if threads:
+            units = ((group, None) for group in self.group_threads(mails))
+        elif batch_size > 0:
+            units = (([mail], m) for mail, m in self.iter_messages(mails, batch_size))
+        else:
+            units = (([mail], None) for mail in mails)
+
+        def iter_unit(group, message):
+            """(メール ID, 添付ファイルのイテレータ) をメールごとに返す"""
+            if threads:
+                pairs = self.get_thread_messages(group)
+            else:
+                pairs = [(group[0], message)]
+            for mail, message in pairs:
+                yield (
+                    mail["id"],
+                    self.extract_attachments(
+                        mail["id"],
+                        message=message,
+                        predicate=predicate,
+                        on_message=on_message,
+                        fetch_profile=mail.get("fetch_profile"),
+                        decode=decode,
+                    ),
+                )
 
-            if is_exclude(filename):
-                logger.info("[SKIP   ]" + path)
-                continue
+        if workers <= 1:
+            for group, message in units:
+                for message_id, rows in iter_unit(group, message):
+                    yield from rows
+                    on_complete(message_id)
+            return
+
+        def fetch(group, message):
+            return [
+                (message_id, list(rows))
+                for message_id, rows in iter_unit(group, message)
+            ]
+
+        # 先読みする単位（メールかスレッド）の上限。メモリ使用量を抑えるため有界にする
+        max_pending = workers * 2
+        pending = deque()
+
+        def pop():
+            for message_id, rows in pending.popleft().result():
+                yield from rows
+                on_complete(message_id)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for group, message in units:
+                pending.append(executor.submit(fetch, group, message))
+                metrics.gauge("queue_depth", len(pending), queue="messages")
+                if len(pending) >= max_pending:
+                    yield from pop()
+
+            while pending:
+                yield from pop()
+
+    @staticmethod
+    def group_threads(mails: Iterable[GMailInfo], max_messages: int = MAX_PAGE_SIZE):
+        """連続するメールを threadId ごとにまとめ、メールのリストを返す
+
+        ジャーナルが一覧のページ単位で再開できるよう、page が変わるところで区切る
+        （page が無いメールは max_messages 件ごとに区切る）。
+        スレッドは最初のメールの位置に並べるため、出力順は mails の順序と異なりうる。
+        fetch_profile を指定したメールは threads().get で取得できないため、まとめない。
+        """
+        groups = {}
+        count = 0
+        page = None
+
+        for mail in mails:
+            if groups and (count >= max_messages or mail.get("page") != page):
+                yield from groups.values()
+                groups = {}
+                count = 0
+            page = mail.get("page")
+            count += 1
+
+            if mail.get("fetch_profile"):
+                groups[("message", mail["id"])] = [mail]
             else:
-                logger.info("[EXTRACT]" + path)
+                groups.setdefault(("thread", mail["threadId"]), []).append(mail)
+
+        yield from groups.values()
+
+    def get_thread_messages(self, mails):
+        """同じスレッドのメールを threads().get で 1 回で取得し、(mail, message) を返す
+
+        メールが 1 件のみの場合は、クォータの少ない messages().get で取得する。
+        """
+        if len(mails) == 1:
+            return [(mails[0], None)]
+
+        client = self._get_service()
+        params = dict(FETCH_PROFILES[self.fetch_profile])
+        if "fields" in params:
+            params["fields"] = f"id,messages({params['fields']})"
+        thread = self.scheduler.execute(
+            client.users().threads().get(userId="me", id=mails[0]["threadId"], **params)
+        )
+
+        messages = {m["id"]: m for m in thread.get("messages", [])}
+        # 一覧の取得後にスレッドから外れたメッセージは、messages().get で取得する
+        return [(mail, messages.get(mail["id"])) for mail in mails]
+
+
+def split_raw_queries(queries, raw_max_size: int):
+    """クエリをサイズで分け、(すべてのクエリ, raw で取得するクエリの集合) を返す"""
+    split = []
+    raw_queries = set()
+    for q in queries:
+        small = f"{q or ''} smaller:{raw_max_size}".strip()
+        split += [small, f"{q or ''} larger:{raw_max_size - 1}".strip()]
+        raw_queries.add(small)
+    return split, raw_queries
+
+
+def build_queries(
+    query: str = None,
+    shards: str = "",
+    fetch_profile: str = "attachments",
+    raw_max_size: int = RAW_MAX_SIZE,
+):
+    """一覧に使うクエリを (クエリのリスト, raw で取得するクエリの集合) で返す"""
+    queries = shard_query(query, shards) if shards else [query]
+    if shards:
+        logger.info(f"[SHARD  ] {len(queries)} queries")
+    if fetch_profile == "raw":
+        return split_raw_queries(queries, raw_max_size)
+    return queries, set()
+
+
+def client_fetch_profile(fetch_profile: str) -> str:
+    """クライアントの fetch_profile（raw はクエリごとに指定し、それ以外は attachments で取得する）"""
+    return "attachments" if fetch_profile == "raw" else fetch_profile
+
+
+def build_client(
+    fetch_profile: str = "attachments",
+    discovery: str = "static",
+    quota_per_second: float = USER_QUOTA_PER_SECOND,
+    concurrency: int = 1,
+) -> GmailClient:
+    """パイプラインのクライアントを認証して生成する
+
+    スロットリングが発生した場合は、同時実行数を concurrency から減らす。
+    """
+    return GmailClient.authenticate_and_build_service(
+        scheduler=RequestScheduler(
+            quota_per_second=quota_per_second, concurrency=max(concurrency, 1)
+        ),
+        fetch_profile=client_fetch_profile(fetch_profile),
+        discovery=discovery,
+    )
+
+
+def build_predicate(
+    excludes=DEFAULT_EXCLUDES,
+    exclude_mime_types: str = "",
+    max_size: int = 0,
+    index: OutputIndex = None,
+    output_dir=None,
+):
+    """オプションから添付ファイルの predicate を生成する
+
+    index を指定すると、出力先に既に存在するファイルも除外する（skip_existing_files 参照）。
+    """
+    predicate = AttachmentFilter(
+        excludes=excludes,
+        exclude_mime_types=[x for x in (exclude_mime_types or "").split(",") if x],
+        max_size=max_size,
+    )
+    if index is not None:
+        predicate = skip_existing_files(predicate, index, output_dir)
+    return predicate
+
+
+def open_journal(fs: AbstractFileSystem, output_dir, query, resume: bool = False):
+    """出力先とクエリごとのジャーナルを開く
+
+    (ジャーナル, {クエリ: 再開するページのトークン}, 完了済みのメッセージ ID) を返す。
+    """
+    key = hashlib.sha1(f"{fs.unstrip_protocol(output_dir)}\n{query}".encode())
+    journal = Journal(os.path.join(JOURNAL_DIR, f"{key.hexdigest()}.jsonl"))
+    page_tokens, completed = journal.load() if resume else ({}, set())
+    if resume:
+        logger.info(f"[RESUME ] completed: {len(completed)} pages: {page_tokens}")
+    journal.open(resume=resume)
+    return journal, page_tokens, completed
+
+
+def clean_output(
+    fs: AbstractFileSystem, output_dir, state: SyncState, catalog: Catalog
+):
+    """出力先と、その状態・カタログの記録を削除する"""
+    if fs.exists(output_dir):
+        fs.rm(output_dir, recursive=True)
+    state.reset()
+    catalog.reset(output_dir)
+
+
+def load_output_index(
+    fs: AbstractFileSystem, output_dir, skip_existing: bool = True
+) -> OutputIndex:
+    """出力先を一度だけ一覧し、添付ファイルごとの存在確認と mkdirs を省略する"""
+    index = OutputIndex(fs)
+    if skip_existing:
+        index.load(fs.find(output_dir, withdirs=True, detail=True))
+    index.makedirs(output_dir)
+    return index
+
+
+def is_unchanged(client: GmailClient, state: SyncState, query=None) -> bool:
+    """前回の抽出から、メールボックスにメッセージが追加されていないかを返す
+
+    SyncState の接続を使うため、呼び出し元（状態を開いた）スレッドで呼び出す。
+    """
+    last_history_id = state.get_history_id(query)
+    if last_history_id and not client.has_new_messages(last_history_id):
+        logger.info(f"[SYNC   ] no changes since history: {last_history_id}")
+        return True
+    return False
+
+
+class MailFilter:
+    """一覧のメールから抽出するものを選び、一覧のページを付ける
+
+    シャードの境界で重複して返るメールや、再開時に完了済みのメールは一度だけ返す。
+    incremental を指定すると、抽出済みのメールをスキップする。
+    page（ページのトークン, クエリ）はジャーナルへの記録と、スレッドをページ内で
+    まとめるのに使う。raw_queries のクエリのメールには fetch_profile=raw を付ける。
+    is_extracted はメモリ上の集合のみを参照するため、別のスレッドから呼び出せる。
+    """
+
+    def __init__(
+        self,
+        state: SyncState,
+        incremental: bool = False,
+        completed=(),
+        raw_queries=(),
+    ):
+        self.state = state
+        self.incremental = incremental
+        self.seen = set(completed)
+        self.raw_queries = set(raw_queries)
+
+    def __call__(self, mail: GMailInfo, query=None, page_token=None):
+        """抽出するメールに page を付けて返す（スキップする場合は None）"""
+        if mail["id"] in self.seen:
+            return None
+        self.seen.add(mail["id"])
+        if self.incremental and self.state.is_extracted(mail["id"]):
+            return None
+
+        mail = {**mail, "page": (page_token, query)}
+        if query in self.raw_queries:
+            mail["fetch_profile"] = "raw"
+        return mail
+
+    def iter_pages(self, pages):
+        """query_pages_many の (クエリ, ページのトークン, メールのリスト) から選ぶ"""
+        for q, token, messages in pages:
+            for mail in messages:
+                mail = self(mail, q, token)
+                if mail is not None:
+                    yield mail
+
+
+class ExtractSession:
+    """抽出のパイプラインに共通する準備と記録（状態・カタログ・ジャーナル・出力先の一覧）
+
+    with で開き、start でクライアントを渡してから mails で抽出するメールを取得する。
+    添付ファイルを保存するたびに add_attachment を、メッセージが完了したら complete と
+    checkpoint（一覧の順序で）を、すべて完了したら finish を呼び出す。
+    中断した場合は、未完了のメッセージを記録せずに閉じる。
+    """
+
+    def __init__(
+        self,
+        protocol: str,
+        output_dir,
+        query: str = None,
+        clean: bool = False,
+        incremental: bool = False,
+        resume: bool = False,
+        shards: str = "",
+        skip_existing: bool = True,
+        fetch_profile: str = "attachments",
+        raw_max_size: int = RAW_MAX_SIZE,
+    ):
+        self.fs: AbstractFileSystem = filesystem(protocol)
+        self.output_dir = output_dir
+        self.query = query
+        # 再開時は抽出済みのファイルを削除しない
+        self.clean = clean and not resume
+        self.incremental = incremental
+        self.resume = resume
+        self.shards = shards
+        self.skip_existing = skip_existing
+        self.fetch_profile = fetch_profile
+        self.raw_max_size = raw_max_size
+        self.client = None
+        self.history_id = None
+        # 完了時にジャーナルへ記録するため、メッセージごとのページを保持する
+        self._pages = {}
+
+    def __enter__(self):
+        self.state = SyncState(STATE_FILE, self.fs.unstrip_protocol(self.output_dir))
+        self.catalog = Catalog(CATALOG_FILE)
+        self.journal, self.page_tokens, self.completed = open_journal(
+            self.fs, self.output_dir, self.query, self.resume
+        )
+        try:
+            if self.clean:
+                clean_output(self.fs, self.output_dir, self.state, self.catalog)
+            self.index = load_output_index(
+                self.fs, self.output_dir, self.skip_existing and not self.clean
+            )
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.state.close()
+        self.catalog.close()
+        self.journal.close()
+
+    def start(self, client: GmailClient) -> GmailClient:
+        """クライアントを設定し、現在の historyId を記録する"""
+        self.client = client
+        # 抽出中に追加されたメールを取りこぼさないよう、一覧を取得する前に記録する
+        self.history_id = client.get_history_id()
+        return client
+
+    def predicate(
+        self,
+        excludes=DEFAULT_EXCLUDES,
+        exclude_mime_types: str = "",
+        max_size: int = 0,
+        existing=None,
+    ):
+        """添付ファイルの predicate を返す
+
+        skip_existing の場合は、existing（省略すると出力先の一覧）に存在するものも除外する。
+        """
+        if not self.skip_existing:
+            existing = None
+        elif existing is None:
+            existing = self.index
+        return build_predicate(
+            excludes, exclude_mime_types, max_size, existing, self.output_dir
+        )
+
+    def mails(self, workers: int = 1):
+        """抽出するメールを一覧の順序で返す（一覧は workers のシャードを並列に取得する）
+
+        incremental の場合、前回から変更が無ければ一覧を取得しない。
+        SyncState を使う確認は呼び出し元のスレッドで行うため、返したイテレータは
+        別のスレッドで消費できる。
+        """
+        if self.incremental and is_unchanged(self.client, self.state, self.query):
+            return iter(())
+
+        queries, raw_queries = build_queries(
+            self.query, self.shards, self.fetch_profile, self.raw_max_size
+        )
+        mail_filter = MailFilter(
+            self.state, self.incremental, self.completed, raw_queries
+        )
+        pages = self.client.query_pages_many(
+            queries, workers=workers, page_tokens=self.page_tokens
+        )
+        return self._iter_mails(mail_filter.iter_pages(pages))
+
+    def _iter_mails(self, mails):
+        for mail in mails:
+            self._pages[mail["id"]] = mail["page"]
+            yield mail
+
+    def add_attachment(self, message_id, filename, mime_type, size, path, digest=None):
+        """保存した添付ファイルを記録する（書き込みは complete でまとめて行う）"""
+        self.state.add_attachment(message_id, filename, path)
+        self.catalog.add_attachment(
+            self.output_dir, message_id, filename, mime_type, size, path, digest
+        )
+
+    def complete(self, message_id):
+        """メッセージの添付ファイルをすべて保存した後に、状態とカタログに書き込む"""
+        self.catalog.commit(message_id)
+        self.state.mark_extracted(message_id)
+
+    def checkpoint(self, message_id):
+        """完了したメッセージをジャーナルに記録する（再開できるよう一覧の順序で呼び出す）"""
+        self.journal.append(message_id, *self._pages.pop(message_id, (None, None)))
+
+    def finish(self):
+        """すべてのメッセージが完了した後に、historyId を記録してジャーナルを削除する"""
+        self.state.set_history_id(self.history_id, self.query)
+        self.journal.remove()
+        self.client.stats.log_summary()
+
+
+def pipe_extract_attachments(
+    protocol: str,
+    output_dir,
+    clean: bool = False,
+    query: str = None,
+    workers: int = 1,
+    batch_size: int = 0,
+    exclude_mime_types: str = "",
+    max_size: int = 0,
+    incremental: bool = False,
+    dedup: str = "",
+    fetch_profile: str = "attachments",
+    resume: bool = False,
+    shards: str = "",
+    skip_existing: bool = True,
+    postprocess: str = "",
+    postprocess_workers: int = 0,
+    discovery: str = "static",
+    raw_max_size: int = RAW_MAX_SIZE,
+    threads: bool = False,
+    quota_per_second: float = USER_QUOTA_PER_SECOND,
+    client: GmailClient = None,
+    excludes=DEFAULT_EXCLUDES,
+):
+    """単に添付ファイルを取得する
+
+    incremental を指定すると、抽出済みのメッセージを messages().get せずにスキップする。
+    dedup を指定すると、同じ内容の添付ファイルは一度だけ保存する（BlobStore 参照）。
+    resume を指定すると、中断した前回の抽出を最後のチェックポイントから再開する。
+    shards を指定すると、query の after: / before: の期間を分割し、一覧を並列に取得する。
+    skip_existing を指定すると、出力先に既に存在するファイルはダウンロードしない。
+    postprocess に PostProcessor に登録した変換をカンマ区切りで指定すると、
+    保存した添付ファイルに別プロセスで適用し、その出力も保存する。
+    discovery にはディスカバリドキュメントの取得元（static / cache）を指定する。
+    fetch_profile が raw の場合、raw_max_size 未満のメッセージは format=raw で 1 回で取得し、
+    それ以上のメッセージは attachments で取得する（query に smaller: / larger: を加えて分ける）。
+    threads を指定すると、一覧のページ内で同じスレッドのメールを threads().get で 1 回で取得する。
+    quota_per_second は、このメールボックスに使うクォータ（units/秒）を指定する。
+    client を省略すると、認証してクライアントを生成する。
+    """
+    # 認証や出力先の準備の前に、誤ったオプションを検出する
+    if batch_size > MAX_BATCH_SIZE:
+        raise ValueError(f"Batch size must be <= {MAX_BATCH_SIZE}: {batch_size}")
+    if threads and batch_size > 0:
+        raise ValueError("threads and batch_size cannot be used together")
+
+    post = None
+    with ExtractSession(
+        protocol,
+        output_dir,
+        query=query,
+        clean=clean,
+        incremental=incremental,
+        resume=resume,
+        shards=shards,
+        skip_existing=skip_existing,
+        fetch_profile=fetch_profile,
+        raw_max_size=raw_max_size,
+    ) as session:
+        try:
+            fs, index = session.fs, session.index
+            if client is None:
+                client = build_client(
+                    fetch_profile, discovery, quota_per_second, workers
+                )
+            session.start(client)
+            mails = session.mails(workers)
+
+            def flatten_dict(d, parent_key="", sep="."):
+                """ネストされた辞書をフラット化する"""
+                items = []
+                for k, v in d.items():
+                    new_key = f"{parent_key}{sep}{k}" if parent_key else k
+                    if isinstance(v, dict):
+                        items.extend(flatten_dict(v, new_key, sep=sep).items())
+                    else:
+                        items.append((new_key, v))
+                return dict(items)
+
+            writer = BulkWriter(fs)
+            store = BlobStore(fs, output_dir, writer, mode=dedup) if dedup else None
+            # manifest はメールごとのパスにファイルを作成しないため、マニフェストで判定する
+            predicate = session.predicate(
+                excludes,
+                exclude_mime_types,
+                max_size,
+                store if store is not None and not store.links else None,
+            )
+
+            if postprocess:
+                post = PostProcessor(
+                    [x for x in postprocess.split(",") if x],
+                    workers=postprocess_workers,
+                )
 
-            with open(path, "wb") as f:
-                # print(i, date, message_id, sender_name, sender_address, filename, mime_type)
-                f.write(file_data)
+            def write_outputs(outputs):
+                """後処理の出力を保存する（出力先の外には書き込まない）"""
+                for out_path, out_data in outputs:
+                    if not out_path.startswith(os.path.join(output_dir, "")):
+                        logger.warning(f"[POST   ] outside of output_dir: {out_path}")
+                        continue
+                    index.makedirs(os.path.dirname(out_path))
+                    logger.info("[POST   ]%s", out_path)
+                    writer.write(out_path, out_data)
+
+            def on_complete(message_id):
+                # バッファ中のファイルが書き込まれるまで完了として記録しない
+                writer.defer(session.complete, message_id)
+                writer.defer(session.checkpoint, message_id)
+
+            with writer:
+                for (
+                    date,
+                    message_id,
+                    sender_name,
+                    sender_address,
+                    title,
+                    filename,
+                    mime_type,
+                    file_data,
+                ) in client.extract_attachments_many(
+                    mails,
+                    workers=workers,
+                    batch_size=batch_size,
+                    predicate=predicate,
+                    on_message=session.catalog.add_mail,
+                    on_complete=on_complete,
+                    threads=threads,
+                    # 重複の排除と後処理はデコードした全体を使う
+                    decode=store is not None or post is not None,
+                ):
+                    if store is None or store.links:
+                        index.makedirs(os.path.join(output_dir, sender_address))
+
+                    path = get_attachment_path(
+                        output_dir, sender_address, date, filename
+                    )
+
+                    logger.info("[EXTRACT]%s", path)
+
+                    if isinstance(file_data, str):
+                        size, digest = writer.write_base64(path, file_data)
+                        metrics.inc("downloaded_bytes", size)
+                    elif store is None:
+                        size = len(file_data)
+                        digest = hashlib.sha256(file_data).hexdigest()
+                        writer.write(path, file_data)
+                    else:
+                        size = len(file_data)
+                        digest = store.put(path, file_data)
+                    if post is not None:
+                        # 変換は別プロセスで行い、取得と並行させる
+                        write_outputs(
+                            post.submit(
+                                path,
+                                file_data,
+                                message_id=message_id,
+                                mime_type=mime_type,
+                            )
+                        )
+                    # 次の添付ファイルを取得する前に解放する
+                    del file_data
+
+                    session.add_attachment(
+                        message_id, filename, mime_type, size, path, digest
+                    )
+
+                if post is not None:
+                    write_outputs(post.drain())
+
+            if store is not None:
+                store.close()
+                logger.info(f"[SUMMARY] deduplicated bytes: {store.saved_bytes}")
+
+            session.finish()
+        finally:
+            # 中断した場合も後処理のプロセスを終了する（未完了のメッセージは記録しない）
+            if post is not None:
+                post.close()
 
 
 def pipe_rm_empty_dir(
     protocol: str, output_dir, clean: bool = False, query: str = None
 ):
+    """空のディレクトリを削除する
+
+    一覧は fs.find で一度だけ取得し、子の数をメモリ上で数えながら深い順に削除する。
+    API の呼び出しは一覧 1 回と、削除するディレクトリの数だけとなる。
+    """
     fs: AbstractFileSystem = filesystem(protocol)
 
-    all_files = fs.glob(os.path.join(output_dir, "**"))
-    for file in sorted(all_files, key=len, reverse=True):
-        if not fs.isdir(file):
+    entries = fs.find(output_dir, withdirs=True, detail=True)
+    children = {}
+    directories = []
+    for path, info in entries.items():
+        if info["type"] == "directory":
+            directories.append(path)
+            children.setdefault(path, 0)
+        parent = fs._parent(path)
+        children[parent] = children.get(parent, 0) + 1
+
+    for path in sorted(directories, key=lambda p: p.count("/"), reverse=True):
+        if children[path]:
             continue
 
-        if not fs.ls(file):
-            fs.rmdir(file)
+        fs.rmdir(path)
+        children[fs._parent(path)] -= 1
@@ -0,0 +1,531 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+from collections import deque
+from typing import AsyncIterable
+
+from googleapiclient.errors import HttpError
+from fsspec import filesystem, AbstractFileSystem
+
+from . import _google
+from ._google import (
+    DEFAULT_EXCLUDES,
+    FETCH_PROFILES,
+    LIST_FIELDS,
+    MAX_PAGE_SIZE,
+    MAX_PART_DEPTH,
+    RAW_MAX_SIZE,
+    CredentialResoruce,
+    ExtractStats,
+    GMailInfo,
+    GmailClient,
+    MailFilter,
+    OauthFlow,
+    build_predicate,
+    build_queries,
+    clean_output,
+    client_fetch_profile,
+    find_truncated_part,
+    get_attachment_path,
+    iter_attachment_parts,
+    needs_refresh,
+)
+from ._catalog import Catalog
+from ._metrics import metrics
+from ._raw import parse_raw_message
+from ._ratelimit import USER_QUOTA_PER_SECOND, AsyncRequestScheduler
+from ._state import SyncState
+from ._writer import OutputIndex, write_base64, write_bytes
+
+logger = logging.getLogger(__name__)
+# リクエストごとの INFO ログを出力しない
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+GMAIL_ROOT_URL = "https://gmail.googleapis.com/"
+
+# HTTP/2 では 1 接続で複数のストリームを多重化する（Google の上限は 100）
+STREAMS_PER_CONNECTION = 100
+
+
+def build_http_client(concurrency: int = 100):
+    """接続を再利用する HTTP/2 クライアントを生成する（pip install "httpx[http2]"）
+
+    接続数が多いほど httpcore の接続プールの管理コストが増えるため、
+    同時実行数をストリームで多重化できるだけの接続数に抑える。
+    """
+    # 任意の依存のため、使う時点で読み込む
+    import httpx
+
+    connections = max(1, math.ceil(concurrency / STREAMS_PER_CONNECTION))
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=connections, max_keepalive_connections=connections
+        ),
+        timeout=httpx.Timeout(60.0),
+    )
+
+
+class AsyncGmailClient:
+    """GmailClient の asyncio 版。REST API を直接呼び出す
+
+    スレッドを使わずに多数のリクエストを同時に待機できる。
+    """
+
+    @classmethod
+    def authenticate_and_build_client(
+        cls, scheduler=None, fetch_profile="attachments", concurrency=100
+    ):
+        loc = CredentialResoruce()
+        flow = OauthFlow(loc)
+        creds = flow.exec()
+
+        return cls(
+            build_http_client(concurrency),
+            credentials=creds,
+            scheduler=scheduler,
+            fetch_profile=fetch_profile,
+        )
+
+    def __init__(
+        self,
+        http,
+        credentials=None,
+        root_url=GMAIL_ROOT_URL,
+        scheduler=None,
+        fetch_profile="attachments",
+        page_size=MAX_PAGE_SIZE,
+    ):
+        if fetch_profile not in FETCH_PROFILES:
+            raise ValueError(f"Unknown fetch profile: {fetch_profile}")
+
+        self._http = http
+        self._credentials = credentials
+        self._refresh_lock = None
+        self.base_url = f"{root_url}gmail/v1/users/me"
+        self.fetch_profile = fetch_profile
+        self.page_size = page_size
+        self.stats = ExtractStats()
+        self.scheduler = scheduler or AsyncRequestScheduler()
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def _get_headers(self) -> dict:
+        headers = {}
+        if self._credentials is None:
+            return headers
+
+        if needs_refresh(self._credentials):
+            if self._refresh_lock is None:
+                self._refresh_lock = asyncio.Lock()
+            async with self._refresh_lock:
+                if needs_refresh(self._credentials):
+                    # google-auth の更新は同期 API のため、スレッドで実行する
+                    await asyncio.to_thread(self._refresh_credentials)
+
+        self._credentials.apply(headers)
+        return headers
+
+    def _refresh_credentials(self):
+        from google.auth.transport.requests import Request
+
+        with CredentialResoruce.lock():
+            self._credentials.refresh(Request())
+            CredentialResoruce.save_token(json.loads(self._credentials.to_json()))
+
+    async def _get(self, path, method, **params) -> dict:
+        url = f"{self.base_url}{path}"
+        params = {k: v for k, v in params.items() if v is not None}
+
+        async def send():
+            response = await self._http.get(
+                url, params=params, headers=await self._get_headers()
+            )
+            if response.status_code >= 400:
+                # 同期版と同じ判定（再試行や 404 の扱い）を使えるよう HttpError に変換する
+                import httplib2
+
+                resp = httplib2.Response(
+                    {"status": response.status_code, **response.headers}
+                )
+                raise HttpError(resp, response.content, uri=url)
+            return response.json()
+
+        return await self.scheduler.execute(send, method=method)
+
+    @classmethod
+    def select(cls, message):
+        return GmailClient.select(message)
+
+    async def get_message(self, message_id, fetch_profile=None) -> dict:
+        return await self._get(
+            f"/messages/{message_id}",
+            "gmail.users.messages.get",
+            **FETCH_PROFILES[fetch_profile or self.fetch_profile],
+        )
+
+    async def load_message(self, message_id, message=None, fetch_profile=None):
+        """GmailClient.load_message の asyncio 版"""
+        if message is None:
+            message = await self.get_message(message_id, fetch_profile)
+        if "raw" in message:
+            with metrics.timer("stage_seconds", stage="parse"):
+                return parse_raw_message(message)
+
+        if "fields" in FETCH_PROFILES[fetch_profile or self.fetch_profile]:
+            part = find_truncated_part(message.get("payload", {}))
+            if part is not None:
+                logger.warning(
+                    "[DEPTH  ]%s %s has parts beyond %d levels, refetch with format=full",
+                    message_id,
+                    part.get("mimeType"),
+                    MAX_PART_DEPTH + 1,
+                )
+                metrics.inc("refetched_messages")
+                message = await self.get_message(message_id, "full")
+        return message
+
+    async def extract_attachments(
+        self,
+        message_id,
+        message=None,
+        predicate=None,
+        on_message=None,
+        fetch_profile=None,
+        decode: bool = True,
+    ):
+        """メールの添付ファイルを取得（GmailClient.extract_attachments と同じ形式で返す）"""
+        message = await self.load_message(message_id, message, fetch_profile)
+        info = self.select(message)
+        if on_message is not None:
+            on_message(message, info)
+
+        for filename, mime_type, attachment_id, inline_data in iter_attachment_parts(
+            message, info, predicate, self.stats
+        ):
+            if attachment_id:
+                attachment = await self._get(
+                    f"/messages/{message_id}/attachments/{attachment_id}",
+                    "gmail.users.messages.attachments.get",
+                )
+                data = attachment.pop("data")
+                del attachment
+            else:
+                data = inline_data
+
+            if isinstance(data, bytes):
+                file_data = data
+                metrics.inc("downloaded_bytes", len(file_data))
+            elif decode:
+                with metrics.timer("stage_seconds", stage="decode"):
+                    file_data = base64.urlsafe_b64decode(data)
+                metrics.inc("downloaded_bytes", len(file_data))
+            else:
+                file_data = data
+            del data
+
+            yield (
+                info["date"],
+                message_id,
+                info["sender_name"],
+                info["sender_address"],
+                info["title"],
+                filename,
+                mime_type,
+                file_data,
+            )
+            del file_data
+
+    async def query(self, query=None, page_token=None):
+        """クエリを実行し、GMailInfo を返す。"""
+        async for _, messages in self.query_pages(query, page_token=page_token):
+            for message in messages:
+                yield message
+
+    async def query_pages(self, query=None, page_token=None):
+        """クエリを実行し、(ページのトークン, GMailInfo のリスト) をページごとに返す。"""
+        next_page_token = page_token
+
+        while True:
+            response = await self._get(
+                "/messages",
+                "gmail.users.messages.list",
+                q=query,
+                pageToken=next_page_token,
+                maxResults=self.page_size,
+                fields=LIST_FIELDS,
+            )
+            yield next_page_token, response.get("messages", [])
+
+            next_page_token = response.get("nextPageToken", None)
+            if not next_page_token:
+                break
+
+    async def get_history_id(self) -> str:
+        profile = await self._get("/profile", "gmail.users.getProfile")
+        return profile["historyId"]
+
+    async def has_new_messages(self, start_history_id) -> bool:
+        try:
+            response = await self._get(
+                "/history",
+                "gmail.users.history.list",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                maxResults=1,
+            )
+        except HttpError as e:
+            if e.resp.status == 404:
+                logger.warning(f"[SYNC   ] history expired: {start_history_id}")
+                return True
+            raise
+
+        return bool(response.get("history"))
+
+    async def extract_attachments_many(
+        self,
+        mails: AsyncIterable[GMailInfo],
+        concurrency: int = 100,
+        predicate=None,
+        on_message=None,
+        on_complete=None,
+        decode: bool = True,
+    ):
+        """複数メールの添付ファイルを並行に取得する。
+
+        concurrency 件のメールを先読みしつつ、出力順は mails の順序を保つ。
+        on_complete はメッセージの添付ファイルをすべて返し終えた後に呼び出される。
+        decode は extract_attachments に渡す。
+        """
+
+        async def fetch(mail):
+            return [
+                row
+                async for row in self.extract_attachments(
+                    mail["id"],
+                    predicate=predicate,
+                    on_message=on_message,
+                    fetch_profile=mail.get("fetch_profile"),
+                    decode=decode,
+                )
+            ]
+
+        pending = deque()
+
+        async def pop():
+            done_id, task = pending.popleft()
+            rows = await task
+            return done_id, rows
+
+        try:
+            async for mail in mails:
+                pending.append((mail["id"], asyncio.create_task(fetch(mail))))
+                metrics.gauge("queue_depth", len(pending), queue="messages")
+                if len(pending) >= concurrency:
+                    done_id, rows = await pop()
+                    for row in rows:
+                        yield row
+                    if on_complete is not None:
+                        on_complete(done_id)
+
+            while pending:
+                done_id, rows = await pop()
+                for row in rows:
+                    yield row
+                if on_complete is not None:
+                    on_complete(done_id)
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+
+async def extract_attachments_async(
+    protocol: str,
+    output_dir,
+    clean: bool = False,
+    query: str = None,
+    concurrency: int = 100,
+    exclude_mime_types: str = "",
+    max_size: int = 0,
+    incremental: bool = False,
+    fetch_profile: str = "attachments",
+    skip_existing: bool = True,
+    raw_max_size: int = RAW_MAX_SIZE,
+    quota_per_second: float = USER_QUOTA_PER_SECOND,
+    client: AsyncGmailClient = None,
+    excludes=DEFAULT_EXCLUDES,
+):
+    """pipe_extract_attachments の asyncio 版
+
+    s3 や gcs などの非同期ファイルシステムには、イベントループ上で書き込む。
+    dedup / resume / shards / threads には対応しない。
+    """
+    fs: AbstractFileSystem = filesystem(protocol)
+    afs = None
+    if fs.async_impl:
+        afs = filesystem(protocol, asynchronous=True)
+        if hasattr(afs, "set_session"):
+            await afs.set_session()
+
+    index = OutputIndex(fs)
+
+    async def makedirs(path):
+        if index.has_dir(path):
+            return
+        if afs is None:
+            fs.makedirs(path, exist_ok=True)
+        else:
+            await afs._makedirs(path, exist_ok=True)
+        index.add_dir(path)
+
+    async def write(path, data):
+        if afs is None:
+            # イベントループを止めないよう、スレッドで書き込む
+            await asyncio.to_thread(write_bytes, fs, path, data)
+        else:
+            await afs._pipe_file(path, data)
+
+    state = SyncState(_google.STATE_FILE, fs.unstrip_protocol(output_dir))
+    catalog = Catalog(_google.CATALOG_FILE)
+    owns_client = client is None
+    try:
+        if clean:
+            clean_output(fs, output_dir, state, catalog)
+        elif skip_existing:
+            if afs is None:
+                index.load(fs.find(output_dir, withdirs=True, detail=True))
+            else:
+                index.load(await afs._find(output_dir, withdirs=True, detail=True))
+
+        await makedirs(output_dir)
+
+        if client is None:
+            client = AsyncGmailClient.authenticate_and_build_client(
+                scheduler=AsyncRequestScheduler(
+                    quota_per_second=quota_per_second, concurrency=concurrency
+                ),
+                fetch_profile=client_fetch_profile(fetch_profile),
+                concurrency=concurrency,
+            )
+
+        history_id = await client.get_history_id()
+
+        async def iter_mails():
+            if incremental:
+                last_history_id = state.get_history_id(query)
+                if last_history_id and not await client.has_new_messages(
+                    last_history_id
+                ):
+                    logger.info(
+                        f"[SYNC   ] no changes since history: {last_history_id}"
+                    )
+                    return
+
+            queries, raw_queries = build_queries(
+                query, fetch_profile=fetch_profile, raw_max_size=raw_max_size
+            )
+            mail_filter = MailFilter(state, incremental, raw_queries=raw_queries)
+            for q in queries:
+                async for mail in client.query(q):
+                    mail = mail_filter(mail, q)
+                    if mail is not None:
+                        yield mail
+
+        predicate = build_predicate(
+            excludes,
+            exclude_mime_types,
+            max_size,
+            index if skip_existing else None,
+            output_dir,
+        )
+
+        def on_complete(message_id):
+            catalog.commit(message_id)
+            state.mark_extracted(message_id)
+
+        async for (
+            date,
+            message_id,
+            sender_name,
+            sender_address,
+            title,
+            filename,
+            mime_type,
+            file_data,
+        ) in client.extract_attachments_many(
+            iter_mails(),
+            concurrency=concurrency,
+            predicate=predicate,
+            on_message=catalog.add_mail,
+            on_complete=on_complete,
+            # 非同期ファイルシステムにはデコードした全体を書き込む
+            decode=afs is not None,
+        ):
+            await makedirs(os.path.join(output_dir, sender_address))
+            path = get_attachment_path(output_dir, sender_address, date, filename)
+
+            logger.info("[EXTRACT]%s", path)
+
+            if isinstance(file_data, str):
+                # デコードしながらスレッドで書き込み、デコードした全体を保持しない
+                size, digest = await asyncio.to_thread(
+                    write_base64, fs, path, file_data
+                )
+                metrics.inc("downloaded_bytes", size)
+            else:
+                size = len(file_data)
+                digest = hashlib.sha256(file_data).hexdigest()
+                with metrics.timer("stage_seconds", stage="write"):
+                    await write(path, file_data)
+            del file_data
+
+            state.add_attachment(message_id, filename, path)
+            catalog.add_attachment(
+                output_dir, message_id, filename, mime_type, size, path, digest
+            )
+
+        state.set_history_id(history_id, query)
+        client.stats.log_summary()
+    finally:
+        if owns_client and client is not None:
+            await client.aclose()
+        state.close()
+        catalog.close()
+
+
+def pipe_extract_attachments_async(
+    protocol: str,
+    output_dir,
+    clean: bool = False,
+    query: str = None,
+    concurrency: int = 100,
+    exclude_mime_types: str = "",
+    max_size: int = 0,
+    incremental: bool = False,
+    fetch_profile: str = "attachments",
+    skip_existing: bool = True,
+    raw_max_size: int = RAW_MAX_SIZE,
+    quota_per_second: float = USER_QUOTA_PER_SECOND,
+):
+    """extract_attachments_async をイベントループで実行する（パイプラインとして指定する）"""
+    asyncio.run(
+        extract_attachments_async(
+            protocol,
+            output_dir,
+            clean=clean,
+            query=query,
+            concurrency=concurrency,
+            exclude_mime_types=exclude_mime_types,
+            max_size=max_size,
+            incremental=incremental,
+            fetch_profile=fetch_profile,
+            skip_existing=skip_existing,
+            raw_max_size=raw_max_size,
+            quota_per_second=quota_per_second,
+        )
+    )
@@ -0,0 +1,247 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# レイテンシのヒストグラムの上限（秒）。Prometheus と同じく上限以下を累積で数える
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# API のメソッドと処理の段階の対応（バッチリクエストはメッセージの取得に含める）
+STAGES = {
+    "gmail.users.messages.list": "list",
+    "gmail.users.messages.get": "get",
+    "gmail.users.threads.get": "get",
+    "gmail.users.messages.attachments.get": "attachment",
+    "batch": "get",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """バケットの上限で近似した分位数（最後のバケットは最大値）"""
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return 0.0
+
+
+class Metrics:
+    """実行中の計測値（カウンタ・ゲージ・ヒストグラム）を集計する（スレッド間で共有する）
+
+    カウンタは inc、キューの深さなどのゲージは gauge（最大値も記録する）、
+    レイテンシは timer か observe で記録する。名前が同じでもラベルが違えば別に集計する。
+    scope の中で記録した値には、scope のラベル（パイプライン名など）が付く。
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._scope = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+
+    @contextmanager
+    def scope(self, **labels):
+        """ワーカーを起動する前に入ること（スレッドごとには切り替えない）"""
+        previous = self._scope
+        self._scope = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._scope = previous
+
+    def _key(self, name: str, labels: dict):
+        labels = {**self._scope, **labels}
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            _, peak = self._gauges.get(key, (0, value))
+            self._gauges[key] = (value, max(peak, value))
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self, **labels) -> dict:
+        """JSON に変換できる形式で返す（ラベルは name{k=v} の形式でキーに含める）
+
+        labels を指定すると、そのラベルを持つ値のみを返す（キーからは省く）。
+        """
+        selected = set(labels.items())
+
+        def select(items):
+            for (name, key_labels), value in sorted(items.items()):
+                if not selected <= set(key_labels):
+                    continue
+                rest = [(k, v) for k, v in key_labels if (k, v) not in selected]
+                if rest:
+                    name += "{" + ",".join(f"{k}={v}" for k, v in rest) + "}"
+                yield name, value
+
+        with self._lock:
+            return {
+                "counters": dict(select(self._counters)),
+                "gauges": {
+                    k: {"last": last, "max": peak}
+                    for k, (last, peak) in select(self._gauges)
+                },
+                "histograms": {
+                    k: {
+                        "count": h.count,
+                        "sum": round(h.sum, 6),
+                        "p50": h.quantile(0.5),
+                        "p90": h.quantile(0.9),
+                        "p99": h.quantile(0.99),
+                        "max": round(h.max, 6),
+                    }
+                    for k, h in select(self._histograms)
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "gmail_extract") -> str:
+        """Prometheus のテキスト形式で返す"""
+
+        def format_labels(labels, **extra):
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            for kind, items in (("counter", self._counters), ("gauge", self._gauges)):
+                declared = set()
+                for (name, labels), value in sorted(items.items()):
+                    metric = f"{prefix}_{name}"
+                    if kind == "counter":
+                        metric += "_total"
+                    if metric not in declared:
+                        lines.append(f"# TYPE {metric} {kind}")
+                        declared.add(metric)
+                    if kind == "gauge":
+                        value = value[0]
+                    lines.append(f"{metric}{format_labels(labels)} {value}")
+
+            declared = set()
+            for (name, labels), h in sorted(self._histograms.items()):
+                metric = f"{prefix}_{name}"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} histogram")
+                    declared.add(metric)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{metric}_bucket{format_labels(labels, le=bound)} {cumulative}"
+                    )
+                lines.append(f"{metric}_sum{format_labels(labels)} {h.sum}")
+                lines.append(f"{metric}_count{format_labels(labels)} {h.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str, prefix: str = "gmail_extract"):
+        """node_exporter の textfile collector が読みかけを読まないよう、置き換えで書き込む"""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(tmp, path)
+
+
+class ThreadProfiler:
+    """cProfile を呼び出し元と、計測中に開始したスレッドのそれぞれで有効にする
+
+    cProfile は有効にしたスレッドのみを計測するため、ワーカースレッドで行う取得や
+    デコード・書き込みを含めるよう、threading.setprofile でスレッドごとに開始し、
+    dump_stats で 1 つの結果にまとめる。
+    Python 3.12 以降の cProfile（sys.monitoring）はすべてのスレッドを計測するため、
+    呼び出し元でのみ有効にする。別のプロセス（後処理）は計測しない。
+    """
+
+    def __init__(self):
+        import cProfile
+
+        self._factory = cProfile.Profile
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._main = None
+
+    def _start(self):
+        profile = self._factory()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def _start_thread(self, frame, event, arg):
+        # スレッドの最初のイベントで呼ばれるため、以降は cProfile に置き換える
+        sys.setprofile(None)
+        self._start()
+
+    def __enter__(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._start_thread)
+        self._main = self._start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._main.disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+
+    def dump_stats(self, path: str):
+        import pstats
+
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+# プロセス内で共有する
+metrics = Metrics()
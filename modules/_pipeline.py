@@ -0,0 +1,162 @@
+import inspect
+import queue
+import threading
+from typing import Callable, Iterable
+
+from ._metrics import metrics
+
+# 段階の間のキューの既定の上限（ワーカー数に対する倍率）
+QUEUE_FACTOR = 2
+# 停止を確認する間隔（秒）
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class Stage:
+    """パイプラインの段階
+
+    func(item) は出力のイテラブルを返す（空で除外、複数で展開）。
+    workers のスレッドで並行に実行するため、出力の順序は入力の順序と異なりうる。
+    max_queue は入力のキューの上限（省略するとワーカー数の QUEUE_FACTOR 倍）で、
+    キューが一杯になると前の段階は待機する（バックプレッシャー）。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[object], Iterable],
+        workers: int = 1,
+        max_queue: int = 0,
+    ):
+        if workers < 1:
+            raise ValueError(f"Stage {name} requires at least 1 worker: {workers}")
+
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.max_queue = max_queue or workers * QUEUE_FACTOR
+
+
+class StagePipeline:
+    """段階を有界のキューでつなぎ、source の要素をストリームとして流す
+
+    各段階は並行に動き、最後の段階の出力は呼び出し元のスレッドで返す
+    （SQLite への記録など、スレッドをまたげない処理は呼び出し元で行う）。
+    いずれかの段階で例外が発生した場合は、すべての段階を止めて呼び出し元で送出する。
+    """
+
+    def __init__(self, source: Iterable, stages: Iterable[Stage], max_output: int = 0):
+        self.source = source
+        self.stages = list(stages)
+        self.max_output = max_output or self.stages[-1].workers * QUEUE_FACTOR
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        # 呼び出し元が途中で終了した場合に、待ち続けないようにする
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, e: Exception):
+        self._errors.append(e)
+        self._stop.set()
+
+    def _feed(self, output: queue.Queue):
+        try:
+            for item in self.source:
+                if not self._put(output, item):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(output, _DONE)
+
+    def _work(self, stage: Stage, inbox, output, remaining: list, lock):
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    # 同じ段階の他のワーカーにも終了を伝える
+                    self._put(inbox, _DONE)
+                    return
+
+                metrics.gauge("queue_depth", inbox.qsize(), queue=stage.name)
+                for result in stage.func(item):
+                    if not self._put(output, result):
+                        return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            # 最後のワーカーが次の段階に終了を伝える
+            if last:
+                self._put(output, _DONE)
+
+    def __iter__(self):
+        queues = [queue.Queue(maxsize=stage.max_queue) for stage in self.stages]
+        queues.append(queue.Queue(maxsize=self.max_output))
+
+        threads = [threading.Thread(target=self._feed, args=(queues[0],), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            threads += [
+                threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], queues[i + 1], remaining, lock),
+                    name=f"{stage.name}-{n}",
+                    daemon=True,
+                )
+                for n in range(stage.workers)
+            ]
+
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+
+def get_pipeline(funcname: str):
+    """--pipelines に指定された名前の関数を返す"""
+    from . import _google, _google_async, _stream
+
+    for module in (_google, _google_async, _stream):
+        func = getattr(module, funcname, None)
+        if func is not None:
+            return func
+    raise AttributeError(f"Unknown pipeline: {funcname}")
+
+
+def select_kwargs(func, kwargs: dict) -> dict:
+    """関数が受け取る引数のみを抽出する"""
+    params = inspect.signature(func).parameters
+    if any(p.kind == p.VAR_KEYWORD for p in params.values()):
+        return kwargs
+    return {k: v for k, v in kwargs.items() if k in params}
@@ -0,0 +1,162 @@
+import gzip
+import io
+import logging
+import multiprocessing
+import os
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, Iterable
+
+from ._metrics import metrics
+from ._path import assert_linux_safe_path
+
+logger = logging.getLogger(__name__)
+
+# 展開後のサイズの上限（圧縮爆弾の対策）
+MAX_DECOMPRESSED_BYTES = 1024 * 1024 * 1024
+
+
+def run_transform(func, shm_name: str, size: int, path: str, metadata: dict):
+    """ワーカープロセスで共有メモリ上の内容に変換を適用する"""
+    # 共有メモリの解放（unlink）は親プロセスが行う
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        view = shm.buf[:size]
+        try:
+            return func(view, path, **metadata)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+class PostProcessor:
+    """添付ファイルの後処理（CPU バウンドの変換）をプロセスプールで実行する
+
+    変換は func(data: memoryview, path, **metadata) として register し、
+    {出力先のパス: bytes} を返す（出力しない場合は None）。
+    内容は共有メモリで渡すため、ワーカーへの受け渡しで pickle による複製を作らない。
+    変換はワーカーで import できるよう、モジュールのトップレベルで定義すること。
+    """
+
+    functions: Dict[str, object] = {}
+
+    @classmethod
+    def register(cls, func):
+        if func.__name__ in cls.functions:
+            raise ValueError(f"Already registered: {func.__name__}")
+
+        cls.functions[func.__name__] = func
+        return func
+
+    def __init__(self, names: Iterable[str], workers: int = 0, max_pending: int = 0):
+        unknowns = [name for name in names if name not in self.functions]
+        if unknowns:
+            raise ValueError(f"Unknown postprocess: {','.join(unknowns)}")
+
+        workers = workers or os.cpu_count()
+        self.transforms = [self.functions[name] for name in names]
+        # 未完了の添付ファイル数の上限。共有メモリの使用量を抑えるため有界にする
+        self.max_pending = max_pending or workers * 2
+        # スレッドを使うプロセスを fork しないよう spawn で起動する
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._pending = deque()
+
+    def submit(self, path, data: bytes, **metadata) -> list:
+        """変換を投入し、完了した変換の出力を [(パス, bytes)] で返す"""
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        shm.buf[: len(data)] = data
+        futures = [
+            self._executor.submit(
+                run_transform, func, shm.name, len(data), path, metadata
+            )
+            for func in self.transforms
+        ]
+        self._pending.append((path, shm, futures))
+        metrics.gauge("queue_depth", len(self._pending), queue="postprocess")
+
+        outputs = []
+        while len(self._pending) > self.max_pending:
+            outputs.extend(self._pop())
+        return outputs
+
+    def drain(self):
+        """未完了の変換をすべて待機し、出力を (パス, bytes) で返す"""
+        while self._pending:
+            yield from self._pop()
+
+    def _pop(self) -> list:
+        path, shm, futures = self._pending.popleft()
+        outputs = {}
+        try:
+            for future in futures:
+                try:
+                    outputs.update(future.result() or {})
+                except Exception as e:
+                    # 1 件の失敗で抽出全体を止めない
+                    logger.warning(f"[POST   ] failed: {path} {e!r}")
+        finally:
+            shm.close()
+            shm.unlink()
+        return list(outputs.items())
+
+    def close(self):
+        for _, shm, futures in self._pending:
+            for future in futures:
+                future.cancel()
+        self._executor.shutdown(wait=True)
+        while self._pending:
+            _, shm, _ = self._pending.popleft()
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+@PostProcessor.register
+def gunzip(data: memoryview, path: str, **metadata):
+    """.gz を展開し、拡張子を除いたパスに出力する"""
+    if not path.endswith(".gz"):
+        return None
+
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    content = decompressor.decompress(data, MAX_DECOMPRESSED_BYTES + 1)
+    if len(content) > MAX_DECOMPRESSED_BYTES:
+        raise ValueError(f"Too large to decompress: {path}")
+    if not decompressor.eof:
+        raise gzip.BadGzipFile(f"Truncated: {path}")
+
+    return {path[: -len(".gz")]: content}
+
+
+@PostProcessor.register
+def unzip(data: memoryview, path: str, **metadata):
+    """.zip を {path}.d/ 以下に展開する"""
+    if not path.endswith(".zip"):
+        return None
+
+    outputs = {}
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+
+            assert_linux_safe_path(info.filename)
+            total += info.file_size
+            if total > MAX_DECOMPRESSED_BYTES:
+                raise ValueError(f"Too large to decompress: {path}")
+
+            name = info.filename.lstrip("/")
+            outputs[os.path.join(f"{path}.d", name)] = archive.read(info)
+
+    return outputs
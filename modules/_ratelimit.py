@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from ._metrics import STAGES, metrics
+
+logger = logging.getLogger(__name__)
+
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.history.list": 2,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.attachments.get": 5,
+    "gmail.users.threads.get": 10,
+}
+DEFAULT_UNITS = 5
+
+# ユーザーごとの上限は 15,000 units/分（= 250 units/秒）
+USER_QUOTA_PER_SECOND = 250
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_retryable(e: Exception) -> bool:
+    if not isinstance(e, HttpError):
+        return False
+
+    if e.resp.status in RETRYABLE_STATUS:
+        return True
+
+    # クォータ超過は 403 で返ることがある
+    return e.resp.status == 403 and b"ateLimitExceeded" in (e.content or b"")
+
+
+def is_throttled(e: Exception) -> bool:
+    return isinstance(e, HttpError) and e.resp.status in {403, 429}
+
+
+def record_call(method: str, start: float, error: Exception = None):
+    """API 呼び出しの回数と、処理の段階ごとのレイテンシを記録する"""
+    method = method or "unknown"
+    metrics.inc("api_calls", method=method)
+    if error is not None:
+        status = error.resp.status if isinstance(error, HttpError) else "exception"
+        metrics.inc("api_errors", method=method, status=status)
+    stage = STAGES.get(method)
+    if stage is not None:
+        metrics.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+def get_retry_after(e: HttpError):
+    value = e.resp.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """クォータ単位を一定の速度で補充するトークンバケット"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, units: float = 1) -> float:
+        """units を差し引き、残高が 0 に戻るまでに待機すべき秒数を返す（待機はしない）
+
+        容量を超える要求（バッチリクエストなど）も全額を差し引き、残高を負にする。
+        後の要求は負の残高を返し終えるまで待機するため、平均の速度は rate を超えない。
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= units
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, units: float = 1):
+        if wait := self.reserve(units):
+            time.sleep(wait)
+
+    async def acquire_async(self, units: float = 1):
+        if wait := self.reserve(units):
+            await asyncio.sleep(wait)
+
+
+class AdaptiveLimit:
+    """同時実行数の上限。スロットリングで半減し、成功が続くと 1 ずつ戻す
+
+    with（スレッド）と async with（イベントループ）のどちらでも使えるが、
+    同じインスタンスをスレッドとイベントループで共有しない。
+    """
+
+    def __init__(self, limit: int, increase_after: int = 20):
+        self.max_limit = limit
+        self.limit = limit
+        self.increase_after = increase_after
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+        # イベントループ内で生成する
+        self._async_cond = None
+
+    def __enter__(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    async def __aenter__(self):
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        async with self._async_cond:
+            await self._async_cond.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._async_cond:
+            self._active -= 1
+            self._async_cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify()
+
+    def on_throttled(self):
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+        metrics.inc("throttles")
+        logger.warning(f"[THROTTLE] concurrency: {self.limit}")
+
+
+class SchedulerBase:
+    """クォータ・同時実行数・再試行の設定（RequestScheduler と AsyncRequestScheduler で共有する）"""
+
+    def __init__(
+        self,
+        quota_per_second: float = USER_QUOTA_PER_SECOND,
+        concurrency: int = 16,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 64.0,
+    ):
+        self.bucket = TokenBucket(quota_per_second)
+        self.limit = AdaptiveLimit(concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def get_units(method) -> int:
+        return QUOTA_UNITS.get(method, DEFAULT_UNITS)
+
+    def get_delay(self, attempt: int, retry_after: float = None) -> float:
+        """指数バックオフ（フルジッター）の待機時間。Retry-After があれば優先する"""
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class RequestScheduler(SchedulerBase):
+    """すべての API 呼び出しにクォータ制御と再試行を適用する（スレッド間で共有する）"""
+
+    def backoff(self, attempt: int, retry_after: float = None):
+        time.sleep(self.get_delay(attempt, retry_after))
+
+    def acquire(self, units):
+        start = time.perf_counter()
+        self.bucket.acquire(units)
+        metrics.inc("quota_wait_seconds", time.perf_counter() - start)
+
+    def execute(self, request, units: int = None, method: str = None):
+        """request.execute() を呼び出す。再試行可能なエラーは待機して再送する
+
+        method は計測に使う（省略すると request.methodId）。
+        """
+        method = method or getattr(request, "methodId", None)
+        if units is None:
+            units = self.get_units(method)
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire(units)
+            try:
+                with self.limit:
+                    start = time.perf_counter()
+                    response = request.execute()
+            except Exception as e:
+                record_call(method, start, e)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+                if is_throttled(e):
+                    self.limit.on_throttled()
+
+                metrics.inc("retries", method=method)
+                logger.warning(f"[RETRY  ] {e.resp.status} attempt: {attempt + 1}")
+                self.backoff(attempt, get_retry_after(e))
+            else:
+                record_call(method, start)
+                self.limit.on_success()
+                return response
+
+
+class AsyncRequestScheduler(SchedulerBase):
+    """RequestScheduler の asyncio 版（同じイベントループ内で共有する）
+
+    スレッドを使わないため、同時実行数の上限（AdaptiveLimit）は async with で待機する。
+    """
+
+    def __init__(self, *args, concurrency: int = 100, **kwargs):
+        super().__init__(*args, concurrency=concurrency, **kwargs)
+
+    async def acquire(self, units):
+        start = time.perf_counter()
+        await self.bucket.acquire_async(units)
+        metrics.inc("quota_wait_seconds", time.perf_counter() - start)
+
+    async def execute(self, send, units: int = None, method: str = None):
+        """send() のコルーチンを待機する。再試行可能なエラーは待機して再送する
+
+        send はリクエストを送信するコルーチン関数で、method は計測とクォータに使う。
+        """
+        if units is None:
+            units = self.get_units(method)
+
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(units)
+            try:
+                async with self.limit:
+                    start = time.perf_counter()
+                    response = await send()
+            except Exception as e:
+                record_call(method, start, e)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+                if is_throttled(e):
+                    self.limit.on_throttled()
+
+                metrics.inc("retries", method=method)
+                logger.warning(f"[RETRY  ] {e.resp.status} attempt: {attempt + 1}")
+                await asyncio.sleep(self.get_delay(attempt, get_retry_after(e)))
+            else:
+                record_call(method, start)
+                self.limit.on_success()
+                return response
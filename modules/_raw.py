@@ -0,0 +1,66 @@
+import base64
+from email import policy
+from email.parser import BytesFeedParser
+
+# base64 を 4 文字単位で区切ってデコードし、パーサーに少しずつ渡す
+RAW_CHUNK_SIZE = 1024 * 1024
+
+# select が参照するヘッダー
+RAW_HEADERS = ("Subject", "Date", "From")
+
+
+def feed_raw(raw: str, chunk_size: int = RAW_CHUNK_SIZE):
+    """base64url の raw を少しずつデコードしてパーサーに渡し、解析したメッセージを返す
+
+    デコード済みの全体と base64 の全体を同時に保持しないよう、チャンク単位で渡す。
+    """
+    chunk_size -= chunk_size % 4
+    parser = BytesFeedParser(policy=policy.default)
+    for i in range(0, len(raw), chunk_size):
+        chunk = raw[i : i + chunk_size]
+        parser.feed(base64.urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4)))
+    return parser.close()
+
+
+def get_part_content(part) -> bytes:
+    if part.get_content_type() == "message/rfc822":
+        # 添付された .eml は、中身のメッセージ全体を出力する
+        return part.get_payload(0).as_bytes()
+    return part.get_payload(decode=True) or b""
+
+
+def parse_raw_message(message: dict) -> dict:
+    """format=raw で取得したメッセージを、format=full と同じ構造の辞書に変換する
+
+    添付ファイルのパートは body.data にデコード済みの bytes を持つ（attachmentId は持たない）。
+    パートは入れ子にせず、文書順に payload.parts に並べる。
+    """
+    parsed = feed_raw(message.pop("raw"))
+
+    parts = []
+    for part in parsed.walk():
+        filename = part.get_filename()
+        if not filename:
+            continue
+
+        content = get_part_content(part)
+        parts.append(
+            {
+                "mimeType": part.get_content_type(),
+                "filename": filename,
+                "body": {"size": len(content), "data": content},
+            }
+        )
+
+    return {
+        **message,
+        "payload": {
+            "mimeType": parsed.get_content_type(),
+            "headers": [
+                {"name": name, "value": str(parsed[name])}
+                for name in RAW_HEADERS
+                if parsed[name] is not None
+            ],
+            "parts": parts,
+        },
+    }
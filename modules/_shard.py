@@ -0,0 +1,87 @@
+import math
+import re
+from datetime import date, datetime, timedelta, timezone
+
+# newer: / older: は after: / before: の別名
+RANGE_PATTERN = re.compile(r"(?<!\S)(after|newer|before|older):(\S+)")
+SHARD_UNITS = {"day", "week", "month"}
+
+
+def parse_bound(value: str):
+    """YYYY/MM/DD（YYYY-MM-DD）は date、UNIX 時刻は datetime として解析する"""
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), tz=timezone.utc)
+    return datetime.strptime(value.replace("-", "/"), "%Y/%m/%d").date()
+
+
+def format_bound(value) -> str:
+    if isinstance(value, datetime):
+        return str(int(value.timestamp()))
+    return value.strftime("%Y/%m/%d")
+
+
+def next_month(value):
+    first = value.replace(day=1)
+    if isinstance(value, datetime):
+        first = first.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (first + timedelta(days=32)).replace(day=1)
+
+
+def split_range(start, end, shards: str):
+    """[start, end) を shards（day / week / month か分割数）ごとの期間に分割する"""
+    if shards == "day":
+        step = timedelta(days=1)
+    elif shards == "week":
+        step = timedelta(weeks=1)
+    elif shards == "month":
+        step = None
+    else:
+        count = int(shards)
+        if count < 1:
+            raise ValueError(f"Invalid shards: {shards}")
+        if isinstance(start, datetime):
+            step = timedelta(seconds=math.ceil((end - start).total_seconds() / count))
+        else:
+            step = timedelta(days=math.ceil((end - start).days / count))
+
+    ranges = []
+    current = start
+    while current < end:
+        upper = next_month(current) if step is None else current + step
+        upper = min(upper, end)
+        ranges.append((current, upper))
+        current = upper
+    return ranges
+
+
+def shard_query(query: str, shards: str) -> list:
+    """query の after: / before: の期間を分割し、期間ごとのクエリを返す。
+
+    after: は含み before: は含まないため、日付で指定した場合は期間が重ならない。
+    境界のメッセージが重複して返る場合に備え、呼び出し側で ID の重複を除外すること。
+    before: を省略した場合は現在までを分割する。
+    """
+    bounds = {}
+    for key, value in RANGE_PATTERN.findall(query or ""):
+        key = {"newer": "after", "older": "before"}.get(key, key)
+        bounds[key] = parse_bound(value)
+
+    if "after" not in bounds:
+        raise ValueError(f"Sharding requires after: in query: {query}")
+
+    start = bounds["after"]
+    if "before" in bounds:
+        end = bounds["before"]
+    elif isinstance(start, datetime):
+        end = datetime.now(timezone.utc)
+    else:
+        end = date.today() + timedelta(days=1)
+
+    if isinstance(start, datetime) != isinstance(end, datetime):
+        raise ValueError(f"after: and before: must have the same format: {query}")
+
+    rest = " ".join(RANGE_PATTERN.sub("", query).split())
+    return [
+        f"{rest} after:{format_bound(lower)} before:{format_bound(upper)}".strip()
+        for lower, upper in split_range(start, end, shards)
+    ]
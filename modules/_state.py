@@ -0,0 +1,171 @@
+import json
+import os
+import sqlite3
+
+# 並列に実行した別の抽出がコミットするまで待機する秒数
+SQLITE_TIMEOUT = 60.0
+
+
+class SyncState:
+    """抽出済みのメッセージと添付ファイルを記録する（出力先ごとに管理する）
+
+    historyId は出力先とクエリごとに記録する（同じ出力先でもクエリを変えた場合は、
+    差分が無くても一覧を取得し直す）。
+    添付ファイルはメッセージの完了までメモリに保持し、mark_extracted で 1 回の
+    トランザクションで書き込む（並列に実行した別の抽出を書き込みロックで待たせない）。
+    """
+
+    def __init__(self, path: str, output_dir: str, timeout: float = SQLITE_TIMEOUT):
+        self.path = path
+        self.output_dir = output_dir
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self._extracted = self._load_extracted()
+        # 完了していないメッセージの添付ファイル（メッセージ ID ごと）
+        self._attachments = {}
+
+    def _create_tables(self):
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS extracted_messages (
+                    output_dir TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    PRIMARY KEY (output_dir, message_id)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS extracted_attachments (
+                    output_dir TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (output_dir, message_id, filename)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sync_history (
+                    output_dir TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    history_id TEXT,
+                    PRIMARY KEY (output_dir, query)
+                )
+                """
+            )
+
+    def _load_extracted(self) -> set:
+        rows = self._conn.execute(
+            "SELECT message_id FROM extracted_messages WHERE output_dir = ?",
+            (self.output_dir,),
+        )
+        return {row[0] for row in rows}
+
+    def is_extracted(self, message_id) -> bool:
+        return message_id in self._extracted
+
+    def mark_extracted(self, message_id):
+        """メッセージとその添付ファイルを 1 回のトランザクションで記録する"""
+        attachments = self._attachments.pop(message_id, [])
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO extracted_attachments VALUES (?, ?, ?, ?)",
+                attachments,
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO extracted_messages VALUES (?, ?)",
+                (self.output_dir, message_id),
+            )
+        self._extracted.add(message_id)
+
+    def add_attachment(self, message_id, filename, path):
+        # 書き込みは mark_extracted でまとめて行う
+        self._attachments.setdefault(message_id, []).append(
+            (self.output_dir, message_id, filename, path)
+        )
+
+    def get_history_id(self, query=None):
+        row = self._conn.execute(
+            "SELECT history_id FROM sync_history WHERE output_dir = ? AND query = ?",
+            (self.output_dir, query or ""),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_history_id(self, history_id, query=None):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_history VALUES (?, ?, ?)",
+                (self.output_dir, query or "", history_id),
+            )
+
+    def reset(self):
+        """出力先の記録をすべて削除する"""
+        with self._conn:
+            for table in (
+                "extracted_messages",
+                "extracted_attachments",
+                "sync_history",
+            ):
+                self._conn.execute(
+                    f"DELETE FROM {table} WHERE output_dir = ?", (self.output_dir,)
+                )
+        self._extracted.clear()
+        self._attachments.clear()
+
+    def close(self):
+        self._conn.close()
+
+
+class Journal:
+    """完了したメッセージと、その一覧ページのトークンを追記する（中断した抽出の再開用）
+
+    メッセージはクエリごとに一覧の順序で完了するため、クエリごとに最後に完了した
+    メッセージのページから一覧を再取得し、完了済みのメッセージを除けば続きから再開できる。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def load(self):
+        """({クエリ: 再開するページのトークン}, 完了済みのメッセージ ID) を返す"""
+        page_tokens = {}
+        completed = set()
+        if not os.path.exists(self.path):
+            return page_tokens, completed
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断した最終行は無視する
+                    break
+                completed.add(row["message_id"])
+                page_tokens[row.get("query")] = row["page_token"]
+        return page_tokens, completed
+
+    def open(self, resume: bool = False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a" if resume else "w")
+
+    def append(self, message_id, page_token, query=None):
+        row = {"message_id": message_id, "page_token": page_token, "query": query}
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """すべて完了した場合に削除する"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+from fsspec import AbstractFileSystem
+
+from ._writer import BulkWriter
+
+DEDUP_MODES = {"hardlink", "symlink", "manifest"}
+
+
+class BlobStore:
+    """添付ファイルの内容をハッシュで管理し、同じ内容は一度だけ保存する。
+
+    内容は {root}/.blobs/{digest[:2]}/{digest} に保存し、メールごとのパスには
+    ハードリンク・シンボリックリンク・マニフェストの行のいずれかを作成する。
+    """
+
+    def __init__(
+        self, fs: AbstractFileSystem, root: str, writer: BulkWriter, mode: str
+    ):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode: {mode}")
+
+        if mode != "manifest" and "file" not in fs.protocol:
+            raise ValueError(f"{mode} is only supported on local filesystem")
+
+        self.fs = fs
+        self.root = root
+        self.writer = writer
+        self.mode = mode
+        self.blob_dir = os.path.join(root, ".blobs")
+        self.manifest_path = os.path.join(root, "manifest.jsonl")
+        self.saved_bytes = 0
+
+        # 既存のブロブを一度だけ列挙し、以降は存在確認をしない
+        if fs.exists(self.blob_dir):
+            self._digests = {os.path.basename(p) for p in fs.find(self.blob_dir)}
+        else:
+            self._digests = set()
+
+        self._manifest = self._load_manifest() if mode == "manifest" else {}
+
+    def _load_manifest(self) -> dict:
+        if not self.fs.exists(self.manifest_path):
+            return {}
+
+        manifest = {}
+        with self.fs.open(self.manifest_path, "r") as f:
+            for line in f:
+                row = json.loads(line)
+                manifest[row["path"]] = row
+        return manifest
+
+    @property
+    def links(self) -> bool:
+        """メールごとのパスにリンクを作成するか（manifest はマニフェストにのみ記録する）"""
+        return self.mode != "manifest"
+
+    def exists(self, path) -> bool:
+        """path がマニフェストに記録済みかを返す（manifest の skip_existing に使う）"""
+        return path in self._manifest
+
+    def get_blob_path(self, digest: str):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def put(self, path, data: bytes) -> str:
+        """内容を保存し、path から参照できるようにする。ハッシュ値を返す。"""
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.get_blob_path(digest)
+
+        if digest in self._digests:
+            self.saved_bytes += len(data)
+        else:
+            self.fs.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            self.writer.write(blob_path, data)
+            self._digests.add(digest)
+
+        if self.mode == "manifest":
+            self._manifest[path] = {"path": path, "digest": digest, "size": len(data)}
+            return digest
+
+        if self.fs.exists(path):
+            self.fs.rm(path)
+
+        if self.mode == "hardlink":
+            self.fs.link(blob_path, path)
+        else:
+            self.fs.symlink(os.path.relpath(blob_path, os.path.dirname(path)), path)
+
+        return digest
+
+    def close(self):
+        if self.mode != "manifest":
+            return
+
+        with self.fs.open(self.manifest_path, "w") as f:
+            for row in self._manifest.values():
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
@@ -0,0 +1,248 @@
+import hashlib
+import logging
+import os
+import threading
+
+from fsspec import AbstractFileSystem
+
+from ._google import (
+    DEFAULT_EXCLUDES,
+    RAW_MAX_SIZE,
+    ExtractSession,
+    GmailClient,
+    accept_part,
+    build_client,
+    find_attachment_parts,
+    get_attachment_path,
+)
+from ._metrics import metrics
+from ._pipeline import Stage, StagePipeline
+from ._ratelimit import USER_QUOTA_PER_SECOND
+from ._writer import OutputIndex, iter_base64_chunks, write_chunks
+
+logger = logging.getLogger(__name__)
+
+# I/O の段階はワーカー数、CPU の段階（GIL を解放しない）は 1 を既定とする
+IO_STAGES = {"fetch", "download", "write"}
+STAGES = ("fetch", "filter", "download", "decode", "write")
+
+
+def parse_stage_workers(value: str, workers: int) -> dict:
+    """ "fetch=8,write=4" のような段階ごとのワーカー数を解析する"""
+    result = {name: workers if name in IO_STAGES else 1 for name in STAGES}
+    for item in (value or "").split(","):
+        if not item:
+            continue
+        name, _, count = item.partition("=")
+        if name not in result:
+            raise ValueError(f"Unknown stage: {name}")
+        result[name] = int(count)
+    return result
+
+
+class StreamExtractor:
+    """添付ファイルの抽出の各段階（StagePipeline の Stage として使う）
+
+    レコードはメッセージの添付ファイルのパートごとの辞書で、すべての段階を通って
+    呼び出し元に届く。除外したパートや添付ファイルの無いメッセージは part を None にして
+    流し、呼び出し元がメッセージの完了をパートの数（parts）で判定できるようにする。
+    """
+
+    def __init__(
+        self,
+        client: GmailClient,
+        fs: AbstractFileSystem,
+        index: OutputIndex,
+        output_dir,
+        predicate=None,
+    ):
+        self.client = client
+        self.fs = fs
+        self.index = index
+        self.output_dir = output_dir
+        self.predicate = predicate
+        # OutputIndex はスレッドセーフではないため、ディレクトリの作成を排他する
+        self._dirs_lock = threading.Lock()
+
+    def fetch(self, mail: dict):
+        message = self.client.load_message(
+            mail["id"], fetch_profile=mail.get("fetch_profile")
+        )
+        info = self.client.select(message)
+        parts = list(find_attachment_parts(message)) or [None]
+        del message
+
+        for part in parts:
+            yield {"mail": mail, "info": info, "parts": len(parts), "part": part}
+
+    def filter(self, record: dict):
+        part = record["part"]
+        if part is not None and not accept_part(
+            part, record["info"], self.predicate, self.client.stats
+        ):
+            record["part"] = None
+        yield record
+
+    def download(self, record: dict):
+        part = record["part"]
+        if part is not None:
+            body = part["body"]
+            if body.get("attachmentId"):
+                record["data"] = self.client.get_attachment(
+                    record["mail"]["id"], body["attachmentId"]
+                )
+            else:
+                # 小さな添付ファイルや raw から切り出したパートは body.data に含まれる
+                record["data"] = body.pop("data")
+        yield record
+
+    def decode(self, record: dict):
+        if record["part"] is not None:
+            data = record.pop("data")
+            if isinstance(data, bytes):
+                chunks = [data]
+            else:
+                # 文字列全体の一時的なコピーを作らないよう、チャンク単位でデコードする
+                with metrics.timer("stage_seconds", stage="decode"):
+                    chunks = list(iter_base64_chunks(data))
+            del data
+            record["chunks"] = chunks
+            metrics.inc("downloaded_bytes", sum(len(c) for c in chunks))
+        yield record
+
+    def write(self, record: dict):
+        part = record["part"]
+        if part is None:
+            yield record
+            return
+
+        info = record["info"]
+        path = get_attachment_path(
+            self.output_dir, info["sender_address"], info["date"], part["filename"]
+        )
+        # 書き込むファイルがあるディレクトリのみを作成するため、空のディレクトリを残さない
+        with self._dirs_lock:
+            self.index.makedirs(os.path.dirname(path))
+
+        chunks = record.pop("chunks")
+        logger.info("[EXTRACT]%s", path)
+        with metrics.timer("stage_seconds", stage="write"):
+            write_chunks(self.fs, path, chunks)
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk)
+        record.update(
+            path=path, size=sum(len(c) for c in chunks), digest=digest.hexdigest()
+        )
+        del chunks
+        yield record
+
+    def stages(self, workers: dict, max_queue: int = 0):
+        return [
+            Stage(name, getattr(self, name), workers[name], max_queue)
+            for name in STAGES
+        ]
+
+
+def pipe_extract_attachments_stream(
+    protocol: str,
+    output_dir,
+    clean: bool = False,
+    query: str = None,
+    workers: int = 1,
+    stage_workers: str = "",
+    stage_queue: int = 0,
+    exclude_mime_types: str = "",
+    max_size: int = 0,
+    incremental: bool = False,
+    fetch_profile: str = "attachments",
+    resume: bool = False,
+    shards: str = "",
+    skip_existing: bool = True,
+    discovery: str = "static",
+    raw_max_size: int = RAW_MAX_SIZE,
+    quota_per_second: float = USER_QUOTA_PER_SECOND,
+    client: GmailClient = None,
+    excludes=DEFAULT_EXCLUDES,
+):
+    """pipe_extract_attachments を段階のストリームとして実行する
+
+    list → fetch → filter → download → decode → write の各段階を有界のキューでつなぎ、
+    段階ごとのワーカー数（stage_workers、例: "fetch=8,download=16,write=4"）で並行に動かす。
+    記録（カタログ・状態・ジャーナル）は呼び出し元のスレッドで行う。
+    メッセージの完了順は一覧の順序と異なるため、ジャーナルには一覧の順序で記録する。
+    ディレクトリは書き込むファイルがある場合のみ作成するため、pipe_rm_empty_dir は不要。
+    dedup / postprocess / threads / batch_size には対応しない。
+    """
+    stage_workers = parse_stage_workers(stage_workers, max(workers, 1))
+
+    with ExtractSession(
+        protocol,
+        output_dir,
+        query=query,
+        clean=clean,
+        incremental=incremental,
+        resume=resume,
+        shards=shards,
+        skip_existing=skip_existing,
+        fetch_profile=fetch_profile,
+        raw_max_size=raw_max_size,
+    ) as session:
+        if client is None:
+            client = build_client(
+                fetch_profile,
+                discovery,
+                quota_per_second,
+                stage_workers["fetch"] + stage_workers["download"],
+            )
+        session.start(client)
+        # list の段階（別のスレッドで動く）。メールに一覧の順序（seq）を付ける
+        mails = (
+            {**mail, "seq": seq}
+            for seq, mail in enumerate(session.mails(workers=stage_workers["fetch"]))
+        )
+
+        extractor = StreamExtractor(
+            client,
+            session.fs,
+            session.index,
+            output_dir,
+            session.predicate(excludes, exclude_mime_types, max_size),
+        )
+        pipeline = StagePipeline(mails, extractor.stages(stage_workers, stage_queue))
+
+        # 未完了のパートの数（seq ごと）と、ジャーナルに記録する前の完了したメール
+        remaining = {}
+        done = {}
+        next_seq = 0
+        for record in pipeline:
+            mail = record["mail"]
+            seq = mail["seq"]
+            if seq not in remaining:
+                remaining[seq] = record["parts"]
+                session.catalog.add_mail(mail, record["info"])
+
+            part = record["part"]
+            if part is not None:
+                session.add_attachment(
+                    mail["id"],
+                    part["filename"],
+                    part.get("mimeType"),
+                    record["size"],
+                    record["path"],
+                    record["digest"],
+                )
+
+            remaining[seq] -= 1
+            if remaining[seq]:
+                continue
+
+            del remaining[seq]
+            session.complete(mail["id"])
+            done[seq] = mail
+            # 再開時に未完了のメールを飛ばさないよう、一覧の順序で記録する
+            while next_seq in done:
+                session.checkpoint(done.pop(next_seq)["id"])
+                next_seq += 1
+
+        session.finish()
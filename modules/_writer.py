@@ -0,0 +1,206 @@
+import base64
+import hashlib
+import time
+import uuid
+from collections import OrderedDict
+
+from fsspec import AbstractFileSystem
+
+from ._metrics import metrics
+
+WRITE_CHUNK_SIZE = 1024 * 1024
+# 非同期ファイルシステムでまとめて書き込む際に、メモリに保持する上限
+MAX_BUFFER_BYTES = 64 * 1024 * 1024
+MAX_BUFFER_FILES = 128
+# 作成済みとして記録するディレクトリ数の上限
+MAX_CACHED_DIRS = 4096
+
+
+def write_bytes(fs: AbstractFileSystem, path, data: bytes, chunk_size=WRITE_CHUNK_SIZE):
+    """fsspec のファイルシステムにチャンク単位で書き込む"""
+    view = memoryview(data)
+    write_chunks(
+        fs, path, (view[i : i + chunk_size] for i in range(0, len(view), chunk_size))
+    )
+
+
+def iter_base64_chunks(data: str, chunk_size=WRITE_CHUNK_SIZE):
+    """base64url を 4 文字単位で区切ってデコードし、チャンクごとに返す
+
+    urlsafe_b64decode は文字列全体を bytes に変換・置換してからデコードするため、
+    チャンク単位で渡し、一時的なコピーをチャンクの大きさに抑える（_raw.feed_raw と同じ）。
+    """
+    chunk_size -= chunk_size % 4
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i : i + chunk_size]
+        yield base64.urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4))
+
+
+def write_base64(fs: AbstractFileSystem, path, data: str, chunk_size=WRITE_CHUNK_SIZE):
+    """base64url の文字列をチャンク単位でデコードしながら書き込み、(バイト数, SHA-256) を返す
+
+    デコードした全体をメモリに保持しない。デコードと書き込みの時間は段階ごとに計測する。
+    """
+    size = 0
+    digest = hashlib.sha256()
+    decode_seconds = 0.0
+
+    def chunks():
+        nonlocal size, decode_seconds
+        it = iter_base64_chunks(data, chunk_size)
+        while True:
+            start = time.perf_counter()
+            chunk = next(it, None)
+            decode_seconds += time.perf_counter() - start
+            if chunk is None:
+                return
+            size += len(chunk)
+            digest.update(chunk)
+            yield chunk
+
+    start = time.perf_counter()
+    write_chunks(fs, path, chunks())
+    metrics.observe("stage_seconds", decode_seconds, stage="decode")
+    metrics.observe(
+        "stage_seconds", time.perf_counter() - start - decode_seconds, stage="write"
+    )
+    return size, digest.hexdigest()
+
+
+def write_chunks(fs: AbstractFileSystem, path, chunks):
+    """chunks を順に書き込む
+
+    ローカルでは一時ファイルに書き込んでからリネームし、書き込み途中のファイルが
+    完成したファイルに見えないようにする（オブジェクトストレージの PUT は元々アトミック）。
+    """
+    atomic = "file" in fs.protocol
+    dest = f"{path}.{uuid.uuid4().hex}.tmp" if atomic else path
+
+    try:
+        with fs.open(dest, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except BaseException:
+        if atomic and fs.exists(dest):
+            fs.rm(dest)
+        raise
+
+    if atomic:
+        fs.mv(dest, path)
+
+
+class BulkWriter:
+    """添付ファイルを書き込む。
+
+    s3 や gcs のような非同期ファイルシステムでは、添付ファイルをバッファして
+    fs.pipe でまとめて並列に書き込む。それ以外は即座に書き込む。
+    """
+
+    def __init__(
+        self,
+        fs: AbstractFileSystem,
+        max_bytes: int = MAX_BUFFER_BYTES,
+        max_files: int = MAX_BUFFER_FILES,
+    ):
+        self.fs = fs
+        self.bulk = getattr(fs, "async_impl", False)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._callbacks = []
+
+    def write(self, path, data: bytes):
+        if not self.bulk:
+            with metrics.timer("stage_seconds", stage="write"):
+                write_bytes(self.fs, path, data)
+            return
+
+        self._buffer[path] = data
+        self._buffer_bytes += len(data)
+        if self._buffer_bytes >= self.max_bytes or len(self._buffer) >= self.max_files:
+            self.flush()
+
+    def write_base64(self, path, data: str):
+        """base64url の文字列をデコードして書き込み、(バイト数, SHA-256) を返す
+
+        即座に書き込む場合は、デコードしながら書き込み、デコードした全体を保持しない。
+        """
+        if self.bulk:
+            with metrics.timer("stage_seconds", stage="decode"):
+                content = base64.urlsafe_b64decode(data)
+            self.write(path, content)
+            return len(content), hashlib.sha256(content).hexdigest()
+
+        return write_base64(self.fs, path, data)
+
+    def defer(self, func, *args):
+        """バッファ中のファイルが書き込まれた後に func を呼び出す"""
+        if self._buffer:
+            self._callbacks.append((func, args))
+        else:
+            func(*args)
+
+    def flush(self):
+        if self._buffer:
+            # まとめて書き込むため、ファイル単位ではなくまとまりごとに計測する
+            with metrics.timer("stage_seconds", stage="write_batch"):
+                self.fs.pipe(self._buffer)
+            self._buffer = {}
+            self._buffer_bytes = 0
+
+        callbacks, self._callbacks = self._callbacks, []
+        for func, args in callbacks:
+            func(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 例外時は書き込まれていないファイルを完了扱いにしない
+        if exc_type is None:
+            self.flush()
+
+
+class OutputIndex:
+    """出力先の既存ファイルと作成済みのディレクトリを記録する
+
+    起動時に一覧を一度だけ取得し（load）、添付ファイルごとの存在確認や mkdirs を省略する。
+    ディレクトリは LRU で max_dirs 件まで保持する。パスは fs の形式に正規化して比較する。
+    """
+
+    def __init__(self, fs: AbstractFileSystem, max_dirs: int = MAX_CACHED_DIRS):
+        self.fs = fs
+        self.max_dirs = max_dirs
+        self._files = set()
+        self._dirs = OrderedDict()
+
+    def load(self, entries: dict):
+        """fs.find(root, withdirs=True, detail=True) の結果を取り込む"""
+        for path, info in entries.items():
+            if info["type"] == "directory":
+                self.add_dir(path)
+            else:
+                self._files.add(path)
+
+    def exists(self, path) -> bool:
+        return self.fs._strip_protocol(path) in self._files
+
+    def has_dir(self, path) -> bool:
+        key = self.fs._strip_protocol(path)
+        if key not in self._dirs:
+            return False
+        self._dirs.move_to_end(key)
+        return True
+
+    def add_dir(self, path):
+        self._dirs[self.fs._strip_protocol(path)] = None
+        if len(self._dirs) > self.max_dirs:
+            self._dirs.popitem(last=False)
+
+    def makedirs(self, path):
+        """作成済みでなければ作成する"""
+        if self.has_dir(path):
+            return
+        self.fs.makedirs(path, exist_ok=True)
+        self.add_dir(path)
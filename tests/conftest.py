@@ -0,0 +1,31 @@
+import pytest
+
+from modules import _google
+from modules._google import GmailClient
+
+from .fake_gmail import build_fake, make_client
+
+
+@pytest.fixture
+def state_paths(tmp_path, monkeypatch):
+    """トークン・状態・カタログ・ジャーナルのパスを tmp_path に置き換える
+
+    use_account などが書き換えた場合も、テストの後に元に戻す。
+    """
+    monkeypatch.setattr(_google, "TOKEN_FILE", str(tmp_path / "token.json"))
+    monkeypatch.setattr(_google, "STATE_FILE", str(tmp_path / "state.sqlite"))
+    monkeypatch.setattr(_google, "CATALOG_FILE", str(tmp_path / "catalog.sqlite"))
+    monkeypatch.setattr(_google, "JOURNAL_DIR", str(tmp_path / "journal"))
+    return tmp_path
+
+
+@pytest.fixture
+def fake(state_paths, monkeypatch):
+    """パイプラインが認証して生成するクライアントを、FakeService のものに置き換える"""
+    fake = build_fake(count=5)
+    monkeypatch.setattr(
+        GmailClient,
+        "authenticate_and_build_service",
+        lambda **kwargs: make_client(fake),
+    )
+    return fake
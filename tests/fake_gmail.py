@@ -0,0 +1,262 @@
+"""テスト用の Gmail API サービスの代替"""
+
+import base64
+import threading
+from email.message import EmailMessage
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from benchmarks.fake_gmail_server import apply_fields, parse_fields
+from modules._google import GmailClient
+from modules._ratelimit import RequestScheduler
+
+
+def make_client(fake, **kwargs):
+    # テストではクォータによる待機を行わない
+    return GmailClient(fake, scheduler=RequestScheduler(quota_per_second=1e9), **kwargs)
+
+
+def read_tree(root):
+    """ディレクトリ以下のファイルを {相対パス: 内容} で返す"""
+    return {
+        str(p.relative_to(root)): p.read_bytes() for p in root.rglob("*") if p.is_file()
+    }
+
+
+def make_message(message_id, attachments, sender="Sender <sender@example.com>"):
+    """attachments: [(filename, mimeType, bytes)] からメッセージを生成する"""
+    parts = [{"partId": "0", "mimeType": "text/plain", "filename": "", "body": {}}]
+    for i, (filename, mime_type, data) in enumerate(attachments, 1):
+        parts.append(
+            {
+                "partId": str(i),
+                "mimeType": mime_type,
+                "filename": filename,
+                "body": {"attachmentId": f"{message_id}-{i}", "size": len(data)},
+            }
+        )
+
+    return {
+        "id": message_id,
+        "threadId": message_id,
+        "payload": {
+            "mimeType": "multipart/mixed",
+            "headers": [
+                {"name": "From", "value": sender},
+                {"name": "Subject", "value": f"subject {message_id}"},
+                {"name": "Date", "value": "Tue, 03 Oct 2023 05:10:49 +0000"},
+            ],
+            "parts": parts,
+        },
+    }
+
+
+class _Request:
+    def __init__(self, service, method, func):
+        self._service = service
+        self.methodId = method
+        self._func = func
+
+    def execute(self):
+        self._service.record(self.methodId)
+        return self._func()
+
+
+class FakeService:
+    """users().messages().(list|get|attachments().get) と threads().get のみを模倣する"""
+
+    def __init__(self, messages, page_size=100):
+        self._messages = {m["id"]: m for m in messages}
+        self.order = [m["id"] for m in messages]
+        self.page_size = page_size
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._data = {}
+        # 初回のみ 503 を返すメッセージ ID
+        self.fail_once = set()
+        self.history_id = 1
+        self._history = []
+        # クエリごとに返すメッセージ ID（未指定のクエリはすべてを返す）
+        self.queries = {}
+
+    def add_data(self, attachment_id, data: bytes):
+        self._data[attachment_id] = data
+
+    def add_message(self, message, data: dict):
+        """メッセージを受信したものとして追加する（data: attachmentId -> bytes）"""
+        self._messages[message["id"]] = message
+        self.order.insert(0, message["id"])
+        self._data.update(data)
+        self.history_id += 1
+        self._history.append(
+            {"id": str(self.history_id), "messagesAdded": [{"message": message}]}
+        )
+
+    def getProfile(self, userId):
+        return _Request(
+            self,
+            "gmail.users.getProfile",
+            lambda: {"historyId": str(self.history_id)},
+        )
+
+    def history(self):
+        return _History(self)
+
+    def record(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return _Attachments(self)
+
+    def threads(self):
+        return _Threads(self)
+
+    def list(self, userId, q=None, pageToken=None, **kwargs):
+        start = int(pageToken or 0)
+        end = start + self.page_size
+
+        order = self.queries.get(q, self.order)
+
+        def func():
+            ids = order[start:end]
+            response = {
+                "messages": [
+                    {"id": i, "threadId": self._messages[i]["threadId"]} for i in ids
+                ]
+            }
+            if end < len(order):
+                response["nextPageToken"] = str(end)
+            return response
+
+        return _Request(self, "gmail.users.messages.list", func)
+
+    def to_raw(self, message) -> str:
+        """format=raw の応答に含める RFC 822 のメッセージを生成する"""
+        mime = EmailMessage()
+        for header in message["payload"]["headers"]:
+            mime[header["name"]] = header["value"]
+        mime.set_content("body")
+        for part in message["payload"]["parts"]:
+            if part["filename"]:
+                maintype, subtype = part["mimeType"].split("/")
+                mime.add_attachment(
+                    self._data[part["body"]["attachmentId"]],
+                    maintype=maintype,
+                    subtype=subtype,
+                    filename=part["filename"],
+                )
+        return base64.urlsafe_b64encode(mime.as_bytes()).decode("UTF-8")
+
+    def get(self, userId, id, format=None, **kwargs):
+        def func():
+            if id in self.fail_once:
+                self.fail_once.discard(id)
+                raise HttpError(httplib2.Response({"status": 503}), b"unavailable")
+            message = self._messages[id]
+            if format == "raw":
+                return {
+                    "id": id,
+                    "threadId": message["threadId"],
+                    "raw": self.to_raw(message),
+                }
+            if "fields" in kwargs:
+                return apply_fields(message, parse_fields(kwargs["fields"]))
+            return message
+
+        return _Request(self, "gmail.users.messages.get", func)
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
+
+
+class _Batch:
+    def __init__(self, service: FakeService, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        self._service.record("batch")
+        for request_id, request in self._requests:
+            try:
+                response = request._func()
+            except HttpError as e:
+                self._callback(request_id, None, e)
+            else:
+                self._callback(request_id, response, None)
+
+
+class _History:
+    def __init__(self, service: FakeService):
+        self._service = service
+
+    def list(self, userId, startHistoryId, **kwargs):
+        def func():
+            history = [
+                h for h in self._service._history if int(h["id"]) > int(startHistoryId)
+            ]
+            return {"history": history} if history else {}
+
+        return _Request(self._service, "gmail.users.history.list", func)
+
+
+class _Threads:
+    def __init__(self, service: FakeService):
+        self._service = service
+
+    def get(self, userId, id, **kwargs):
+        def func():
+            messages = [
+                self._service._messages[i]
+                for i in reversed(self._service.order)
+                if self._service._messages[i]["threadId"] == id
+            ]
+            return {"id": id, "messages": messages}
+
+        return _Request(self._service, "gmail.users.threads.get", func)
+
+
+class _Attachments:
+    def __init__(self, service: FakeService):
+        self._service = service
+
+    def get(self, userId, messageId, id, **kwargs):
+        def func():
+            data = self._service._data[id]
+            return {
+                "size": len(data),
+                "data": base64.urlsafe_b64encode(data).decode("UTF-8"),
+            }
+
+        return _Request(self._service, "gmail.users.messages.attachments.get", func)
+
+
+def build_fake(count=10, attachments_per_message=2, size=16):
+    messages = []
+    service_data = {}
+    for n in range(count):
+        message_id = f"m{n:04d}"
+        files = [
+            (f"file{n}_{i}.pdf", "application/pdf", bytes([n % 256]) * size)
+            for i in range(attachments_per_message)
+        ]
+        message = make_message(message_id, files)
+        for i, (_, _, data) in enumerate(files, 1):
+            service_data[f"{message_id}-{i}"] = data
+        messages.append(message)
+
+    service = FakeService(messages)
+    for k, v in service_data.items():
+        service.add_data(k, v)
+    return service
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from modules import _accounts
+
+
+def write_manifest(tmp_path, manifest):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def test_load_manifest(tmp_path, monkeypatch):
+    monkeypatch.setattr(_accounts, "ACCOUNTS_DIR", str(tmp_path / "accounts"))
+    path = write_manifest(
+        tmp_path,
+        {
+            "defaults": {"protocol": "file", "output_prefix": "out", "workers": 4},
+            "project_quota_per_second": 300,
+            "accounts": [
+                {"name": "alice"},
+                {"name": "bob", "output_dir": "bob-out", "workers": 1},
+            ],
+        },
+    )
+
+    (alice, bob), project_quota = _accounts.load_manifest(path)
+    assert project_quota == 300
+    assert alice["output_dir"] == "out/alice"
+    assert alice["token"] == str(tmp_path / "accounts" / "alice" / "token.json")
+    assert alice["workers"] == 4
+    assert bob["output_dir"] == "bob-out"
+    assert bob["workers"] == 1
+
+    # 同時に実行するアカウントで均等に分け、ユーザーごとの上限は超えない
+    shared = _accounts.share_quota([alice, bob], 2, 300)
+    assert [a["quota_per_second"] for a in shared] == [150, 150]
+    shared = _accounts.share_quota([alice, bob], 1, 300)
+    assert [a["quota_per_second"] for a in shared] == [250, 250]
+
+    path = write_manifest(
+        tmp_path,
+        {"defaults": {"output_prefix": "out"}, "accounts": [{"name": "a"}] * 2},
+    )
+    with pytest.raises(ValueError):
+        _accounts.load_manifest(path)
+
+
+def test_run_account(tmp_path, fake):
+    # use_account が書き換えるパスは、state_paths がテストの後に元に戻す
+    token = tmp_path / "alice" / "token.json"
+    token.parent.mkdir()
+    token.write_text("{}")
+
+    summary = _accounts.run_account(
+        {
+            "name": "alice",
+            "token": str(token),
+            "state_dir": str(tmp_path / "alice"),
+            "output_dir": str(tmp_path / "out" / "alice"),
+            "protocol": "file",
+            "pipelines": _accounts.DEFAULT_PIPELINES,
+        }
+    )
+
+    assert summary["status"] == "ok"
+    assert summary["counters"]["api_calls{method=gmail.users.messages.get}"] == 5
+    assert len(list((tmp_path / "out" / "alice").rglob("*.pdf"))) == 10
+    assert (tmp_path / "alice" / "catalog.sqlite").exists()
+
+
+def test_run_accounts_reports_each_account(tmp_path):
+    accounts = [
+        {
+            "name": name,
+            "token": str(tmp_path / name / "token.json"),
+            "state_dir": str(tmp_path / name),
+            "output_dir": str(tmp_path / "out" / name),
+            "pipelines": _accounts.DEFAULT_PIPELINES,
+        }
+        for name in ("alice", "bob")
+    ]
+
+    # トークンが無いアカウントは、認可を待たずに失敗として報告する
+    results = _accounts.run_accounts(accounts, processes=1)
+    assert [r["account"] for r in results] == ["alice", "bob"]
+    assert all(r["status"] == "error" for r in results)
+    assert "Token not found" in results[0]["error"]
+
+
+def test_run_accounts_with_empty_manifest(tmp_path):
+    path = write_manifest(tmp_path, {"accounts": []})
+    accounts, _ = _accounts.load_manifest(path)
+
+    assert _accounts.run_accounts(accounts) == []
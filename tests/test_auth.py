@@ -0,0 +1,62 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from modules import _google
+from modules._google import CredentialResoruce, OauthFlow
+
+
+def make_token(expires_in: timedelta) -> dict:
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + expires_in
+    return {
+        "token": "access",
+        "refresh_token": "refresh",
+        "client_id": "id",
+        "client_secret": "secret",
+        "expiry": expiry.isoformat() + "Z",
+    }
+
+
+@pytest.fixture
+def token_path(tmp_path, monkeypatch):
+    path = tmp_path / "token.json"
+    monkeypatch.setattr(_google, "TOKEN_FILE", str(path))
+    OauthFlow.clear_cache()
+    yield path
+    OauthFlow.clear_cache()
+
+
+def test_credentials_are_cached_in_process(token_path, monkeypatch):
+    CredentialResoruce.save_token(make_token(timedelta(hours=1)))
+    reads = []
+    original = CredentialResoruce.get_token_or_none.__func__
+    monkeypatch.setattr(
+        CredentialResoruce,
+        "get_token_or_none",
+        classmethod(lambda cls: reads.append(1) or original(cls)),
+    )
+
+    first = OauthFlow(CredentialResoruce()).exec()
+    second = OauthFlow(CredentialResoruce()).exec()
+
+    assert first is second
+    assert len(reads) == 1
+    assert [p.name for p in token_path.parent.iterdir() if ".tmp" in p.name] == []
+
+
+def test_refreshes_before_expiry(token_path, monkeypatch):
+    CredentialResoruce.save_token(make_token(timedelta(minutes=1)))
+
+    def refresh(self, request):
+        self.token = "refreshed"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(
+            hours=1
+        )
+
+    monkeypatch.setattr(Credentials, "refresh", refresh)
+    creds = OauthFlow(CredentialResoruce()).exec()
+
+    assert creds.token == "refreshed"
+    assert json.loads(token_path.read_text())["token"] == "refreshed"
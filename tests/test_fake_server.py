@@ -0,0 +1,67 @@
+import pytest
+
+from benchmarks.fake_gmail_server import FakeGmailServer, Mailbox, build_fake_service
+from modules import _google
+from modules._google import FETCH_PROFILES, GmailClient
+from modules._ratelimit import RequestScheduler
+
+
+@pytest.fixture
+def server():
+    server = FakeGmailServer(Mailbox(messages=30, size=1024), page_size=20).start()
+    yield server
+    server.stop()
+
+
+def test_pipeline_against_fake_server(server, tmp_path, state_paths):
+    def service_factory():
+        return build_fake_service(server.url)
+
+    client = GmailClient(
+        service_factory(),
+        service_factory=service_factory,
+        scheduler=RequestScheduler(quota_per_second=1e9),
+        page_size=20,
+    )
+    output_dir = tmp_path / "out"
+    _google.pipe_extract_attachments(
+        "file", str(output_dir), workers=4, batch_size=10, client=client
+    )
+
+    files = [p for p in output_dir.rglob("*") if p.is_file()]
+    assert len(files) == 60
+    assert server.calls["gmail.users.messages.get"] == 30
+    # 除外される画像はダウンロードしない
+    assert server.calls["gmail.users.messages.attachments.get"] == 60
+    # 一覧 2 ページ + バッチ 3 回 + 添付ファイル 60 件 + プロファイル
+    assert server.http_requests == 66
+
+
+def test_fetch_profile_reduces_response(server):
+    service = build_fake_service(server.url)
+    client = GmailClient(service, scheduler=RequestScheduler(quota_per_second=1e9))
+    message_id = server.mailbox.order[0]
+
+    server.reset()
+    client.fetch_profile = "full"
+    full = list(client.extract_attachments(message_id))
+    full_bytes = server.bytes_sent
+
+    server.reset()
+    client.fetch_profile = "attachments"
+    masked = list(client.extract_attachments(message_id))
+    masked_bytes = server.bytes_sent
+
+    assert [row[:7] for row in masked] == [row[:7] for row in full]
+    assert masked_bytes < full_bytes
+
+    message = client.scheduler.execute(
+        service.users()
+        .messages()
+        .get(userId="me", id=message_id, **FETCH_PROFILES["metadata"])
+    )
+    assert [h["name"] for h in message["payload"]["headers"]] == [
+        "From",
+        "Subject",
+        "Date",
+    ]
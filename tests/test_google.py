@@ -0,0 +1,522 @@
+import base64
+import gzip
+import sqlite3
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from googleapiclient.errors import HttpError
+
+from modules import _google
+from modules._catalog import Catalog, query_catalog
+from modules._google import AttachmentFilter, GmailClient
+from modules._state import SyncState
+
+from .fake_gmail import FakeService, build_fake, make_client, make_message, read_tree
+
+
+def test_extract_attachments_many_keeps_order():
+    fake = build_fake(count=20)
+    client = make_client(fake, service_factory=lambda: fake)
+
+    serial = [
+        row[1] + row[5] for row in client.extract_attachments_many(client.query())
+    ]
+    parallel = [
+        row[1] + row[5]
+        for row in client.extract_attachments_many(client.query(), workers=4)
+    ]
+
+    assert len(serial) == 40
+    assert serial == parallel
+
+
+def test_batch_retries_failed_requests(monkeypatch):
+    monkeypatch.setattr("modules._ratelimit.time.sleep", lambda _: None)
+    fake = build_fake(count=30)
+    fake.fail_once = {"m0003", "m0017"}
+    client = make_client(fake)
+
+    rows = list(client.extract_attachments_many(client.query(), batch_size=20))
+
+    assert len(rows) == 60
+    assert fake.calls["batch"] == 3
+    assert "gmail.users.messages.get" not in fake.calls
+
+
+def test_batch_gives_up_without_a_final_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("modules._ratelimit.time.sleep", sleeps.append)
+
+    class FailAlways(set):
+        def discard(self, item):
+            pass
+
+    fake = build_fake(count=2)
+    fake.fail_once = FailAlways({"m0001"})
+    client = make_client(fake)
+
+    with pytest.raises(HttpError):
+        client.get_messages(["m0000", "m0001"], retries=2)
+    assert fake.calls["batch"] == 3
+    assert len(sleeps) == 2
+
+
+def test_invalid_batch_size_fails_before_auth(state_paths, monkeypatch):
+    def authenticate(**kwargs):
+        raise AssertionError("authenticated")
+
+    monkeypatch.setattr(GmailClient, "authenticate_and_build_service", authenticate)
+
+    with pytest.raises(ValueError):
+        _google.pipe_extract_attachments(
+            "file", str(state_paths / "out"), batch_size=101
+        )
+    assert not (state_paths / "out").exists()
+
+
+def test_predicate_skips_download():
+    files = [
+        ("invoice.pdf", "application/pdf", b"a" * 10),
+        ("logo.png", "image/png", b"b" * 20),
+        ("photo.jpg", "image/jpeg", b"c" * 30),
+        ("large.zip", "application/zip", b"d" * 100),
+    ]
+    fake = FakeService([make_message("m1", files)])
+    for i, (_, _, data) in enumerate(files, 1):
+        fake.add_data(f"m1-{i}", data)
+    client = make_client(fake)
+
+    predicate = AttachmentFilter(
+        excludes={".png"}, exclude_mime_types={"image/"}, max_size=50
+    )
+    rows = list(client.extract_attachments("m1", predicate=predicate))
+
+    assert [row[5] for row in rows] == ["invoice.pdf"]
+    assert fake.calls["gmail.users.messages.attachments.get"] == 1
+    assert client.stats.skipped_requests == 3
+    assert client.stats.skipped_bytes == 150
+
+
+def test_incremental_skips_extracted_messages(tmp_path, fake):
+    output_dir = str(tmp_path / "out")
+
+    _google.pipe_extract_attachments("file", output_dir, incremental=True)
+    assert fake.calls["gmail.users.messages.get"] == 5
+
+    # 変更がなければ一覧も取得しない
+    fake.calls.clear()
+    _google.pipe_extract_attachments("file", output_dir, incremental=True)
+    assert "gmail.users.messages.list" not in fake.calls
+    assert "gmail.users.messages.get" not in fake.calls
+
+    # 追加されたメッセージのみ取得する
+    fake.add_message(
+        make_message("new", [("new.pdf", "application/pdf", b"x")]), {"new-1": b"x"}
+    )
+    fake.calls.clear()
+    _google.pipe_extract_attachments("file", output_dir, incremental=True)
+    assert fake.calls["gmail.users.messages.get"] == 1
+    assert (tmp_path / "out" / "sender@example.com").is_dir()
+
+
+def test_incremental_history_is_per_query(tmp_path, fake):
+    fake.queries = {"q1": ["m0000", "m0001"]}
+    output_dir = tmp_path / "out"
+
+    _google.pipe_extract_attachments(
+        "file", str(output_dir), query="q1", incremental=True
+    )
+    assert len(list(output_dir.rglob("*.pdf"))) == 4
+
+    # 変更が無くても、クエリが異なれば一覧を取得する
+    _google.pipe_extract_attachments(
+        "file", str(output_dir), query="q2", incremental=True
+    )
+    assert len(list(output_dir.rglob("*.pdf"))) == 10
+
+
+def test_state_writes_each_message_in_one_transaction(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    first = SyncState(path, "a")
+    # 並列に実行した別の抽出は、ロックを待たずに記録できる
+    second = SyncState(path, "b", timeout=0)
+    try:
+        first.add_attachment("m1", "a.pdf", "a/a.pdf")
+        second.add_attachment("m2", "b.pdf", "b/b.pdf")
+        second.mark_extracted("m2")
+        first.mark_extracted("m1")
+
+        rows = sqlite3.connect(path).execute(
+            "SELECT output_dir, message_id, path FROM extracted_attachments"
+        )
+        assert sorted(rows) == [("a", "m1", "a/a.pdf"), ("b", "m2", "b/b.pdf")]
+    finally:
+        first.close()
+        second.close()
+
+
+def test_extract_attachments_streams_each_part():
+    fake = build_fake(count=1, attachments_per_message=3)
+    client = make_client(fake)
+
+    rows = client.extract_attachments("m0000")
+    next(rows)
+    assert fake.calls["gmail.users.messages.attachments.get"] == 1
+    next(rows)
+    assert fake.calls["gmail.users.messages.attachments.get"] == 2
+
+
+def test_catalog_records_mails_and_attachments(tmp_path, fake):
+    _google.pipe_extract_attachments("file", str(tmp_path / "out"))
+
+    catalog = Catalog(str(tmp_path / "catalog.sqlite"))
+    _, mails = catalog.query(
+        "SELECT id FROM mails WHERE sender = ?", ("sender@example.com",)
+    )
+    columns, rows = catalog.query(
+        "SELECT a.filename, a.size FROM attachments a"
+        " JOIN mails m ON a.mail_id = m.id WHERE m.id = 'm0001'"
+    )
+
+    assert len(mails) == 5
+    assert columns == ["filename", "size"]
+    assert sorted(rows) == [("file1_0.pdf", 16), ("file1_1.pdf", 16)]
+
+
+def test_catalog_writes_each_mail_in_one_transaction(tmp_path):
+    path = str(tmp_path / "catalog.sqlite")
+    first = Catalog(path)
+    # 並列に実行した別の抽出は、ロックを待たずに記録できる
+    second = Catalog(path, timeout=0)
+    info = {"sender_name": "", "sender_address": "s", "date": "d", "title": "t"}
+    try:
+        first.add_mail({"id": "m1"}, info)
+        first.add_attachment("a", "m1", "a.pdf", "application/pdf", 1, "a/a.pdf")
+        second.add_mail({"id": "m2"}, info)
+        second.commit("m2")
+        first.commit("m1")
+
+        assert first.query("SELECT id FROM mails ORDER BY id")[1] == [("m1",), ("m2",)]
+        assert first.query("SELECT path FROM attachments")[1] == [("a/a.pdf",)]
+    finally:
+        first.close()
+        second.close()
+
+
+def test_query_catalog_is_read_only(tmp_path, fake):
+    _google.pipe_extract_attachments("file", str(tmp_path / "out"))
+    path = str(tmp_path / "catalog.sqlite")
+
+    assert query_catalog(path, "SELECT COUNT(*) FROM mails")[1] == [(5,)]
+    with pytest.raises(sqlite3.OperationalError):
+        query_catalog(path, "CREATE TABLE x (a)")
+    # パスを誤った場合に空のカタログを作成しない
+    with pytest.raises(FileNotFoundError):
+        query_catalog(str(tmp_path / "missing.sqlite"), "SELECT 1")
+    assert not (tmp_path / "missing.sqlite").exists()
+
+
+def test_extract_attachments_walks_nested_and_inline_parts():
+    inline = base64.urlsafe_b64encode(b"inline").decode()
+    message = make_message("m1", [("top.pdf", "application/pdf", b"top")])
+    message["payload"]["parts"].append(
+        {
+            "partId": "2",
+            "mimeType": "message/rfc822",
+            "filename": "",
+            "body": {"size": 0},
+            "parts": [
+                {
+                    "partId": "2.0",
+                    "mimeType": "multipart/alternative",
+                    "filename": "",
+                    "body": {"size": 0},
+                    "parts": [
+                        {
+                            "partId": "2.0.0",
+                            "mimeType": "text/csv",
+                            "filename": "nested.csv",
+                            "body": {"size": 6, "data": inline},
+                        },
+                    ],
+                },
+                {
+                    "partId": "2.1",
+                    "mimeType": "application/pdf",
+                    "filename": "forwarded.pdf",
+                    "body": {"attachmentId": "m1-fwd", "size": 3},
+                },
+            ],
+        }
+    )
+    fake = FakeService([message])
+    fake.add_data("m1-1", b"top")
+    fake.add_data("m1-fwd", b"fwd")
+    client = make_client(fake)
+
+    rows = list(client.extract_attachments("m1"))
+
+    assert [(row[5], row[7]) for row in rows] == [
+        ("top.pdf", b"top"),
+        ("nested.csv", b"inline"),
+        ("forwarded.pdf", b"fwd"),
+    ]
+    assert fake.calls["gmail.users.messages.attachments.get"] == 2
+
+
+def test_extract_attachments_refetches_parts_beyond_fields_mask():
+    message = make_message("m1", [])
+    parts = message["payload"]["parts"]
+    # 転送を 8 回繰り返したメールの最も内側の添付ファイル
+    for i in range(8):
+        forwarded = {"partId": str(i), "mimeType": "message/rfc822", "parts": []}
+        parts.append(forwarded)
+        parts = forwarded["parts"]
+    parts.append(
+        {
+            "mimeType": "application/pdf",
+            "filename": "deep.pdf",
+            "body": {"attachmentId": "m1-deep", "size": 4},
+        }
+    )
+    fake = FakeService([message])
+    fake.add_data("m1-deep", b"deep")
+    client = make_client(fake)
+
+    rows = list(client.extract_attachments("m1"))
+
+    assert [(row[5], row[7]) for row in rows] == [("deep.pdf", b"deep")]
+    assert fake.calls["gmail.users.messages.get"] == 2
+
+
+def test_resume_from_checkpoint(tmp_path, fake):
+    fake.page_size = 2
+    output_dir = tmp_path / "out"
+    get_attachment = fake.attachments
+
+    def failing_attachments():
+        attachments = get_attachment()
+        original = attachments.get
+
+        def get(userId, messageId, id, **kwargs):
+            if messageId == "m0003":
+                raise ConnectionError("network blip")
+            return original(userId, messageId, id, **kwargs)
+
+        attachments.get = get
+        return attachments
+
+    fake.attachments = failing_attachments
+    with pytest.raises(ConnectionError):
+        _google.pipe_extract_attachments("file", str(output_dir))
+
+    # 書き込み途中の一時ファイルは残らない
+    assert not list(output_dir.rglob("*.tmp"))
+
+    fake.attachments = get_attachment
+    fake.calls.clear()
+    _google.pipe_extract_attachments("file", str(output_dir), clean=True, resume=True)
+
+    # m0000-m0002 は完了済み。m0003 のページ（m0002, m0003）から再開する
+    assert fake.calls["gmail.users.messages.get"] == 2
+    assert len(list(output_dir.rglob("*.pdf"))) == 10
+    assert not list((tmp_path / "journal").iterdir())
+
+
+def test_sharded_query_lists_in_parallel(tmp_path, fake):
+    # 境界のメッセージ m0002 は両方のシャードに含まれる
+    fake.queries = {
+        "after:2024/01/01 before:2024/02/01": ["m0000", "m0001", "m0002"],
+        "after:2024/02/01 before:2024/03/01": ["m0002", "m0003", "m0004"],
+    }
+    output_dir = tmp_path / "out"
+
+    _google.pipe_extract_attachments(
+        "file",
+        str(output_dir),
+        query="after:2024/01/01 before:2024/03/01",
+        shards="month",
+        workers=2,
+    )
+
+    assert fake.calls["gmail.users.messages.list"] == 2
+    assert fake.calls["gmail.users.messages.get"] == 5
+    assert len(list(output_dir.rglob("*.pdf"))) == 10
+
+
+def test_rm_empty_dir_walks_once(tmp_path, monkeypatch):
+    for path in ["a/b/c", "a/d", "e"]:
+        (tmp_path / "out" / path).mkdir(parents=True)
+    (tmp_path / "out" / "a" / "d" / "f.pdf").write_bytes(b"x")
+
+    # エントリごとに isdir を呼び出さない（find が起点に 1 回だけ呼び出す）
+    calls = []
+    isdir = LocalFileSystem.isdir
+    monkeypatch.setattr(
+        LocalFileSystem,
+        "isdir",
+        lambda self, path: calls.append(path) or isdir(self, path),
+    )
+    _google.pipe_rm_empty_dir("file", str(tmp_path / "out"))
+    assert len(calls) == 1
+
+    remaining = sorted(
+        str(p.relative_to(tmp_path / "out")) for p in (tmp_path / "out").rglob("*")
+    )
+    assert remaining == ["a", "a/d", "a/d/f.pdf"]
+
+
+def test_skip_existing_files(tmp_path, fake, monkeypatch):
+    output_dir = tmp_path / "out"
+    _google.pipe_extract_attachments("file", str(output_dir))
+    (output_dir / "sender@example.com").joinpath(
+        "2023-10-03T05-10-49+00-00_file4_1.pdf"
+    ).unlink()
+
+    makedirs = []
+    original = LocalFileSystem.makedirs
+    monkeypatch.setattr(
+        LocalFileSystem,
+        "makedirs",
+        lambda self, path, **kw: makedirs.append(path) or original(self, path, **kw),
+    )
+    fake.calls.clear()
+    _google.pipe_extract_attachments("file", str(output_dir))
+
+    # 削除したファイルのみダウンロードし、作成済みのディレクトリは作成しない
+    assert fake.calls["gmail.users.messages.attachments.get"] == 1
+    assert makedirs == []
+    assert len(list(output_dir.rglob("*.pdf"))) == 10
+
+
+def test_skip_existing_with_manifest(tmp_path, fake):
+    output_dir = tmp_path / "out"
+
+    _google.pipe_extract_attachments("file", str(output_dir), dedup="manifest")
+    assert fake.calls["gmail.users.messages.attachments.get"] == 10
+    # ファイルを作成しないメールごとのディレクトリは作成しない
+    assert sorted(p.name for p in output_dir.iterdir()) == [".blobs", "manifest.jsonl"]
+
+    # 再実行ではマニフェストに記録済みの添付ファイルをダウンロードしない
+    fake.calls.clear()
+    _google.pipe_extract_attachments("file", str(output_dir), dedup="manifest")
+    assert "gmail.users.messages.attachments.get" not in fake.calls
+    assert len((output_dir / "manifest.jsonl").read_text().splitlines()) == 10
+
+
+def test_postprocess_writes_outputs(tmp_path, fake):
+    fake.add_message(
+        make_message("gz", [("report.csv.gz", "application/gzip", b"")]),
+        {"gz-1": gzip.compress(b"a,b\n")},
+    )
+    output_dir = tmp_path / "out"
+
+    _google.pipe_extract_attachments(
+        "file", str(output_dir), postprocess="gunzip", postprocess_workers=1
+    )
+
+    [csv] = output_dir.rglob("*.csv")
+    assert csv.read_bytes() == b"a,b\n"
+    assert len(list(output_dir.rglob("*.gz"))) == 1
+
+
+def test_discovery_document_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(_google, "DISCOVERY_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(_google, "_discovery_documents", {})
+    fetched = []
+
+    def fetch():
+        fetched.append(1)
+        return '{"name": "gmail", "version": "fetched"}'
+
+    monkeypatch.setattr(_google, "fetch_discovery_document", fetch)
+
+    # 期限内のキャッシュは取得し直さず、プロセス内では一度だけ読み込む
+    assert _google.load_discovery_document("cache")["version"] == "fetched"
+    assert _google.load_discovery_document("cache")["version"] == "fetched"
+    assert len(fetched) == 1
+
+    # 期限切れで取得に失敗した場合は、期限切れのキャッシュを使う
+    def fail():
+        raise OSError("offline")
+
+    monkeypatch.setattr(_google, "fetch_discovery_document", fail)
+    monkeypatch.setattr(_google, "_discovery_documents", {})
+    document = _google.load_discovery_document("cache", ttl=0)
+    assert document["version"] == "fetched"
+
+    # static はネットワークに接続しない
+    assert _google.load_discovery_document("static")["name"] == "gmail"
+    service = _google.build_gmail_service(discovery="static", http=object())
+    assert hasattr(service, "users")
+
+
+def test_extract_records_metrics(tmp_path, fake, monkeypatch):
+    from modules._metrics import Metrics
+
+    metrics = Metrics()
+    for module in ("_google", "_ratelimit", "_writer"):
+        monkeypatch.setattr(f"modules.{module}.metrics", metrics)
+
+    with metrics.scope(pipeline="extract"):
+        _google.pipe_extract_attachments("file", str(tmp_path / "out"))
+
+    summary = metrics.summary(pipeline="extract")
+    assert summary["counters"]["api_calls{method=gmail.users.messages.get}"] == 5
+    assert summary["counters"]["downloaded_bytes"] > 0
+    for stage in ("list", "get", "attachment", "decode", "write"):
+        assert summary["histograms"][f"stage_seconds{{stage={stage}}}"]["count"] > 0
+
+
+@pytest.mark.parametrize("batch_size", [0, 2])
+def test_raw_fetch_profile(tmp_path, fake, batch_size):
+    ids = list(fake.order)
+    fake.queries = {"smaller:100": ids[:3], "larger:99": ids[3:]}
+
+    _google.pipe_extract_attachments(
+        "file", str(tmp_path / "parts"), fetch_profile="attachments"
+    )
+    fake.calls.clear()
+    _google.pipe_extract_attachments(
+        "file",
+        str(tmp_path / "raw"),
+        fetch_profile="raw",
+        raw_max_size=100,
+        batch_size=batch_size,
+    )
+
+    # 小さなメッセージは attachments().get を呼び出さない
+    assert fake.calls["gmail.users.messages.attachments.get"] == 4
+
+    assert read_tree(tmp_path / "raw") == read_tree(tmp_path / "parts")
+
+
+def test_group_threads_within_page():
+    mails = [
+        {"id": "a", "threadId": "t1", "page": 1},
+        {"id": "b", "threadId": "t2", "page": 1},
+        {"id": "c", "threadId": "t1", "page": 1},
+        {"id": "d", "threadId": "t1", "page": 2},
+        {"id": "e", "threadId": "t1", "page": 2, "fetch_profile": "raw"},
+    ]
+
+    groups = [[m["id"] for m in g] for g in GmailClient.group_threads(mails)]
+    assert groups == [["a", "c"], ["b"], ["d"], ["e"]]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_threads_fetch_once_per_thread_tree(tmp_path, fake, workers):
+    for message_id in fake.order[:3]:
+        fake._messages[message_id]["threadId"] = "t1"
+
+    _google.pipe_extract_attachments("file", str(tmp_path / "messages"))
+    fake.calls.clear()
+    _google.pipe_extract_attachments(
+        "file", str(tmp_path / "threads"), threads=True, workers=workers
+    )
+
+    # 3 件のスレッドは 1 回、1 件のみのスレッドは messages().get で取得する
+    assert fake.calls["gmail.users.threads.get"] == 1
+    assert fake.calls["gmail.users.messages.get"] == 2
+
+    assert read_tree(tmp_path / "threads") == read_tree(tmp_path / "messages")
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fake_gmail_server import FakeGmailServer, Mailbox, build_fake_service
+from modules import _google_async
+from modules._google import AttachmentFilter, GmailClient
+from modules._google_async import AsyncGmailClient
+from modules._ratelimit import AsyncRequestScheduler, RequestScheduler
+
+httpx = pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def server():
+    server = FakeGmailServer(Mailbox(messages=30, size=1024), page_size=20).start()
+    yield server
+    server.stop()
+
+
+def make_async_client(server):
+    return AsyncGmailClient(
+        httpx.AsyncClient(),
+        root_url=server.url,
+        scheduler=AsyncRequestScheduler(quota_per_second=1e9),
+        page_size=20,
+    )
+
+
+def test_extract_attachments_matches_sync_client(server):
+    message_id = server.mailbox.order[0]
+    predicate = AttachmentFilter(excludes={".png"})
+    sync_client = GmailClient(
+        build_fake_service(server.url),
+        scheduler=RequestScheduler(quota_per_second=1e9),
+    )
+    expected = list(sync_client.extract_attachments(message_id, predicate=predicate))
+
+    async def run():
+        client = make_async_client(server)
+        try:
+            return [
+                row
+                async for row in client.extract_attachments(
+                    message_id, predicate=predicate
+                )
+            ]
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == expected
+
+
+def test_async_pipeline_against_fake_server(server, tmp_path, state_paths):
+    output_dir = tmp_path / "out"
+
+    async def run(**kwargs):
+        client = make_async_client(server)
+        try:
+            await _google_async.extract_attachments_async(
+                "file", str(output_dir), client=client, concurrency=8, **kwargs
+            )
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+
+    files = [p for p in output_dir.rglob("*") if p.is_file()]
+    assert len(files) == 60
+    assert server.calls["gmail.users.messages.get"] == 30
+    assert server.calls["gmail.users.messages.attachments.get"] == 60
+
+    # 変更がなければ一覧も取得しない
+    server.reset()
+    asyncio.run(run(incremental=True))
+    assert "gmail.users.messages.list" not in server.calls
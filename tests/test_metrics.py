@@ -0,0 +1,53 @@
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+
+from modules._metrics import Metrics, ThreadProfiler
+
+
+def test_summary_by_scope():
+    metrics = Metrics(buckets=(0.1, 1))
+    with metrics.scope(pipeline="extract"):
+        metrics.inc("api_calls", method="get")
+        metrics.inc("api_calls", method="get")
+        metrics.gauge("queue_depth", 3, queue="messages")
+        metrics.gauge("queue_depth", 1, queue="messages")
+        metrics.observe("stage_seconds", 0.05, stage="get")
+        metrics.observe("stage_seconds", 2, stage="get")
+    with metrics.scope(pipeline="rm_empty_dir"):
+        metrics.inc("api_calls", method="get")
+
+    summary = metrics.summary(pipeline="extract")
+    assert summary["counters"] == {"api_calls{method=get}": 2}
+    assert summary["gauges"] == {"queue_depth{queue=messages}": {"last": 1, "max": 3}}
+    histogram = summary["histograms"]["stage_seconds{stage=get}"]
+    assert histogram["count"] == 2
+    assert histogram["p50"] == 0.1
+    assert histogram["max"] == 2
+
+
+def test_prometheus_text():
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.inc("retries", method="get")
+    metrics.observe("stage_seconds", 0.5, stage="write")
+    metrics.observe("stage_seconds", 0.05, stage="write")
+
+    lines = metrics.to_prometheus("test").splitlines()
+    assert "# TYPE test_retries_total counter" in lines
+    assert 'test_retries_total{method="get"} 1' in lines
+    assert 'test_stage_seconds_bucket{stage="write",le="0.1"} 1' in lines
+    assert 'test_stage_seconds_bucket{stage="write",le="+Inf"} 2' in lines
+    assert 'test_stage_seconds_count{stage="write"} 2' in lines
+
+
+def test_thread_profiler_includes_worker_threads(tmp_path):
+    def work_in_thread():
+        return sum(range(1000))
+
+    with ThreadProfiler() as profiler:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda _: work_in_thread(), range(4)))
+
+    path = str(tmp_path / "run.prof")
+    profiler.dump_stats(path)
+    names = {func[2] for func in pstats.Stats(path).stats}
+    assert "work_in_thread" in names
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from modules._pipeline import Stage, StagePipeline, get_pipeline
+
+
+def test_stages_fan_out_and_filter():
+    pipeline = StagePipeline(
+        range(20),
+        [
+            Stage("split", lambda x: [x, x + 100], workers=4),
+            Stage("even", lambda x: [x] if x % 2 == 0 else [], workers=2),
+        ],
+    )
+
+    assert sorted(pipeline) == sorted(
+        [x for x in range(20) if x % 2 == 0]
+        + [x + 100 for x in range(20) if x % 2 == 0]
+    )
+
+
+def test_bounded_queue_applies_backpressure():
+    produced = []
+
+    def source():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    pipeline = iter(StagePipeline(source(), [Stage("id", lambda x: [x], max_queue=1)]))
+    next(pipeline)
+    time.sleep(0.3)
+
+    # source は下流のキューの空きを待つため、先に読み切らない
+    assert len(produced) < 10
+    pipeline.close()
+
+
+def test_error_stops_all_stages():
+    started = threading.Event()
+
+    def fail(x):
+        started.set()
+        if x == 5:
+            raise ValueError("boom")
+        return [x]
+
+    with pytest.raises(ValueError, match="boom"):
+        list(StagePipeline(range(1000), [Stage("fail", fail, workers=3)]))
+    assert started.is_set()
+    assert not [t for t in threading.enumerate() if t.name.startswith("fail-")]
+
+
+def test_get_pipeline():
+    assert get_pipeline("pipe_extract_attachments_stream").__name__ == (
+        "pipe_extract_attachments_stream"
+    )
+    with pytest.raises(AttributeError):
+        get_pipeline("pipe_unknown")
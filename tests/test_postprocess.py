@@ -0,0 +1,48 @@
+import gzip
+import io
+import zipfile
+
+import pytest
+
+from modules._postprocess import PostProcessor
+
+
+@PostProcessor.register
+def upper(data, path, **metadata):
+    return {f"{path}.upper": bytes(data).upper()}
+
+
+def make_zip(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def test_post_processor_runs_transforms_in_workers():
+    compressed = gzip.compress(b"x,y")
+    with PostProcessor(["upper", "gunzip"], workers=2, max_pending=1) as post:
+        outputs = post.submit("/out/a.txt", b"abc")
+        outputs += post.submit("/out/b.csv.gz", compressed)
+        outputs += list(post.drain())
+
+    assert sorted(outputs) == [
+        ("/out/a.txt.upper", b"ABC"),
+        ("/out/b.csv", b"x,y"),
+        ("/out/b.csv.gz.upper", compressed.upper()),
+    ]
+
+
+def test_failed_transform_does_not_stop_others():
+    data = make_zip({"../evil.txt": b"x"})
+    with PostProcessor(["unzip", "upper"], workers=1) as post:
+        post.submit("/out/a.zip", data)
+        outputs = list(post.drain())
+
+    assert [path for path, _ in outputs] == ["/out/a.zip.upper"]
+
+
+def test_unknown_transform():
+    with pytest.raises(ValueError):
+        PostProcessor(["missing"])
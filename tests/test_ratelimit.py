@@ -0,0 +1,138 @@
+import asyncio
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from modules._ratelimit import (
+    AdaptiveLimit,
+    AsyncRequestScheduler,
+    RequestScheduler,
+    TokenBucket,
+)
+
+
+class FlakyRequest:
+    methodId = "gmail.users.messages.get"
+
+    def __init__(self, statuses, headers=None):
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.statuses:
+            status = self.statuses.pop(0)
+            resp = httplib2.Response({"status": status, **self.headers})
+            raise HttpError(resp, b"error")
+        return {"ok": True}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("modules._ratelimit.time.sleep", sleeps.append)
+    return sleeps
+
+
+def test_retry_honors_retry_after(sleeps):
+    scheduler = RequestScheduler(concurrency=8)
+    request = FlakyRequest([429, 503], headers={"retry-after": "7"})
+
+    assert scheduler.execute(request) == {"ok": True}
+    assert request.calls == 3
+    assert sleeps == [7.0, 7.0]
+    # 429 でのみ同時実行数を下げる
+    assert scheduler.limit.limit == 4
+
+
+def test_non_retryable_error_raises(sleeps):
+    scheduler = RequestScheduler()
+    request = FlakyRequest([404])
+
+    with pytest.raises(HttpError):
+        scheduler.execute(request)
+    assert request.calls == 1
+
+
+def test_token_bucket_waits_for_refill(monkeypatch):
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr("modules._ratelimit.time.monotonic", lambda: now[0])
+    monkeypatch.setattr("modules._ratelimit.time.sleep", sleep)
+
+    bucket = TokenBucket(rate=10)
+    bucket.acquire(10)
+    assert sleeps == []
+
+    bucket.acquire(5)
+    assert sleeps == [0.5]
+
+
+def test_token_bucket_charges_requests_over_capacity(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("modules._ratelimit.time.monotonic", lambda: now[0])
+
+    # 100 件のバッチ（500 units）は容量の 2 倍を消費する
+    bucket = TokenBucket(rate=250)
+    assert bucket.reserve(500) == 1.0
+    # 負の残高を返し終えるまで、後の要求も待機する
+    now[0] = 0.5
+    assert bucket.reserve(5) == pytest.approx(0.52)
+
+
+def test_adaptive_limit_recovers():
+    limit = AdaptiveLimit(8, increase_after=2)
+    limit.on_throttled()
+    assert limit.limit == 4
+
+    for _ in range(4):
+        limit.on_success()
+    assert limit.limit == 6
+
+
+def test_async_retry_honors_retry_after(monkeypatch):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr("modules._ratelimit.asyncio.sleep", sleep)
+    scheduler = AsyncRequestScheduler()
+    request = FlakyRequest([503], headers={"retry-after": "3"})
+
+    async def send():
+        return request.execute()
+
+    result = asyncio.run(scheduler.execute(send, method=request.methodId))
+    assert result == {"ok": True}
+    assert request.calls == 2
+    assert sleeps == [3.0]
+
+
+def test_async_throttle_lowers_concurrency():
+    scheduler = AsyncRequestScheduler(concurrency=4, base_delay=0)
+    request = FlakyRequest([429])
+    active = []
+
+    async def send():
+        active.append(scheduler.limit._active)
+        await asyncio.sleep(0)
+        return request.execute()
+
+    async def run():
+        await scheduler.execute(send, method=request.methodId)
+        assert scheduler.limit.limit == 2
+        await asyncio.gather(
+            *(scheduler.execute(send, method=request.methodId) for _ in range(8))
+        )
+
+    asyncio.run(run())
+    # スロットリングの後は、下げた上限を超えて同時に送信しない
+    assert max(active[2:]) == 2
@@ -0,0 +1,49 @@
+import base64
+from email.message import EmailMessage
+
+from modules._google import GmailClient, iter_attachment_parts
+from modules._raw import feed_raw, parse_raw_message
+
+
+def encode(mime: EmailMessage) -> str:
+    return base64.urlsafe_b64encode(mime.as_bytes()).decode().rstrip("=")
+
+
+def test_parse_raw_message():
+    forwarded = EmailMessage()
+    forwarded["Subject"] = "inner"
+    forwarded.set_content("inner body")
+    forwarded.add_attachment(b"inner", maintype="text", subtype="csv", filename="a.csv")
+
+    mime = EmailMessage()
+    mime["From"] = "=?utf-8?b?5bGx55Sw?= <yamada@example.com>"
+    mime["Subject"] = "=?utf-8?b?6KuL5rGC5pu4?="
+    mime["Date"] = "Tue, 03 Oct 2023 05:10:49 +0000"
+    mime.set_content("body")
+    mime.add_attachment(
+        bytes(range(256)) * 10,
+        maintype="application",
+        subtype="pdf",
+        filename="請求書.pdf",
+    )
+    mime.add_attachment(forwarded, filename="fwd.eml")
+
+    # パディングを省いた base64 を、チャンクに分けて渡しても同じ結果になる
+    raw = encode(mime)
+    assert feed_raw(raw, chunk_size=6).as_bytes() == feed_raw(raw).as_bytes()
+    message = parse_raw_message({"id": "m1", "threadId": "t1", "raw": raw})
+
+    info = GmailClient.select(message)
+    assert info["title"] == "請求書"
+    assert info["sender_name"] == "山田"
+    assert info["sender_address"] == "yamada@example.com"
+
+    parts = list(iter_attachment_parts(message, info))
+    assert [(p[0], p[1], p[2]) for p in parts] == [
+        ("請求書.pdf", "application/pdf", None),
+        ("fwd.eml", "message/rfc822", None),
+        ("a.csv", "text/csv", None),
+    ]
+    assert parts[0][3] == bytes(range(256)) * 10
+    assert b"Subject: inner" in parts[1][3]
+    assert parts[2][3] == b"inner"
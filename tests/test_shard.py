@@ -0,0 +1,37 @@
+import pytest
+
+from modules._shard import shard_query
+
+
+def test_shard_query_by_month():
+    queries = shard_query("after:2024/01/15 before:2024/04/01 has:attachment", "month")
+
+    assert queries == [
+        "has:attachment after:2024/01/15 before:2024/02/01",
+        "has:attachment after:2024/02/01 before:2024/03/01",
+        "has:attachment after:2024/03/01 before:2024/04/01",
+    ]
+
+
+def test_shard_query_by_count():
+    queries = shard_query("newer:2024-01-01 older:2024-01-11", "3")
+
+    assert queries == [
+        "after:2024/01/01 before:2024/01/05",
+        "after:2024/01/05 before:2024/01/09",
+        "after:2024/01/09 before:2024/01/11",
+    ]
+
+
+def test_shard_query_by_timestamp():
+    queries = shard_query("after:1704067200 before:1704240000", "day")
+
+    assert queries == [
+        "after:1704067200 before:1704153600",
+        "after:1704153600 before:1704240000",
+    ]
+
+
+def test_shard_query_requires_after():
+    with pytest.raises(ValueError):
+        shard_query("before:2024/01/01", "month")
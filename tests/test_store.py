@@ -0,0 +1,38 @@
+import os
+
+from fsspec import filesystem
+
+from modules._store import BlobStore
+from modules._writer import BulkWriter
+
+
+def test_blob_store_hardlinks_duplicates(tmp_path):
+    fs = filesystem("file")
+    root = str(tmp_path)
+    os.makedirs(tmp_path / "a")
+    os.makedirs(tmp_path / "b")
+
+    with BulkWriter(fs) as writer:
+        store = BlobStore(fs, root, writer, mode="hardlink")
+        first = store.put(str(tmp_path / "a" / "invoice.pdf"), b"same")
+        second = store.put(str(tmp_path / "b" / "invoice.pdf"), b"same")
+
+    assert first == second
+    assert store.saved_bytes == 4
+    assert os.stat(tmp_path / "a" / "invoice.pdf").st_nlink == 3
+    assert (tmp_path / "b" / "invoice.pdf").read_bytes() == b"same"
+
+
+def test_blob_store_manifest(tmp_path):
+    fs = filesystem("memory")
+    root = "/manifest"
+
+    with BulkWriter(fs) as writer:
+        store = BlobStore(fs, root, writer, mode="manifest")
+        store.put("/manifest/a/x.pdf", b"1")
+        store.put("/manifest/b/x.pdf", b"1")
+        store.close()
+
+    reopened = BlobStore(fs, root, BulkWriter(fs), mode="manifest")
+    assert len(reopened._digests) == 1
+    assert set(reopened._manifest) == {"/manifest/a/x.pdf", "/manifest/b/x.pdf"}
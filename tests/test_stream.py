@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from modules import _google, _stream
+from modules._catalog import Catalog
+
+from .fake_gmail import read_tree
+
+
+def test_parse_stage_workers():
+    assert _stream.parse_stage_workers("fetch=8,write=2", 4) == {
+        "fetch": 8,
+        "filter": 1,
+        "download": 4,
+        "decode": 1,
+        "write": 2,
+    }
+    with pytest.raises(ValueError):
+        _stream.parse_stage_workers("index=2", 4)
+
+
+@pytest.mark.parametrize("stage_workers", ["", "fetch=4,download=8,write=3"])
+def test_stream_matches_pipe_extract_attachments(tmp_path, fake, stage_workers):
+    excludes = {"_1.pdf"}
+    _google.pipe_extract_attachments("file", str(tmp_path / "batch"), excludes=excludes)
+    fake.calls.clear()
+    _stream.pipe_extract_attachments_stream(
+        "file",
+        str(tmp_path / "stream"),
+        workers=2,
+        stage_workers=stage_workers,
+        excludes=excludes,
+    )
+
+    assert read_tree(tmp_path / "stream") == read_tree(tmp_path / "batch")
+    assert fake.calls["gmail.users.messages.get"] == 5
+    assert not list((tmp_path / "journal").iterdir())
+
+    catalog = Catalog(str(tmp_path / "catalog.sqlite"))
+    _, rows = catalog.query(
+        "SELECT COUNT(*) FROM attachments WHERE output_dir = ?",
+        (str(tmp_path / "stream"),),
+    )
+    catalog.close()
+    assert rows == [(len(read_tree(tmp_path / "stream")),)]
+
+
+def test_stream_resume_from_checkpoint(tmp_path, fake):
+    fake.page_size = 2
+    output_dir = tmp_path / "out"
+    get_attachment = fake.attachments
+
+    def failing_attachments():
+        attachments = get_attachment()
+        original = attachments.get
+
+        def get(userId, messageId, id, **kwargs):
+            if messageId == "m0003":
+                raise ConnectionError("network blip")
+            return original(userId, messageId, id, **kwargs)
+
+        attachments.get = get
+        return attachments
+
+    fake.attachments = failing_attachments
+    with pytest.raises(ConnectionError):
+        _stream.pipe_extract_attachments_stream("file", str(output_dir), workers=4)
+
+    # 完了順に関わらず、ジャーナルは一覧の順序で途切れなく記録する
+    (journal,) = (tmp_path / "journal").iterdir()
+    ids = [json.loads(line)["message_id"] for line in journal.read_text().splitlines()]
+    assert ids == [f"m{i:04d}" for i in range(len(ids))]
+    assert len(ids) < 5
+
+    fake.attachments = get_attachment
+    fake.calls.clear()
+    _stream.pipe_extract_attachments_stream(
+        "file", str(output_dir), workers=4, resume=True
+    )
+
+    assert fake.calls["gmail.users.messages.get"] == 5 - len(ids)
+    assert len(list(output_dir.rglob("*.pdf"))) == 10
+    assert not list((tmp_path / "journal").iterdir())
+
+
+def test_stream_incremental(tmp_path, fake):
+    output_dir = tmp_path / "out"
+
+    _stream.pipe_extract_attachments_stream(
+        "file", str(output_dir), workers=2, incremental=True
+    )
+    assert fake.calls["gmail.users.messages.get"] == 5
+
+    # 変更がなければ一覧も取得しない
+    fake.calls.clear()
+    _stream.pipe_extract_attachments_stream(
+        "file", str(output_dir), workers=2, incremental=True
+    )
+    assert "gmail.users.messages.list" not in fake.calls
+    assert len(list(output_dir.rglob("*.pdf"))) == 10
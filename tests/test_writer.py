@@ -0,0 +1,67 @@
+import base64
+import hashlib
+
+from fsspec import filesystem
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+
+from modules._writer import BulkWriter, OutputIndex, write_base64
+
+
+def test_bulk_writer_defers_until_flushed():
+    memory = filesystem("memory")
+    fs = AsyncFileSystemWrapper(memory, asynchronous=False)
+    done = []
+
+    with BulkWriter(fs, max_files=2) as writer:
+        writer.write("/bulk/a.pdf", b"a")
+        writer.defer(done.append, "m1")
+        assert done == []
+
+        writer.write("/bulk/b.pdf", b"b")
+        assert done == ["m1"]
+
+        writer.write("/bulk/c.pdf", b"c")
+        writer.defer(done.append, "m2")
+
+    assert done == ["m1", "m2"]
+    assert memory.cat("/bulk/c.pdf") == b"c"
+
+
+def test_writer_writes_immediately_on_sync_fs():
+    fs = filesystem("memory")
+    done = []
+
+    with BulkWriter(fs) as writer:
+        writer.write("/sync/a.pdf", b"a" * 10)
+        writer.defer(done.append, "m1")
+        assert done == ["m1"]
+
+    assert fs.cat("/sync/a.pdf") == b"a" * 10
+
+
+def test_write_base64_decodes_in_chunks():
+    fs = filesystem("memory")
+    data = bytes(range(256)) * 4 + b"x"
+    # Gmail の base64url はパディングを省略することがある
+    encoded = base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    size, digest = write_base64(fs, "/b64/a.bin", encoded, chunk_size=10)
+
+    assert fs.cat("/b64/a.bin") == data
+    assert size == len(data)
+    assert digest == hashlib.sha256(data).hexdigest()
+
+
+def test_output_index_evicts_least_recently_used_dirs():
+    memory = filesystem("memory")
+    index = OutputIndex(memory, max_dirs=2)
+    index.load({"/out/a/x.pdf": {"type": "file"}, "/out/a": {"type": "directory"}})
+
+    assert index.exists("memory:///out/a/x.pdf")
+    index.makedirs("/out/b")
+    assert index.has_dir("/out/a")
+    index.makedirs("/out/c")
+
+    assert not index.has_dir("/out/b")
+    assert index.has_dir("/out/a")
+    assert memory.isdir("/out/c")